@@ -0,0 +1,70 @@
+"""Benchmark saving the CSV of a new ensemble, which should use constant memory regardless of the number of rows.
+
+For the peak memory, the CSV is generated while it is read like a request stream, so it only includes the ensemble code.
+Run from the repository root with `python benchmarks/ensemble_csv.py`.
+"""
+
+import io
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+from ipsportal.ensemble import save_initial_csv
+
+PARAMETERS = [f'component_{idx}:parameter_{idx}' for idx in range(8)]
+
+
+class GeneratedCSV(io.RawIOBase):
+    """Readable stream of a CSV with `rows` members, generated on the fly."""
+
+    def __init__(self, rows: int) -> None:
+        self._lines = self._generate(rows)
+        self._pending = b''
+
+    @staticmethod
+    def _generate(rows: int) -> Iterator[bytes]:
+        yield f'sim_name,{",".join(PARAMETERS)}\n'.encode()
+        for row in range(rows):
+            yield f'sim_{row},{",".join(str(row * idx / 7) for idx in range(len(PARAMETERS)))}\n'.encode()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while len(self._pending) < len(buffer):
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._pending += line
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def main() -> None:
+    print(f'{"rows":>10} {"seconds":>10} {"rows/s":>10} {"peak KiB":>10} {"file MiB":>10}')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'ensemble.csv'
+        for rows in (10**3, 10**4, 10**5, 5 * 10**5):
+            # the throughput is measured on a CSV held in memory, as generating it takes longer than saving it
+            data = GeneratedCSV(rows).read()
+            start = time.perf_counter()
+            save_initial_csv(io.BytesIO(data), path)
+            elapsed = time.perf_counter() - start
+            del data
+
+            # tracemalloc slows down allocations, so the memory is measured in a separate run
+            tracemalloc.start()
+            save_initial_csv(io.BufferedReader(GeneratedCSV(rows)), path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            size = path.stat().st_size / 2**20
+            print(f'{rows:>10} {elapsed:>10.3f} {rows / elapsed:>10.0f} {peak / 1024:>10.0f} {size:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Benchmark the computation of the resource plot, which should scale linearly with the number of tasks.
+
+Run from the repository root with `python benchmarks/resource_plot.py`.
+"""
+
+import random
+import time
+from typing import Any
+
+from ipsportal.resourceplot import get_resource_usage
+
+COMPONENTS = [f'component_{idx}' for idx in range(8)]
+
+
+def make_tasks(count: int, seed: int = 0) -> list[dict[str, Any]]:
+    rng = random.Random(seed)
+    return [
+        {
+            'timestamp': rng.randrange(0, 3_600_000_000),
+            'duration': rng.randrange(1_000, 60_000_000),
+            'localEndpoint': {'serviceName': rng.choice(COMPONENTS)},
+            'tags': {'cores_allocated': rng.randint(1, 128)},
+        }
+        for _ in range(count)
+    ]
+
+
+def main() -> None:
+    print(f'{"tasks":>10} {"seconds":>10} {"µs/task":>10}')
+    for count in (10**3, 10**4, 10**5, 10**6):
+        tasks = make_tasks(count)
+        start = time.perf_counter()
+        get_resource_usage(tasks, time_start=0, duration=3_660)
+        elapsed = time.perf_counter() - start
+        print(f'{count:>10} {elapsed:>10.3f} {elapsed / count * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,4 +3,9 @@
 # create random secret key
 python -c 'import secrets; print(f"SECRET_KEY = \"{secrets.token_hex()}\"")' > /usr/local/var/ipsportal-instance/config.py
 
+# create the MongoDB indexes once, before the workers start
+flask --app ipsportal create-indexes
+# move events embedded in runs of older versions to the events collection, a no-op once they were moved
+flask --app ipsportal migrate-events
+
 exec "$@"
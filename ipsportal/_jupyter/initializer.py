@@ -17,14 +17,20 @@ To see available libraries on NERSC, run:
 import json
 import logging
 import mmap
+import os
 import shutil
+import tempfile
 from pathlib import Path
 
 import nbformat as nbf
+import portalocker
+
+from ..environment import DATA_LISTING_COMPACT_BYTES
 
 _logger = logging.getLogger(__name__)
 
 IPS_DATA_LIST_FILE = 'ips_analysis_api_data_listing.json'
+IPS_DATA_JOURNAL_FILE = 'ips_analysis_api_data_listing.jsonl'
 IPS_CHILD_RUNS_FILE = 'ips_analysis_api_child_runs.txt'
 
 CURRENT_API_VERSION = 'v1'
@@ -118,6 +124,41 @@ def initialize_jupyter_python_api(jupyterhub_dir: Path) -> None:
         f.write(_jupyter_notebook_api_code())
 
 
+_refreshed_api_dirs: set[Path] = set()
+
+
+def refresh_jupyter_python_api(jupyterhub_dir: Path) -> None:
+    """Replace an outdated copy of the API module, e.g. one which does not read the data listing journal yet.
+
+    The copy is otherwise only written when a new run directory is initialized, and notebooks load it from there.
+    Each directory is only compared once per process.
+    """
+    dest_dir = Path(jupyterhub_dir)
+    if dest_dir in _refreshed_api_dirs:
+        return
+
+    python_fname = f'ips_analysis_api_{CURRENT_API_VERSION}.py'
+    source_file = Path(__file__).parent / python_fname
+    dest_file = dest_dir / python_fname
+    source = source_file.read_bytes()
+    try:
+        current = dest_file.read_bytes()
+    except FileNotFoundError:
+        current = None
+    if current != source:
+        _logger.info('Refreshing outdated %s', dest_file)
+        # replace the file atomically, notebooks may load it at any time
+        with tempfile.NamedTemporaryFile('wb', dir=dest_dir, prefix=f'.{python_fname}.', delete=False) as tmp:
+            try:
+                tmp.write(source)
+                shutil.copymode(source_file if current is None else dest_file, tmp.name)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        os.replace(tmp.name, dest_file)
+    _refreshed_api_dirs.add(dest_dir)
+
+
 def initialize_jupyter_notebook(notebook_src: bytes, notebook_dest: Path) -> None:
     """Create a new notebook from an old notebook, copying the result from 'src' to 'dest'.
 
@@ -195,6 +236,11 @@ def update_data_listing_file(dest: Path, filename: str, timestamp: float = 0.0)
     """
     Potentially update the data listing file with new information.
 
+    The data file is appended to a journal (IPS_DATA_JOURNAL_FILE, one JSON object per line), so the cost does not
+    depend on the number of data files of the run. The journal is compacted into the data listing file
+    (IPS_DATA_LIST_FILE) once it grows larger than DATA_LISTING_COMPACT_BYTES and the data listing file itself.
+    Writers of the same run directory, also in different processes, are serialized with a lock file.
+
     NOTE: You should handle the "replace" flag before calling this function.
 
     Params:
@@ -204,30 +250,68 @@ def update_data_listing_file(dest: Path, filename: str, timestamp: float = 0.0)
 
     """
     data_listing_file = dest / IPS_DATA_LIST_FILE
-    if not data_listing_file.exists():
-        # we will potentially raise an OSError here
-        _initialize_jupyter_data_list_file(dest)
+    with portalocker.Lock(dest / f'.{IPS_DATA_LIST_FILE}.lock', 'a', timeout=30):
+        if not data_listing_file.exists():
+            # we will potentially raise an OSError here
+            _initialize_jupyter_data_list_file(dest)
+
+        entry = {'timestamp': str(timestamp), 'path': f'data/{filename}'}
+        # duplicate entries are only removed when reading, checking for them here would need to read the journal
+        with open(dest / IPS_DATA_JOURNAL_FILE, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            journal_size = f.tell()
+
+        if journal_size >= max(DATA_LISTING_COMPACT_BYTES, data_listing_file.stat().st_size):
+            _compact_data_listing(dest)
+
+
+def _read_data_listing(dest: Path) -> dict[str, list[str]]:
+    """Merge the data listing file and its journal, keeping the order in which data files were added."""
+    # read the journal first: a compaction in between moves its entries to the data listing file, read afterwards
+    try:
+        with open(dest / IPS_DATA_JOURNAL_FILE) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        lines = []
+    try:
+        with open(dest / IPS_DATA_LIST_FILE) as f:
+            mapping: dict[str, list[str]] = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # file is not valid JSON, so we'll overwrite it outright
+        mapping = {}
 
-    datafile_dest = f'data/{filename}'
-    with open(data_listing_file, 'r+') as f:
+    for line in lines:
         try:
-            mapping: dict[str, list[str]] = json.load(f)
-        except json.JSONDecodeError:
-            # file is not valid JSON, so we'll overwrite it outright
-            mapping = {}
-        string_timestamp = str(timestamp)
-        timestamp_values = mapping.get(string_timestamp)
-        if not isinstance(timestamp_values, list):
-            mapping[string_timestamp] = [datafile_dest]
-        elif datafile_dest not in timestamp_values:
-            timestamp_values.append(datafile_dest)
-        else:
-            # no need to write, duplicate value detected
-            return
-
-        f.seek(0)
-        f.truncate(0)
-        f.write(json.dumps(mapping, indent=2))
+            entry = json.loads(line)
+            timestamp_values = mapping.setdefault(entry['timestamp'], [])
+            path = entry['path']
+        except (json.JSONDecodeError, KeyError, TypeError):
+            # the last line may still be written
+            continue
+        if path not in timestamp_values:
+            timestamp_values.append(path)
+    return mapping
+
+
+def _compact_data_listing(dest: Path) -> None:
+    """Move the entries of the journal into the data listing file. The caller must hold the lock of the directory.
+
+    The data listing file is replaced atomically before the journal is emptied, so readers never miss entries.
+    """
+    data_listing_file = dest / IPS_DATA_LIST_FILE
+    mapping = _read_data_listing(dest)
+    with tempfile.NamedTemporaryFile('w', dir=dest, prefix=f'.{IPS_DATA_LIST_FILE}.', delete=False) as tmp:
+        try:
+            tmp.write(json.dumps(mapping, indent=2))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            shutil.copymode(data_listing_file, tmp.name)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+    os.replace(tmp.name, data_listing_file)
+    with open(dest / IPS_DATA_JOURNAL_FILE, 'w'):
+        pass
 
 
 def update_parent_module_file_with_child_runid(dest: Path, child_runid: int) -> None:
@@ -25,6 +25,7 @@ if TYPE_CHECKING:
 THIS_DIR = Path(__file__).resolve().parent
 
 IPS_DATA_LIST_FILE = 'ips_analysis_api_data_listing.json'
+IPS_DATA_JOURNAL_FILE = 'ips_analysis_api_data_listing.jsonl'
 IPS_CHILD_RUNS_FILE = 'ips_analysis_api_child_runs.txt'
 
 
@@ -109,9 +110,30 @@ def _normalize_data_filepaths(base_dir: Path, data: dict[str, list[str]]) -> dic
 def _get_data_from_directory(directory: Path) -> dict[float, list[str]]:
     """INTERNAL USE ONLY
 
-    'directory' should be an absolute path, not a relative path."""
+    'directory' should be an absolute path, not a relative path.
+
+    Data files are listed in IPS_DATA_LIST_FILE, and data files added since the IPS Portal last updated it
+    are listed in IPS_DATA_JOURNAL_FILE (one JSON object per line).
+    """
+    # read the journal first: if the IPS Portal moves its entries to the listing file in between, they are read there
+    try:
+        with open(directory / IPS_DATA_JOURNAL_FILE, 'rb') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        lines = []
     with open(directory / IPS_DATA_LIST_FILE, 'rb') as f:
         data: dict[str, list[str]] = json.load(f)
+
+    for line in lines:
+        try:
+            entry = json.loads(line)
+            file_path_list = data.setdefault(entry['timestamp'], [])
+            file_path = entry['path']
+        except (ValueError, KeyError, TypeError):
+            # the IPS Portal may still be writing the last line
+            continue
+        if file_path not in file_path_list:
+            file_path_list.append(file_path)
     return _normalize_data_filepaths(directory, data)
 
 
@@ -1,40 +1,66 @@
-import hashlib
+import gzip
+import io
 import logging
-import time
+import zlib
+from collections.abc import Iterator
 from json import JSONDecodeError
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 import pymongo
 import pymongo.errors
-import requests
-from flask import Blueprint, Response, current_app, json, jsonify, request
+from flask import Blueprint, Response, current_app, json, jsonify, request, stream_with_context
 
-from ipsportal.datatables import get_datatables_results
+from ipsportal.archive import ArchiveUnavailableError
+from ipsportal.datatables import get_datatables_results, get_datatables_rows
 from ipsportal.db import (
-    add_run,
+    ACCEPTING_STATES,
+    ENSEMBLE_PROGRESS_COUNTERS,
+    get_ensemble_progress,
     get_ensembles,
     get_events,
-    get_parent_portal_runid,
+    get_events_page,
+    get_events_total,
     get_portal_runid,
     get_run,
+    get_run_live_fields,
     get_runid,
     get_runs,
+    get_runs_page,
+    get_runs_search_filter,
     get_runs_total,
-    get_trace,
-    next_runid,
-    update_run,
+    iter_trace,
+    restore_archived_events,
 )
-from ipsportal.ensemble import update_ensemble_information
-from ipsportal.jupyter import setup_jupyter_from_ips_start
 
 # from ipsportal.environment import SECRET_API_KEY
-from ipsportal.trace_jaeger import send_trace
-from ipsportal.util import ALLOWED_PROPS_RUN
+from ipsportal.ensemble import PORTAL_GENERATED_KEYS, read_ensemble_csv, refresh_stale_ensemble_csv
+from ipsportal.environment import EVENT_STREAM_BATCH_SIZE, LIVE_KEEPALIVE_INTERVAL, LIVE_POLL_INTERVAL
+from ipsportal.http_cache import cached_run_response
+from ipsportal.ingest import EventIngester, validate_event
+from ipsportal.live import live_broker
+from ipsportal.pagination import CursorError
+from ipsportal.util import ALLOWED_PROPS_EVENT, ALLOWED_PROPS_RUN
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
 
 logger = logging.getLogger(__name__)
 
 bp = Blueprint('api', __name__)
 
+MAX_REPORTED_ERRORS = 100
+"""Maximum number of per-line errors included in the response of the event stream endpoint."""
+
+MAX_CHILD_RUNS_PAGE = 1000
+"""Maximum number of child runs per page."""
+
+_ARCHIVE_UNAVAILABLE_MESSAGE = 'the archive of this run is unavailable, try again later'
+
+
+def _archive_unavailable() -> tuple[Response, int]:
+    # the cause was logged by archive.load_documents
+    return jsonify(message=_ARCHIVE_UNAVAILABLE_MESSAGE), 503
+
 
 @bp.route('/api/runs-datatables')
 def runs_datatables() -> tuple[Response, int]:
@@ -50,6 +76,8 @@ def runs_datatables() -> tuple[Response, int]:
             data_query_fn=get_runs,
             count_query_fn=get_runs_total,
             base_filter={'parent_portal_runid': None},
+            search_filter_fn=get_runs_search_filter,
+            page_query_fn=get_runs_page,
         )
     except pymongo.errors.PyMongoError:
         logger.exception('Pymongo error')
@@ -72,63 +100,382 @@ def runs() -> tuple[Response, int]:
 
 @bp.route('/api/run/<string:portal_runid>/children')
 def child_runs(portal_runid: str) -> tuple[Response, int]:
-    return jsonify(get_runs(db_filter={'parent_portal_runid': portal_runid})), 200
+    return _child_runs(portal_runid)
 
 
 @bp.route('/api/run/<int:runid>/children')
 def child_runs_runid(runid: int) -> tuple[Response, int]:
-    return jsonify(get_runs(db_filter={'parent_portal_runid': get_portal_runid(runid)})), 200
+    return _child_runs(get_portal_runid(runid))
+
+
+def _child_runs(portal_runid: str | None) -> tuple[Response, int]:
+    """All child runs, or a page of them if "limit" or "cursor" are provided.
+
+    Pages are sorted by the "sort" property (default runid) in the "dir" direction (asc or desc, default asc),
+    and returned as {"data": [...], "next_cursor": ...}. Pass "next_cursor" as "cursor" to get the next page.
+    """
+    db_filter = {'parent_portal_runid': portal_runid}
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        return jsonify(get_runs(db_filter=db_filter)), 200
+
+    limit = request.args.get('limit', 100, type=int)
+    if limit is None or not 0 < limit <= MAX_CHILD_RUNS_PAGE:
+        return jsonify(message=f'limit must be between 1 and {MAX_CHILD_RUNS_PAGE}'), 400
+    sort_prop = request.args.get('sort', 'runid')
+    if sort_prop not in ALLOWED_PROPS_RUN:
+        return jsonify(message=f'sort must be one of {ALLOWED_PROPS_RUN}'), 400
+    sort_dir = {'asc': 1, 'desc': -1}.get(request.args.get('dir', 'asc'))
+    if sort_dir is None:
+        return jsonify(message='dir must be either "asc" or "desc"'), 400
+
+    try:
+        data, next_cursor = get_runs_page(
+            db_filter, 0, limit, {sort_prop: sort_dir, '_id': sort_dir}, request.args.get('cursor')
+        )
+    except CursorError as e:
+        return jsonify(message=str(e)), 400
+    return jsonify(data=data, next_cursor=next_cursor), 200
 
 
 @bp.route('/api/run/<int:runid>/events')
+@cached_run_response()
 def events_runid(runid: int) -> tuple[Response, int]:
-    events = get_events({'runid': runid})
+    """All events of a run, or only the events after the "after_seqnum" query parameter."""
+    after_seqnum = request.args.get('after_seqnum', type=int)
+    if after_seqnum is None and 'after_seqnum' in request.args:
+        return jsonify(message='after_seqnum must be an integer'), 400
+    try:
+        events = get_events({'runid': runid}, after_seqnum)
+    except ArchiveUnavailableError:
+        return _archive_unavailable()
     if events is None:
         return jsonify(message=f'runid {runid} not found'), 404
 
     return jsonify(events), 200
 
 
+@bp.route('/api/run/<int:runid>/events-datatables')
+def events_datatables_runid(runid: int) -> tuple[Response, int]:
+    return _events_datatables(get_portal_runid(runid), f'runid {runid} not found')
+
+
+@bp.route('/api/run/<string:portal_runid>/events-datatables')
+def events_datatables(portal_runid: str) -> tuple[Response, int]:
+    exists = get_runid(portal_runid) is not None
+    return _events_datatables(portal_runid if exists else None, f'portal_runid {portal_runid} not found')
+
+
+def _events_datatables(portal_runid: str | None, not_found_message: str) -> tuple[Response, int]:
+    """DataTables endpoint for the events of a run.
+
+    Besides the DataTables parameters, the "data" object can contain filters:
+    "eventtype" and "code" (exact matches), and "seqnum_min" and "seqnum_max" (inclusive).
+    """
+    if portal_runid is None:
+        return jsonify(message=not_found_message), 404
+    try:
+        arguments: dict[str, Any] = json.loads(request.args.get('data', '{}'))
+    except JSONDecodeError:
+        return jsonify(('data', '"data" query parameter must be JSON-parseable')), 400
+    if not isinstance(arguments, dict):
+        return jsonify(('<BASE>', 'query parameter must be a DataTables JSON object string')), 400
+
+    errors: list[tuple[str, str]] = []
+    extra_filter: dict[str, Any] = {}
+    for prop in ('eventtype', 'code'):
+        value = arguments.get(prop)
+        if value is None:
+            continue
+        if isinstance(value, str):
+            extra_filter[prop] = value
+        else:
+            errors.append((prop, 'must be a string'))
+    seqnum_range: dict[str, int] = {}
+    for prop, operator in (('seqnum_min', '$gte'), ('seqnum_max', '$lte')):
+        value = arguments.get(prop)
+        if value is None:
+            continue
+        if isinstance(value, int) and not isinstance(value, bool):
+            seqnum_range[operator] = value
+        else:
+            errors.append((prop, 'must be an integer'))
+    if seqnum_range:
+        extra_filter['seqnum'] = seqnum_range
+    if errors:
+        return jsonify(errors), 400
+
+    try:
+        # the events table queries the events collection, which no longer holds the events of archived runs
+        restore_archived_events(portal_runid)
+        datatables_ok, datatables_value = get_datatables_results(
+            arguments,
+            allowed_props=ALLOWED_PROPS_EVENT,
+            data_query_fn=get_events_page,
+            count_query_fn=get_events_total,
+            base_filter={'portal_runid': portal_runid},
+            extra_filter=extra_filter,
+            # seqnum is unique within a run, so the (portal_runid, <column>, seqnum) indexes of db.ensure_indexes
+            # satisfy the sort of every column in ALLOWED_PROPS_EVENT
+            sort_tiebreaker='seqnum',
+        )
+    except ArchiveUnavailableError:
+        return _archive_unavailable()
+    except pymongo.errors.PyMongoError:
+        logger.exception('Pymongo error')
+        return jsonify('Internal Service Error'), 500
+    if not datatables_ok:
+        logger.warning('DataTables value invalid: %s', datatables_value)
+        return jsonify(datatables_value), 400
+    return jsonify(datatables_value), 200
+
+
+@bp.route('/api/run/<int:runid>/ensembles/summary')
+def ensembles_summary(runid: int) -> tuple[Response, int]:
+    """Progress of every ensemble of a run, from counters kept up to date while ingesting the events of its members.
+
+    Ensembles created before the counters existed report no members.
+    """
+    try:
+        ensembles = get_ensembles(runid)
+        if not ensembles:
+            return jsonify(message=f'no ensembles for runid {runid}'), 404
+        progress = get_ensemble_progress([ensemble['ensemble_id'] for ensemble in ensembles])
+    except pymongo.errors.PyMongoError:
+        logger.exception('Pymongo error')
+        return jsonify('Internal Service Error'), 500
+    empty_progress = {
+        'members': None,
+        'pending': 0,
+        **dict.fromkeys(ENSEMBLE_PROGRESS_COUNTERS[1:], 0),
+        'walltime': {'min': None, 'max': None, 'mean': None},
+    }
+    return jsonify(
+        [
+            {
+                'ensemble_id': ensemble['ensemble_id'],
+                'ensemble_name': ensemble['ensemble_name'],
+                'component_name': ensemble['component_name'],
+                **progress.get(ensemble['ensemble_id'], empty_progress),
+            }
+            for ensemble in ensembles
+        ]
+    ), 200
+
+
+@bp.route('/api/run/<int:runid>/ensembles/<string:ensemble_id>')
+def ensemble_table(runid: int, ensemble_id: str) -> tuple[Response, int]:
+    """Rows of an ensemble of a run, from the ensemble CSV.
+
+    Without the "data" query parameter, this returns the name and the columns of the ensemble.
+    Otherwise "data" is a DataTables request, see datatables.get_datatables_rows.
+    The rows are arrays of values in the order of the columns.
+    """
+    ensembles = get_ensembles(runid, ensemble_id)
+    if not ensembles:
+        return jsonify(message=f'ensemble {ensemble_id} of runid {runid} not found'), 404
+    ensemble = ensembles[0]
+    refresh_stale_ensemble_csv(ensemble_id, ensemble['path'])
+    try:
+        columns, rows = read_ensemble_csv(ensemble['path'])
+    except OSError:
+        logger.exception('Unable to read ensemble CSV %s', ensemble['path'])
+        return jsonify(message='Unable to read ensemble'), 500
+    if len(columns) <= len(PORTAL_GENERATED_KEYS):
+        logger.error('Ensemble CSV %s is missing the sim_name column', ensemble['path'])
+        return jsonify(message='Unable to read ensemble'), 500
+
+    if 'data' not in request.args:
+        return jsonify(
+            ensemble_id=ensemble_id,
+            ensemble_name=ensemble['ensemble_name'],
+            component_name=ensemble['component_name'],
+            columns=columns,
+            # component keys always have a ':' in them, and other keys never do
+            component_keys=[column for column in columns if ':' in column],
+            recordsTotal=len(rows),
+        ), 200
+
+    try:
+        arguments = json.loads(request.args['data'])
+    except JSONDecodeError:
+        return jsonify(('data', '"data" query parameter must be JSON-parseable')), 400
+    # sim names are unique per ensemble
+    datatables_ok, datatables_value = get_datatables_rows(
+        arguments, columns, rows, sort_tiebreaker=columns[len(PORTAL_GENERATED_KEYS)]
+    )
+    if not datatables_ok:
+        return jsonify(datatables_value), 400
+    return jsonify(datatables_value), 200
+
+
 @bp.route('/api/run/<int:runid>')
+@cached_run_response()
 def run_runid(runid: int) -> tuple[Response, int]:
-    run = get_run({'runid': runid})
-    if run is None:
-        return jsonify(message=f'runid {runid} not found'), 404
-    return jsonify(run), 200
+    return _run({'runid': runid}, f'runid {runid} not found')
 
 
 @bp.route('/api/run/<string:portal_runid>')
+@cached_run_response()
 def run(portal_runid: str) -> tuple[Response, int]:
-    run = get_run({'portal_runid': portal_runid})
+    return _run({'portal_runid': portal_runid}, f'portal_runid {portal_runid} not found')
+
+
+def _run(db_filter: dict[str, Any], not_found_message: str) -> tuple[Response, int]:
+    """The run summary.
+
+    With the "after_seqnum" query parameter, only the fields which change while the run is running are returned,
+    and "new_events" tells whether events were added after that seqnum.
+    """
+    if 'after_seqnum' not in request.args:
+        run = get_run(db_filter)
+        if run is None:
+            return jsonify(message=not_found_message), 404
+        return jsonify(run), 200
+
+    after_seqnum = request.args.get('after_seqnum', type=int)
+    if after_seqnum is None:
+        return jsonify(message='after_seqnum must be an integer'), 400
+    run = get_run_live_fields(db_filter)
     if run is None:
-        return jsonify(message=f'portal_runid {portal_runid} not found'), 404
+        return jsonify(message=not_found_message), 404
+    run['new_events'] = run.get('last_seqnum', after_seqnum + 1) > after_seqnum
     return jsonify(run), 200
 
 
+@bp.route('/api/run/<int:runid>/stream')
+def run_stream_runid(runid: int) -> tuple[Response, int]:
+    return _run_stream({'runid': runid}, f'runid {runid} not found')
+
+
+@bp.route('/api/run/<string:portal_runid>/stream')
+def run_stream(portal_runid: str) -> tuple[Response, int]:
+    return _run_stream({'portal_runid': portal_runid}, f'portal_runid {portal_runid} not found')
+
+
+def _server_sent_event(message_type: str, data: Any, event_id: int | None = None) -> str:
+    message = f'event: {message_type}\ndata: {json.dumps(data)}\n'
+    if event_id is not None:
+        message += f'id: {event_id}\n'
+    return message + '\n'
+
+
+def _run_stream(db_filter: dict[str, Any], not_found_message: str) -> tuple[Response, int]:
+    """Server-Sent Events of a run, until it ends.
+
+    Messages are "run" with the changed fields of the run (the first message has all of them),
+    "events" with a list of new events, and "end" once the run stopped accepting events.
+    An "error" message ends the stream if the requested past events could not be loaded from the archive.
+    Only events after the "after_seqnum" query parameter (or the Last-Event-ID header when reconnecting)
+    are sent, by default the stream starts with the next event.
+    """
+    run = get_run_live_fields(db_filter)
+    if run is None:
+        return jsonify(message=not_found_message), 404
+    after_seqnum = request.args.get('after_seqnum', type=int)
+    if after_seqnum is None:
+        after_seqnum = request.headers.get('Last-Event-ID', type=int)
+    if after_seqnum is None:
+        after_seqnum = run.get('last_seqnum', -1)
+
+    def generate() -> Iterator[str]:
+        subscription = live_broker.subscribe(run['portal_runid'], after_seqnum)
+        try:
+            yield f'retry: {int(LIVE_POLL_INTERVAL * 1000) + 2000}\n\n'
+            live_broker.publish_run(run['portal_runid'], run)
+            if run.get('last_seqnum', after_seqnum) > after_seqnum:
+                try:
+                    events = get_events(db_filter, after_seqnum) or []
+                except ArchiveUnavailableError:
+                    yield _server_sent_event('error', {'message': _ARCHIVE_UNAVAILABLE_MESSAGE})
+                    return
+                live_broker.publish_events(run['portal_runid'], events)
+            while not subscription.overflowed:
+                message = subscription.get(timeout=LIVE_KEEPALIVE_INTERVAL)
+                if message is None:
+                    # also detects clients which went away
+                    yield ': keepalive\n\n'
+                    continue
+                message_type, data = message
+                if message_type == 'events':
+                    yield _server_sent_event(message_type, data, data[-1]['seqnum'])
+                else:
+                    yield _server_sent_event(message_type, data)
+                    if data.get('state', 'Running') not in ACCEPTING_STATES:
+                        yield _server_sent_event('end', data['state'])
+                        return
+        finally:
+            live_broker.unsubscribe(subscription)
+
+    return (
+        Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            # stop nginx from buffering the stream
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        ),
+        200,
+    )
+
+
 @bp.route('/api/run/<string:portal_runid>/events')
+@cached_run_response()
 def events(portal_runid: str) -> tuple[Response, int]:
-    events = get_events({'portal_runid': portal_runid})
+    """All events of a run, or only the events after the "after_seqnum" query parameter."""
+    after_seqnum = request.args.get('after_seqnum', type=int)
+    if after_seqnum is None and 'after_seqnum' in request.args:
+        return jsonify(message='after_seqnum must be an integer'), 400
+    try:
+        events = get_events({'portal_runid': portal_runid}, after_seqnum)
+    except ArchiveUnavailableError:
+        return _archive_unavailable()
     if events is None:
         return jsonify(message=f'portal_runid {portal_runid} not found'), 404
     return jsonify(events), 200
 
 
 @bp.route('/api/run/<int:runid>/trace')
+@cached_run_response(include_descendants=True)
 def trace_runid(runid: int) -> tuple[Response, int]:
-    trace = get_trace({'runid': runid})
-    if trace == []:
-        return jsonify(message=f'runid {runid} not found'), 404
-
-    return jsonify(trace), 200
+    return _trace({'runid': runid}, f'runid {runid} not found')
 
 
 @bp.route('/api/run/<string:portal_runid>/trace')
+@cached_run_response(include_descendants=True)
 def trace(portal_runid: str) -> tuple[Response, int]:
-    trace = get_trace({'portal_runid': portal_runid})
-    if trace == []:
-        return jsonify(message=f'portal_runid {portal_runid} not found'), 404
+    return _trace({'portal_runid': portal_runid}, f'portal_runid {portal_runid} not found')
+
 
-    return jsonify(trace), 200
+def _trace(db_filter: dict[str, Any], not_found_message: str) -> tuple[Response, int]:
+    """Stream the spans of a run and its descendants as a JSON array.
+
+    The optional "depth" query parameter limits the generations of descendants, and "limit" the number of spans.
+    """
+    max_depth = request.args.get('depth', type=int)
+    if max_depth is not None and max_depth < 0:
+        return jsonify(message='depth must be a non-negative integer'), 400
+    max_spans = request.args.get('limit', type=int)
+    if max_spans is not None and max_spans < 1:
+        return jsonify(message='limit must be a positive integer'), 400
+
+    spans = iter_trace(db_filter, max_depth, max_spans)
+    try:
+        first = next(spans, None)
+    except ArchiveUnavailableError:
+        return _archive_unavailable()
+    if first is None:
+        return jsonify(message=not_found_message), 404
+
+    def generate() -> Iterator[str]:
+        yield '[' + json.dumps(first)
+        try:
+            for span in spans:
+                yield ',' + json.dumps(span)
+        except ArchiveUnavailableError:
+            # the status was already sent, leave the array unterminated so clients fail to parse it
+            return
+        yield ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json'), 200
 
 
 @bp.route('/', methods=['POST'])
@@ -144,165 +491,112 @@ def event() -> tuple[Response, int]:
         current_app.logger.error('Missing data')
         return jsonify(message='Missing data'), 400
 
-    successes = 0
-    errors = []
-
     if isinstance(event_list, dict):
         event_list = [event_list]
 
-    output: dict[str, Any] = {}
-    output['message'] = '{} events added to run'
+    # validate the whole batch before writing anything, so a bad event never leaves the batch half-applied
+    validation_errors = [validate_event(e) for e in event_list]
+    if any(validation_errors):
+        current_app.logger.error('Invalid event batch: %s', validation_errors)
+        results = [
+            {'status': 'error', 'error': error} if error else {'status': 'not_applied'} for error in validation_errors
+        ]
+        return jsonify(message=next(error for error in validation_errors if error), results=results), 400
 
+    ingester = EventIngester(request.root_url.rstrip('/'))
     for e in event_list:
-        required = {'code', 'eventtype', 'comment', 'walltime', 'phystimestamp', 'portal_runid', 'seqnum'}
-        run_keys = {
-            'user',
-            'host',
-            'state',
-            'rcomment',
-            'tokamak',
-            'shotno',
-            'simname',
-            'startat',
-            'stopat',
-            'sim_runid',
-            'outputprefix',
-            'tag',
-            'ips_version',
-            'portal_runid',
-            'ok',
-            'walltime',
-            'parent_portal_runid',
-            'portal_ensemble_id',
-            'vizurl',
-        }
-
-        if not e.keys() >= required:
-            current_app.logger.error('Missing required data: %s', e)
-            return jsonify(message=f'Missing required data: {sorted(k for k in required if k not in e)}'), 400
-
-        if 'time' not in e:
-            e['time'] = time.strftime('%Y-%m-%d|%H:%M:%S%Z', time.localtime())
-
-        if e.get('eventtype') == 'IPS_START':
-            runid = next_runid()
-            run_dict: dict[str, Any] = {key: e[key] for key in run_keys if key in e}
-            run_dict['runid'] = runid
-            run_dict['events'] = [e]
-            run_dict['traces'] = []
-            run_dict['has_trace'] = False
-            try:
-                add_run(run_dict)
-                setup_jupyter_from_ips_start(run_dict['user'], runid)
-                # if this is an ensemble run, we need to update its parent
-                if (
-                    'portal_ensemble_id' in run_dict
-                    and 'parent_portal_runid' in run_dict
-                    and 'simname' in run_dict
-                    and 'user' in run_dict
-                ):
-                    logger.info(
-                        'Preparing to update ensemble CSV with runid %s of parent_portal_runid %s',
-                        runid,
-                        run_dict['parent_portal_runid'],
-                    )
-                    error = ''
-                    parent_integer_runid = get_runid(run_dict['parent_portal_runid'])
-                    if parent_integer_runid is not None:
-                        ensembles = get_ensembles(parent_integer_runid, run_dict['portal_ensemble_id'])
-                        if ensembles is not None:
-                            try:
-                                update_ensemble_information(
-                                    runid,
-                                    request.root_url.rstrip('/'),
-                                    run_dict['simname'],
-                                    run_dict['user'],
-                                    ensembles[0]['path'],
-                                )
-                            except Exception:
-                                logger.exception('update_ensemble_information exception...')
-                                error = 'exception from update_ensemble_information'
-                        else:
-                            error = 'failed when trying to get the actual runid from the parent_portal_runid and the portal_ensemble_id'
-                    else:
-                        error = 'unable to retrieve the real runid from the parent portal runid'
-                    if error:
-                        errors.append('Could not update parent ensemble information')
-                        current_app.logger.error(
-                            'Could not update parent ensemble information for parentid=%s simname=%s ensemble_id=%s because: %s',
-                            run_dict['parent_portal_runid'],
-                            run_dict['simname'],
-                            run_dict['portal_ensemble_id'],
-                            error,
-                        )
-            except FileNotFoundError:
-                current_app.logger.exception('no file for %s', run_dict['parent_portal_runid'])
-                errors.append('could not update ensemble file')
-                continue
-            except pymongo.errors.DuplicateKeyError:
-                current_app.logger.exception('Duplicate Key %s', run_dict)
-                errors.append('Duplicate portal_runid Key')
-                continue
-            except Exception:
-                current_app.logger.exception('unknown IPS_START exception')
-                continue
-            successes += 1
-            output['message'] = 'New run created and ' + output['message']
-            output['runid'] = runid
-            if 'simname' in e:
-                output['simname'] = e['simname']
-            continue
-
-        update: dict[str, Any] = {'$push': {'events': e}}
-        update['$currentDate'] = {
-            'lastModified': True,
-        }
-
-        if e.get('eventtype') == 'IPS_END':
-            run_dict = {key: e[key] for key in run_keys if key in e}
-            update['$set'] = run_dict
-            output['message'] = output['message'] + ' and run ended'
-        else:
-            update['$set'] = {'walltime': e.get('walltime')}
-            if 'vizurl' in e:
-                update['$set']['vizurl'] = e.get('vizurl')
-
-        if trace := e.pop('trace', False):
-            update['$push']['traces'] = trace
-            if '$set' in update:
-                update['$set']['has_trace'] = True
-            else:
-                update['$set'] = {'has_trace': True}
-
-        update_result = update_run({'portal_runid': e.get('portal_runid'), 'state': 'Running'}, update)
-        if update_result.modified_count == 0:
-            current_app.logger.error('Invalid portal_runid %s', update)
-            errors.append('Invalid portal_runid')
-            continue
-
-        if trace:
-            traces = [trace]
-
-            # add traces to parent run recursively
-            portal_runid = e['portal_runid']
-            while parent_portal_runid := get_parent_portal_runid(portal_runid):
-                new_trace = trace.copy()
-                new_trace['traceId'] = hashlib.md5(parent_portal_runid.encode()).hexdigest()
-                traces.append(new_trace)
-                portal_runid = parent_portal_runid
+        ingester.add(e)
+    ingester.flush()
+
+    if ingester.errors:
+        return jsonify(**ingester.summary(), results=ingester.results, errors=ingester.errors), 400
+
+    return jsonify(**ingester.summary(), results=ingester.results), 200
+
+
+@bp.route('/api/events/stream', methods=['POST'])
+def events_stream() -> tuple[Response, int]:
+    """Ingest newline-delimited JSON events (one event object per line).
+
+    The body is parsed incrementally and written to Mongo every EVENT_STREAM_BATCH_SIZE events,
+    so a single long-lived request can carry all events of a run. The body may be compressed,
+    as indicated by the Content-Encoding header ('gzip', or 'zstd' if the zstandard package is installed).
+
+    Invalid lines are skipped and reported with their line number, all other events are still ingested.
+    Like /api/event, the response is 400 if any event was rejected or another error occurred while ingesting.
+    """
+    if request.mimetype != 'application/x-ndjson':
+        return jsonify(message="Content-Type HTTP header value must be 'application/x-ndjson'"), 415
+
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    stream: Iterable[bytes]
+    if encoding == 'gzip':
+        stream = gzip.GzipFile(fileobj=request.stream, mode='rb')
+    elif encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            return jsonify(message='zstd Content-Encoding is not supported by this server'), 415
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(request.stream))
+    elif encoding == 'identity':
+        stream = request.stream
+    else:
+        return jsonify(message=f'Unsupported Content-Encoding {encoding}'), 415
+
+    ingester = EventIngester(request.root_url.rstrip('/'))
+    line_numbers: list[int] = []
+    errors: list[dict[str, Any]] = []
+    failed = 0
+    other_errors = 0
+    lines = 0
+
+    def record_results() -> None:
+        nonlocal failed, other_errors
+        results, ingester_errors = ingester.take_results()
+        for line_number, result in zip(line_numbers, results, strict=True):
+            if result['status'] == 'error':
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'line': line_number, 'error': result['error']})
+        # errors which do not belong to a single line, e.g. a parent ensemble which could not be updated
+        other_errors += len(ingester_errors)
+        for error in ingester_errors:
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'error': error})
+        line_numbers.clear()
 
+    try:
+        for lines, raw_line in enumerate(stream, start=1):
+            if not raw_line.strip():
+                continue
+            error: str | None
             try:
-                send_trace(traces)
-            except requests.exceptions.ConnectionError:
-                pass
-
-        successes += 1
-
-    output['message'] = output['message'].format(successes)
+                e = json.loads(raw_line)
+            except ValueError:
+                error = 'Invalid JSON'
+            else:
+                error = validate_event(e)
+            if error:
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'line': lines, 'error': error})
+                continue
 
-    if errors:
+            line_numbers.append(lines)
+            ingester.add(e)
+            if len(line_numbers) >= EVENT_STREAM_BATCH_SIZE:
+                record_results()
+    except (OSError, EOFError, zlib.error) as e:
+        # truncated or corrupt compressed data, everything up to this point was still ingested
+        current_app.logger.warning('Unable to read event stream: %s', e)
+        errors.append({'line': lines + 1, 'error': 'Unable to decode request body'})
+        failed += 1
+    finally:
+        record_results()
+
+    output = {**ingester.summary(), 'lines': lines, 'failed': failed}
+    if failed or other_errors:
         return jsonify(**output, errors=errors), 400
-
     return jsonify(**output), 200
 
 
@@ -0,0 +1,74 @@
+"""Cold storage of the events and traces of old runs, see db.tier_runs.
+
+Archived runs keep their document in MongoDB, with all summary fields, but their events and traces are moved
+to gzip compressed JSON objects in the ARCHIVE_BUCKET MinIO bucket, under "<portal_runid>/<kind>.json.gz".
+The run document records the object names in its "archive" property.
+Objects read back from MinIO are kept in a small per-process cache, as a run is usually viewed several times in a row.
+"""
+
+from __future__ import annotations
+
+import gzip
+import logging
+from typing import Any
+
+from bson import json_util
+from minio.error import MinioException
+from urllib3.exceptions import MaxRetryError
+
+from .environment import ARCHIVE_BUCKET, ARCHIVE_CACHE_MAX_ENTRIES, ARCHIVE_CACHE_TTL
+from .minio import get_minio_object, put_private_object
+from .util import TTLCache
+
+logger = logging.getLogger(__name__)
+
+_archive_cache: TTLCache[list[dict[str, Any]]] = TTLCache(ARCHIVE_CACHE_TTL, max_entries=ARCHIVE_CACHE_MAX_ENTRIES)
+
+
+def compress_documents(documents: list[dict[str, Any]]) -> bytes:
+    # extended JSON, so dates and other BSON types survive the round trip
+    return gzip.compress(json_util.dumps(documents).encode())
+
+
+def decompress_documents(data: bytes) -> list[dict[str, Any]]:
+    documents: list[dict[str, Any]] = json_util.loads(gzip.decompress(data))
+    return documents
+
+
+class ArchiveUnavailableError(Exception):
+    """Archived documents could not be loaded from MinIO, the cause is logged."""
+
+
+def store_documents(portal_runid: str, kind: str, documents: list[dict[str, Any]]) -> str:
+    """Store documents of a run in the archive.
+
+    Params:
+      kind: "events" or "traces"
+
+    Returns:
+      the object name to load the documents with
+
+    Raises MinioException or MaxRetryError if the documents could not be stored.
+    """
+    object_id = f'{portal_runid}/{kind}.json.gz'
+    put_private_object(compress_documents(documents), ARCHIVE_BUCKET, object_id, 'application/gzip')
+    return object_id
+
+
+def load_documents(object_id: str) -> list[dict[str, Any]]:
+    """Load documents from the archive.
+
+    Raises ArchiveUnavailableError if the documents could not be loaded.
+    """
+    documents = _archive_cache.get(object_id)
+    if documents is None:
+        try:
+            data = get_minio_object(ARCHIVE_BUCKET, object_id)
+        except (MinioException, MaxRetryError) as e:
+            logger.exception('Unable to load %s from the archive', object_id)
+            msg = f'archived documents {object_id} are unavailable'
+            raise ArchiveUnavailableError(msg) from e
+        documents = decompress_documents(data)
+        _archive_cache.set(object_id, documents)
+    # callers may modify the list
+    return list(documents)
@@ -180,6 +180,7 @@ def add_notebook() -> tuple[Response, int]:
                     '$push': {
                         'jupyter_urls': result[0],
                     },
+                    '$currentDate': {'lastModified': True},
                 },
                 upsert=True,
             )
@@ -280,7 +281,7 @@ def add_ensemble_variables() -> tuple[Response, int]:
     - X-Ips-Ensemble-Id - ID associated with a specific ensemble run (all ensemble children should post this)
     - X-Ips-Sim-Name - the name of the simulation
 
-    request body = the data file itself, in bytes
+    request body = the CSV file itself, in bytes. It is written to the ensemble file as it is received.
 
     Optional Parameters:
     - X-Ips-Replace - leave value empty if additive, remove if replacing
@@ -332,6 +333,7 @@ def add_ensemble_variables() -> tuple[Response, int]:
         ensemble_name,
         component_name,
         ensemble_id,
-        request.data,
+        # streamed, so large ensembles are never held in memory at once
+        request.stream,
     )
     return jsonify(result[0]), result[1]
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 from copy import deepcopy
+from functools import partial
 from typing import TYPE_CHECKING, Any, Literal
 
+from .pagination import CursorError
+
 if TYPE_CHECKING:
     from collections.abc import Callable
 
@@ -14,18 +17,21 @@ class SortParamError(Exception):
         self.message = message
 
 
-def _parse_sort_arguments(request: dict[str, Any], allowed_props: list[str]) -> dict[str, int]:
+def _parse_sort_arguments(request: dict[str, Any], allowed_props: list[str], tiebreaker: str = '_id') -> dict[str, int]:
     """Parse sort arguments from DataTables
 
     Params:
       request: DataTables server-side processing request argument
       allowed_props: list of allowed properties.
         If the request tries to get a property not in this list, raise SortParamException
+      tiebreaker: unique property which orders rows with equal values
 
     Returns:
       dictionary of property to sort direction.
         The dictionary should have the property names as keys,
         and the values should either be "1" (sort ASC) or "-1" (sort DESC).
+        Only the first sorted column is used, followed by the tiebreaker in the same direction,
+        so that a (<filter>, <column>, <tiebreaker>) index can satisfy the sort in either direction.
 
     Raises:
       SortParamException - if any params are not properly formatted. Should never be raised if
@@ -103,8 +109,9 @@ def _parse_sort_arguments(request: dict[str, Any], allowed_props: list[str]) ->
                 raise SortParamError(prop, 'missing "data" property') from None
 
     if sort_dict:
+        column, sort_code = next(iter(sort_dict.items()))
         # enforce sort consistency in case all other properties are equal
-        sort_dict['_id'] = 1
+        sort_dict = {column: sort_code, tiebreaker: sort_code}
 
     return sort_dict
 
@@ -129,6 +136,97 @@ def _add_search_terms(search_terms: list[str], allowed_props: list[str]) -> dict
     }
 
 
+def _parse_paging_arguments(request: dict[str, Any], errors: list[tuple[str, str]]) -> tuple[int, int, int]:
+    """Get the draw, start and length of a DataTables request, adding invalid values to `errors`."""
+    draw = request.get('draw', 0)
+    if not isinstance(draw, int) or draw < 0:
+        errors.append(('draw', 'must be a non-negative integer'))
+
+    start = request.get('start', 0)
+    if not isinstance(start, int) or start < 0:
+        errors.append(('start', 'must be a non-negative integer'))
+
+    length = request.get('length', 20)
+    if not isinstance(length, int) or length < 1:
+        errors.append(('length', 'must be a positive integer'))
+    return draw, start, length
+
+
+def _search_value(search: Any) -> list[str]:
+    """Get the lowercase terms of a DataTables search object."""
+    if isinstance(search, dict) and isinstance(search.get('value'), str):
+        return [term.lower() for term in search['value'].split()]
+    return []
+
+
+def _row_sort_key(idx: int, row: list[str]) -> tuple[int, float, str]:
+    # numbers sort numerically, before all other values
+    value = row[idx]
+    try:
+        return 0, float(value), ''
+    except ValueError:
+        return 1, 0.0, value.lower()
+
+
+def get_datatables_rows(
+    request: dict[str, Any], columns: list[str], rows: list[list[str]], sort_tiebreaker: str
+) -> tuple[Literal[False], list[tuple[str, str]]] | tuple[Literal[True], dict[str, Any]]:
+    """Counterpart of get_datatables_results for rows held in memory, e.g. parsed CSV files.
+
+    Params:
+      request: the parameters that DataTables provides, the "data" of the columns are indexes into `columns`
+      columns: names of the columns
+      rows: rows of values, in the order of `columns`
+      sort_tiebreaker: column with unique values which orders rows with equal values
+
+    The global search and the search values of individual columns match values case-insensitively by substring,
+    every term has to match. Values which are numbers sort numerically.
+
+    Returns:
+      the same as get_datatables_results, the data are rows of values
+    """
+    if not isinstance(request, dict):
+        return False, [('<BASE>', 'query parameter must be a DataTables JSON object string')]
+
+    errors: list[tuple[str, str]] = []
+    draw, start, length = _parse_paging_arguments(request, errors)
+    try:
+        sort_args = _parse_sort_arguments(request, columns, sort_tiebreaker)
+    except SortParamError as e:
+        sort_args = {}
+        errors.append((e.property, e.message))
+
+    column_terms: list[tuple[int, str]] = []
+    for idx, column in enumerate(request.get('columns') or []):
+        if not isinstance(column, dict):
+            continue
+        terms = _search_value(column.get('search'))
+        if terms and (not isinstance(column.get('data'), int) or not 0 <= column['data'] < len(columns)):
+            errors.append((f'columns[{idx}][data]', 'must be a valid property index'))
+            continue
+        column_terms.extend((column['data'], term) for term in terms)
+    if errors:
+        return False, errors
+
+    global_terms = _search_value(request.get('search'))
+    filtered = [
+        row
+        for row in rows
+        if all(term in row[idx].lower() for idx, term in column_terms)
+        and all(any(term in value.lower() for value in row) for term in global_terms)
+    ]
+    # sort by the least significant column first, Python's sort is stable
+    for prop, direction in reversed(sort_args.items()):
+        filtered.sort(key=partial(_row_sort_key, columns.index(prop)), reverse=direction == -1)
+
+    return True, {
+        'draw': draw,
+        'recordsTotal': len(rows),
+        'recordsFiltered': len(filtered),
+        'data': filtered[start : start + length],
+    }
+
+
 # potentially useful reference: https://github.com/pjosols/mongo-datatables
 # (NOTE: this library does NOT attempt to validate the input, so don't use it directly)
 def get_datatables_results(
@@ -137,6 +235,11 @@ def get_datatables_results(
     data_query_fn: Callable[[dict[str, Any], int, int, dict[str, int]], list[Any]],
     count_query_fn: Callable[[dict[str, Any]], int],
     base_filter: dict[str, Any] | None = None,
+    search_filter_fn: Callable[[list[str]], dict[str, Any]] | None = None,
+    page_query_fn: Callable[[dict[str, Any], int, int, dict[str, int], str | None], tuple[list[Any], str | None]]
+    | None = None,
+    extra_filter: dict[str, Any] | None = None,
+    sort_tiebreaker: str = '_id',
 ) -> tuple[Literal[False], list[tuple[str, str]]] | tuple[Literal[True], dict[str, Any]]:
     """
     This function is intended to be a generic mechanism when interacting with a DataTables request.
@@ -159,6 +262,17 @@ def get_datatables_results(
       base_filter: Optional parameter, this is a starting $match MongoDB query
         that can be appended to if the frontend sends search instructions.
         (note that the parameter will not be modified, we instead make a copy of it internally)
+      search_filter_fn: Optional callback function which takes in the search terms,
+        and returns the value to update the $match filter with.
+        By default, every term is matched against every allowed property with a regex.
+      page_query_fn: Optional callback function for keyset pagination, used instead of data_query_fn.
+        It takes in the same arguments as data_query_fn followed by the "cursor" of the request (if any),
+        and returns the data and the cursor of the next page, which is added to the response as "next_cursor".
+        DataTables does not know about cursors, the client must send the "next_cursor" of the previous page
+        as "cursor" along with the usual parameters.
+      extra_filter: Optional filters outside of DataTables' own parameters, e.g. from custom form fields.
+        These apply to "recordsFiltered" and the data, but not to "recordsTotal".
+      sort_tiebreaker: unique property which orders rows with equal values of the sorted column
 
     Returns:
       always a two-tuple value:
@@ -170,21 +284,14 @@ def get_datatables_results(
         return False, (('<BASE>', 'query parameter must be a DataTables JSON object string'))
 
     errors: list[tuple[str, str]] = []
+    draw, start, length = _parse_paging_arguments(request, errors)
 
-    draw = request.get('draw', 0)
-    if not isinstance(draw, int) or draw < 0:
-        errors.append(('draw', 'must be a non-negative integer'))
-
-    start = request.get('start', 0)
-    if not isinstance(start, int) or start < 0:
-        errors.append(('start', 'must be a non-negative integer'))
-
-    length = request.get('length', 20)
-    if not isinstance(length, int) or length < 1:
-        errors.append(('length', 'must be a positive integer'))
+    cursor = request.get('cursor')
+    if cursor is not None and not isinstance(cursor, str):
+        errors.append(('cursor', 'must be a string'))
 
     try:
-        sort_args = _parse_sort_arguments(request, allowed_props)
+        sort_args = _parse_sort_arguments(request, allowed_props, sort_tiebreaker)
     except SortParamError as e:
         sort_args = {}
         errors.append((e.property, e.message))
@@ -194,6 +301,8 @@ def get_datatables_results(
 
     # TODO: currently only checking global search, but DataTables API allows for per-column search
     where_filter = deepcopy(base_filter) if base_filter else {}
+    if extra_filter:
+        where_filter.update(deepcopy(extra_filter))
     search = request.get('search')
     if isinstance(search, dict):
         search_value = search.get('value')
@@ -201,14 +310,21 @@ def get_datatables_results(
             # TODO should probably sanitize this search result
             search_values = search_value.split()
             if search_values:
-                where_filter.update(_add_search_terms(search_values, allowed_props))
-
-    return (
-        True,
-        {
-            'draw': draw,
-            'recordsTotal': count_query_fn(base_filter or {}),
-            'recordsFiltered': count_query_fn(where_filter),
-            'data': data_query_fn(where_filter, start, length, sort_args),
-        },
-    )
+                if search_filter_fn:
+                    where_filter.update(search_filter_fn(search_values))
+                else:
+                    where_filter.update(_add_search_terms(search_values, allowed_props))
+
+    response: dict[str, Any] = {
+        'draw': draw,
+        'recordsTotal': count_query_fn(base_filter or {}),
+        'recordsFiltered': count_query_fn(where_filter),
+    }
+    if page_query_fn:
+        try:
+            response['data'], response['next_cursor'] = page_query_fn(where_filter, start, length, sort_args, cursor)
+        except CursorError as e:
+            return False, [('cursor', str(e))]
+    else:
+        response['data'] = data_query_fn(where_filter, start, length, sort_args)
+    return True, response
@@ -1,15 +1,75 @@
+import hashlib
+import json
 import logging
+import os
+import socket
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timedelta, timezone
 from typing import Any, TypedDict
 
-from flask import Flask, g
+import click
+from flask import Flask
 from pymongo import ASCENDING, DESCENDING, MongoClient
 from pymongo.database import Database
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from pymongo.operations import UpdateOne
+from pymongo.results import BulkWriteResult
 from werkzeug.local import LocalProxy
 
-from .environment import MONGO_HOST, MONGO_PASSWORD, MONGO_PORT, MONGO_USERNAME
+from .archive import load_documents, store_documents
+from .environment import (
+    ARCHIVE_AFTER_DAYS,
+    MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_HOST,
+    MONGO_MAX_POOL_SIZE,
+    MONGO_MIN_POOL_SIZE,
+    MONGO_PASSWORD,
+    MONGO_PORT,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS,
+    MONGO_USERNAME,
+    RUN_TIMEOUT_HOURS,
+    RUNS_COUNT_CACHE_TTL,
+    RUNS_COUNT_LIMIT,
+    TIMEOUT_SWEEP_INTERVAL,
+)
+from .pagination import decode_cursor, decode_offset_cursor, encode_cursor, encode_offset_cursor, keyset_filter
+from .search import SEARCHABLE_PROPS, run_search_tokens, search_filter
+from .util import ALLOWED_PROPS_EVENT, ALLOWED_PROPS_RUN, TTLCache
 
 logger = logging.getLogger(__name__)
 
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+
+RUNS_TABLE_PROJECTION = {
+    '_id': False,
+    'event_count': True,
+    'has_trace': True,
+    'host': True,
+    'ips_version': True,
+    'lastModified': True,
+    'last_seqnum': True,
+    'ok': True,
+    'parent_portal_runid': True,
+    'portal_runid': True,
+    'rcomment': True,
+    'runid': True,
+    'shotno': True,
+    'sim_runid': True,
+    'simname': True,
+    'startat': True,
+    'state': True,
+    'stopat': True,
+    'tag': True,
+    'tokamak': True,
+    'user': True,
+    'walltime': True,
+    'vizurl': True,
+}
+
 
 class EnsembleInformation(TypedDict):
     """A run can store a list of ensembles associated with it."""
@@ -31,40 +91,195 @@ class EnsembleInformation(TypedDict):
     """The path to the flat-file which stores the ensemble data"""
 
 
+_client: MongoClient[dict[str, Any]] | None = None
+_client_pid: int | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> MongoClient[dict[str, Any]]:
+    """Get the MongoDB client of this process.
+
+    Each process has one client with its own connection pool, which is shared by all requests and threads.
+    The client is created lazily, so gunicorn workers create their own client after forking.
+    """
+    global _client, _client_pid  # noqa: PLW0603
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                # a client inherited from the parent process must not be used (or closed) after a fork
+                client: MongoClient[dict[str, Any]] = MongoClient(
+                    host=MONGO_HOST,
+                    port=MONGO_PORT,
+                    username=MONGO_USERNAME,
+                    password=MONGO_PASSWORD,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_MIN_POOL_SIZE,
+                    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                )
+                # indexes are created by `flask --app ipsportal create-indexes` before the workers start
+                _client = client
+                _client_pid = os.getpid()
+    return _client
+
+
 def get_db() -> Database[dict[str, Any]]:
-    if 'db' not in g:
-        client: MongoClient[dict[str, Any]] = MongoClient(
-            host=MONGO_HOST,
-            port=MONGO_PORT,  # type: ignore[arg-type]
-            username=MONGO_USERNAME,
-            password=MONGO_PASSWORD,
-        )
-        client.portal.runs.create_index([('runid', DESCENDING)], unique=True)
-        client.portal.runs.create_index([('portal_runid', ASCENDING)], unique=True)
-        client.portal.data.create_index([('runid', DESCENDING)], unique=True)
-        # client.portal.data.create_index([('portal_runid', ASCENDING)], unique=True)
-        g.db = client.portal
+    return get_client().portal
+
+
+def ensure_indexes(database: Database[dict[str, Any]], replace_conflicting: bool = False) -> None:
+    """Create the indexes of all collections. This is a no-op for indexes which already exist.
+
+    Params:
+      database: the portal database
+      replace_conflicting: drop and recreate indexes whose options changed, e.g. indexes which became unique
+    """
+    indexes: list[tuple[str, list[tuple[str, int]], dict[str, Any]]] = [
+        ('runs', [('runid', DESCENDING)], {'unique': True}),
+        ('runs', [('portal_runid', ASCENDING)], {'unique': True}),
+        # used by the timeout sweeper
+        ('runs', [('state', ASCENDING), ('lastModified', ASCENDING)], {}),
+        # multikey index for searching the runs tables, see search.py
+        ('runs', [('parent_portal_runid', ASCENDING), ('search_tokens', ASCENDING)], {}),
+        # the runs tables filter by parent and sort by one column, see datatables._parse_sort_arguments
+        *(
+            ('runs', [('parent_portal_runid', ASCENDING), (column, ASCENDING), ('_id', ASCENDING)], {})
+            for column in ALLOWED_PROPS_RUN
+        ),
+        ('data', [('runid', DESCENDING)], {'unique': True}),
+        # events are idempotent on (portal_runid, seqnum)
+        ('events', [('portal_runid', ASCENDING), ('seqnum', ASCENDING)], {'unique': True}),
+        # the events table filters by run and sorts by one column, seqnum sorts use the unique index above
+        *(
+            ('events', [('portal_runid', ASCENDING), (column, ASCENDING), ('seqnum', ASCENDING)], {})
+            for column in ALLOWED_PROPS_EVENT
+            if column != 'seqnum'
+        ),
+        # ('data', [('portal_runid', ASCENDING)], {'unique': True}),
+        # children register as members of their parent's ensemble, see ensemble.add_ensemble_member
+        ('ensemble_members', [('ensemble_id', ASCENDING), ('sim_name', ASCENDING)], {'unique': True}),
+        # stale ensemble CSVs are detected by the latest registered member, see ensemble.refresh_stale_ensemble_csv
+        ('ensemble_members', [('ensemble_id', ASCENDING), ('lastModified', ASCENDING)], {}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            database[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            if not replace_conflicting or e.code not in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+                raise
+            logger.warning('Replacing index %s of %s', keys, collection)
+            database[collection].drop_index(keys)
+            database[collection].create_index(keys, **options)
+
+
+@click.command('create-indexes')
+def create_indexes_command() -> None:
+    """Create or update the indexes of all collections."""
+    ensure_indexes(get_db(), replace_conflicting=True)
+    click.echo('Created indexes')
+
+
+@click.command('sweep-timeouts')
+@click.option('--hours', type=float, default=RUN_TIMEOUT_HOURS, show_default=True, help='Timeout in hours.')
+def sweep_timeouts_command(hours: float) -> None:
+    """Mark running runs which did not receive an event for a while as timed out."""
+    click.echo(f'{sweep_timed_out_runs(hours)} runs timed out')
 
-    return g.db  # type: ignore[no-any-return]
 
+@click.command('update-search-tokens')
+def update_search_tokens_command() -> None:
+    """Add search tokens to runs created by older versions of the portal."""
+    click.echo(f'Added search tokens to {add_missing_search_tokens()} runs')
 
-def close_db(_e: BaseException | None = None) -> None:
-    db = g.pop('db', None)
 
-    if db is not None:
-        db.client.close()
+@click.command('recount-runs')
+def recount_runs_command() -> None:
+    """Recount the runs, e.g. after runs were deleted from the database."""
+    counters = reset_run_counters()
+    click.echo(f'Counted {counters["total"]} runs, {counters["top_level"]} top level runs')
+
+
+@click.command('tier-runs')
+@click.option(
+    '--days',
+    type=float,
+    default=ARCHIVE_AFTER_DAYS,
+    show_default=True,
+    help='Archive runs which were last modified more than this many days ago.',
+)
+def tier_runs_command(days: float) -> None:
+    """Move the events and traces of old runs which ended to the MinIO archive."""
+    click.echo(f'Archived {tier_runs(days)} runs')
+
+
+@click.command('migrate-events')
+def migrate_events_command() -> None:
+    """Move events embedded in run documents into the events collection."""
+    click.echo(f'Migrated the events of {migrate_embedded_events()} runs')
 
 
 def init_app(app: Flask) -> None:
-    app.teardown_appcontext(close_db)
+    app.cli.add_command(create_indexes_command)
+    app.cli.add_command(migrate_events_command)
+    app.cli.add_command(recount_runs_command)
+    app.cli.add_command(sweep_timeouts_command)
+    app.cli.add_command(tier_runs_command)
+    app.cli.add_command(update_search_tokens_command)
+    app.before_request(start_timeout_sweeper)
 
 
 # Use LocalProxy to read the global db instance with just `db`
 db: Database[dict[str, Any]] = LocalProxy(get_db)  # type: ignore[assignment]
 
 
+TOP_LEVEL_RUNS_FILTER = {'parent_portal_runid': None}
+"""Filter of the runs which are not children of other runs, i.e. the runs of the index page."""
+
+_runs_count_cache: TTLCache[int] = TTLCache(RUNS_COUNT_CACHE_TTL)
+
+
 def get_runs_total(db_filter: dict[str, Any]) -> int:
-    return db.runs.count_documents(db_filter)
+    """Count the runs matching a filter.
+
+    The number of top level runs is read from a counters document maintained at IPS_START.
+    Other counts are cached briefly, and stop at RUNS_COUNT_LIMIT.
+    """
+    if db_filter == TOP_LEVEL_RUNS_FILTER:
+        return get_run_counters()['top_level']
+
+    key = json.dumps(db_filter, sort_keys=True, default=str)
+    count = _runs_count_cache.get(key)
+    if count is None:
+        options: dict[str, Any] = {'maxTimeMS': 30_000}
+        if RUNS_COUNT_LIMIT:
+            options['limit'] = RUNS_COUNT_LIMIT
+        count = db.runs.count_documents(db_filter, **options)
+        _runs_count_cache.set(key, count)
+    return count
+
+
+def get_run_counters() -> dict[str, int]:
+    """Get the total number of runs, and the number of top level runs."""
+    counters = db.counters.find_one({'_id': 'runs'})
+    if counters is None:
+        # the first request after upgrading the portal counts once
+        counters = reset_run_counters()
+    return {'total': counters['total'], 'top_level': counters['top_level']}
+
+
+def reset_run_counters() -> dict[str, int]:
+    counters = {
+        'total': db.runs.estimated_document_count(),
+        'top_level': db.runs.count_documents(TOP_LEVEL_RUNS_FILTER),
+    }
+    db.counters.update_one({'_id': 'runs'}, {'$set': counters}, upsert=True)
+    return counters
+
+
+def increment_run_counters(top_level: bool) -> None:
+    """Count a new run. This is a no-op until the counters are initialized by get_run_counters."""
+    db.counters.update_one({'_id': 'runs'}, {'$inc': {'total': 1, 'top_level': int(top_level)}})
 
 
 def get_runs(
@@ -73,82 +288,384 @@ def get_runs(
     limit: int | None = None,
     sort: dict[str, int] | None = None,
 ) -> list[dict[str, Any]]:
-    aggregation_pipeline: list[dict[str, Any]] = [
-        {'$match': db_filter},
-        {
-            '$addFields': {
-                'timeout': {
-                    '$cond': [
-                        {
-                            '$and': [
-                                {'$eq': ['$state', 'Running']},
-                                {
-                                    '$or': [
-                                        {'$not': '$lastModified'},
-                                        {
-                                            '$gte': [
-                                                {
-                                                    '$dateDiff': {
-                                                        'startDate': '$lastModified',
-                                                        'endDate': '$$NOW',
-                                                        'unit': 'hour',
-                                                    }
-                                                },
-                                                3,
-                                            ]
-                                        },
-                                    ]
-                                },
-                            ]
-                        },
-                        True,
-                        False,
-                    ]
-                }
-            }
-        },
-        {
-            '$project': {
-                '_id': False,
-                'has_trace': True,
-                'host': True,
-                'ips_version': True,
-                'lastModified': True,
-                'ok': True,
-                'parent_portal_runid': True,
-                'portal_runid': True,
-                'rcomment': True,
-                'runid': True,
-                'shotno': True,
-                'sim_runid': True,
-                'simname': True,
-                'startat': True,
-                'state': {'$cond': ['$timeout', 'Timeout', '$state']},
-                'stopat': {'$cond': ['$timeout', {'$last': '$events.time'}, '$stopat']},
-                'tag': True,
-                'tokamak': True,
-                'user': True,
-                'walltime': True,
-                'vizurl': True,
-            }
-        },
-    ]
+    """Get runs for the runs tables.
+
+    The state of timed out runs is maintained by `sweep_timed_out_runs`, so this is a plain query
+    which can use the indexes for filtering and sorting.
+    """
+    # if the query is taking longer than 30 seconds (probably already too long), kill it to prevent a DDOS
+    cursor = db.runs.find(db_filter, projection=RUNS_TABLE_PROJECTION, max_time_ms=30_000)
     if sort:
-        aggregation_pipeline.append({'$sort': sort})
+        cursor = cursor.sort(list(sort.items()))
     if skip:
-        aggregation_pipeline.append({'$skip': skip})
+        cursor = cursor.skip(skip)
     if limit:
-        aggregation_pipeline.append({'$limit': limit})
+        cursor = cursor.limit(limit)
+    return list(cursor)
 
-    # if the query is taking longer than 30 seconds (probably already too long), kill it to prevent a DDOS
-    return list(db.runs.aggregate(aggregation_pipeline, maxTimeMS=30_000))
 
+MIXED_TYPE_RUN_PROPS = frozenset({'walltime'})
+"""Sortable run properties stored with different types (walltime is sent as a string or a number),
+which are paged with offset cursors instead of keyset filters, see pagination.py."""
+
+
+def get_runs_page(
+    db_filter: dict[str, Any],
+    skip: int,
+    limit: int,
+    sort: dict[str, int],
+    cursor: str | None = None,
+) -> tuple[list[dict[str, Any]], str | None]:
+    """Get a page of runs for the runs tables, with keyset pagination.
+
+    Sorts on MIXED_TYPE_RUN_PROPS skip rows instead, as keyset filters would miss rows of the other types.
+
+    Params:
+      cursor: the next_cursor returned with the previous page. If provided, `skip` is ignored.
+
+    Returns:
+      the runs, and the cursor of the next page (None if this is the last page)
+
+    Raises:
+      CursorError if the cursor is invalid
+    """
+    sort = sort or {'_id': ASCENDING}
+    keyset = MIXED_TYPE_RUN_PROPS.isdisjoint(sort)
+    if cursor is not None and keyset:
+        db_filter = {'$and': [db_filter, keyset_filter(sort, decode_cursor(cursor, sort))]}
+        skip = 0
+    elif cursor is not None:
+        skip = decode_offset_cursor(cursor, sort)
+    runs = list(
+        db.runs.find(
+            db_filter,
+            projection={**RUNS_TABLE_PROJECTION, '_id': True},
+            sort=list(sort.items()),
+            skip=skip,
+            limit=limit,
+            max_time_ms=30_000,
+        )
+    )
+    next_cursor = None
+    if len(runs) == limit:
+        next_cursor = encode_cursor(sort, runs[-1]) if keyset else encode_offset_cursor(sort, skip + limit)
+    for run in runs:
+        del run['_id']
+    return runs, next_cursor
+
+
+def get_runs_search_filter(search_terms: list[str]) -> dict[str, Any]:
+    """Build the search filter of the runs tables, see search.search_filter."""
+    # distinct values of an indexed field are read from the index
+    return search_filter(search_terms, db.runs.distinct('state'))
+
+
+def add_missing_search_tokens(batch_size: int = 1000) -> int:
+    """Add search tokens to runs which do not have them yet.
+
+    Returns:
+      number of runs updated
+    """
+    updated = 0
+    batch: list[UpdateOne] = []
+    projection = {'_id': True, **dict.fromkeys(SEARCHABLE_PROPS, True)}
+    for run in db.runs.find({'search_tokens': {'$exists': False}}, projection=projection):
+        batch.append(UpdateOne({'_id': run['_id']}, {'$set': {'search_tokens': run_search_tokens(run)}}))
+        if len(batch) >= batch_size:
+            updated += db.runs.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += db.runs.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+def sweep_timed_out_runs(timeout_hours: float = RUN_TIMEOUT_HOURS) -> int:
+    """Mark running runs which did not receive an event for a while as timed out.
+
+    Timed out runs become running again if they receive another event.
+
+    Returns:
+      number of runs which timed out
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=timeout_hours)
+    # runs created by older versions of the portal may not have lastModified
+    timed_out = {'state': 'Running', '$or': [{'lastModified': {'$lt': cutoff}}, {'lastModified': None}]}
+    update = [{'$set': {'state': 'Timeout', 'stopat': {'$ifNull': ['$last_event_time', '$stopat']}}}]
+
+    # ensemble members time out one by one, so only the members which actually timed out are counted
+    count = 0
+    progress = []
+    for run in db.runs.find(
+        {**timed_out, 'portal_ensemble_id': {'$exists': True}}, projection={'_id': True, 'portal_ensemble_id': True}
+    ):
+        if db.runs.update_one({**timed_out, '_id': run['_id']}, update).modified_count:
+            count += 1
+            progress.append(ensemble_progress_update(run['portal_ensemble_id'], 'Running', 'Timeout'))
+    update_ensemble_progress([p for p in progress if p is not None])
+
+    result = db.runs.update_many({**timed_out, 'portal_ensemble_id': {'$exists': False}}, update)
+    return count + result.modified_count
+
+
+def acquire_lease(name: str, holder: str, seconds: float) -> bool:
+    """Take or renew a lease for `seconds`, unless another holder has a lease which did not expire yet.
+
+    Leases let a single process of all portal processes do periodic background work.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        db.leases.update_one(
+            {'_id': name, '$or': [{'holder': holder}, {'expires': {'$lt': now}}]},
+            {'$set': {'holder': holder, 'expires': now + timedelta(seconds=seconds)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # the upsert conflicts with the lease of another holder
+        return False
+    return True
+
+
+_sweeper_pid: int | None = None
+_sweeper_lock = threading.Lock()
+
+
+def start_timeout_sweeper(interval: float = TIMEOUT_SWEEP_INTERVAL) -> None:
+    """Periodically sweep timed out runs from a background thread of this process.
+
+    This is cheap to call repeatedly, the thread is only started once per process.
+    Every worker process runs the thread, but only the holder of the "timeout-sweeper" lease sweeps,
+    another process takes over if the holder stops renewing it.
+    """
+    global _sweeper_pid  # noqa: PLW0603
+    if interval <= 0 or _sweeper_pid == os.getpid():
+        return
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+        holder = f'{socket.gethostname()}:{os.getpid()}'
+
+        def sweep() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    if not acquire_lease('timeout-sweeper', holder, 2 * interval):
+                        continue
+                    if timed_out := sweep_timed_out_runs():
+                        logger.info('%d runs timed out', timed_out)
+                except PyMongoError:
+                    logger.exception('Unable to sweep timed out runs')
+
+        threading.Thread(target=sweep, name='run-timeout-sweeper', daemon=True).start()
+
+
+def add_events(events: list[dict[str, Any]]) -> Any:
+    """Store events of runs, all events must have a 'portal_runid' and a 'seqnum'.
+
+    Events are stored as one document per event in the 'events' collection, indexed by (portal_runid, seqnum),
+    so the size of a run document does not grow with the number of events.
+    """
+    return db.events.insert_many(events, ordered=False)
+
+
+def get_existing_event_keys(seqnums: dict[str, list[Any]]) -> set[tuple[str, Any]]:
+    """Check which events are already stored, with a single query.
+
+    Params:
+      seqnums: mapping of portal_runids to the seqnums to check
+
+    Returns:
+      the (portal_runid, seqnum) pairs which are stored
+    """
+    if not seqnums:
+        return set()
+    result = db.events.find(
+        {'$or': [{'portal_runid': portal_runid, 'seqnum': {'$in': s}} for portal_runid, s in seqnums.items()]},
+        projection={'_id': False, 'portal_runid': True, 'seqnum': True},
+    )
+    return {(e['portal_runid'], e['seqnum']) for e in result}
+
+
+def get_events(db_filter: dict[str, Any], after_seqnum: int | None = None) -> list[dict[str, Any]] | None:
+    """Get the events of the run matching the filter, ordered by seqnum.
+
+    Params:
+      after_seqnum: only get events with a larger seqnum, i.e. the events added since the last poll
 
-def get_events(db_filter: dict[str, Any]) -> list[dict[str, Any]] | None:
-    runs = db.runs.find_one(db_filter, projection={'_id': False, 'events': True})
-    if runs is None:
+    Returns None if no run matches the filter.
+    Raises ArchiveUnavailableError if the run is archived and its events could not be loaded.
+    """
+    run = db.runs.find_one(
+        db_filter, projection={'_id': False, 'portal_runid': True, 'events': True, 'archive.events': True}
+    )
+    if run is None:
         return None
-    return runs['events']  # type: ignore[no-any-return]
+    if 'archive' in run:
+        archived = load_documents(run['archive']['events'])
+        if after_seqnum is None:
+            return archived
+        return [e for e in archived if e.get('seqnum', -1) > after_seqnum]
+    # runs which have not been migrated yet still embed their older events
+    events: list[dict[str, Any]] = run.get('events', [])
+    events_filter: dict[str, Any] = {'portal_runid': run['portal_runid']}
+    if after_seqnum is not None:
+        events = [e for e in events if e.get('seqnum', -1) > after_seqnum]
+        # a range scan of the (portal_runid, seqnum) index
+        events_filter['seqnum'] = {'$gt': after_seqnum}
+    events += db.events.find(events_filter, projection={'_id': False}, sort=[('seqnum', ASCENDING)])
+    return events
+
+
+def get_events_total(db_filter: dict[str, Any]) -> int:
+    return db.events.count_documents(db_filter, maxTimeMS=30_000)
+
+
+def get_events_page(
+    db_filter: dict[str, Any],
+    skip: int | None = None,
+    limit: int | None = None,
+    sort: dict[str, int] | None = None,
+) -> list[dict[str, Any]]:
+    """Get events for the events table.
+
+    Unlike `get_events`, this does not include events of unmigrated runs, or of archived runs
+    which were not restored with `restore_archived_events`.
+    """
+    cursor = db.events.find(db_filter, projection={'_id': False}, max_time_ms=30_000)
+    cursor = cursor.sort(list((sort or {'seqnum': ASCENDING}).items()))
+    if skip:
+        cursor = cursor.skip(skip)
+    if limit:
+        cursor = cursor.limit(limit)
+    return list(cursor)
+
+
+def tier_runs(days: float = ARCHIVE_AFTER_DAYS) -> int:
+    """Move the events and traces of runs which ended more than `days` ago to the archive, see archive.py.
+
+    This is safe to run while the portal is ingesting events, and to run again if it was interrupted:
+    run documents are only updated once their events and traces are stored, and events are deleted afterwards.
+    Runs whose events still have to be migrated with `migrate_embedded_events` are skipped.
+
+    Returns:
+      number of runs archived
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    ended = {'state': {'$nin': ACCEPTING_STATES}, 'lastModified': {'$lt': cutoff}}
+    archived = 0
+    for run in db.runs.find(
+        {**ended, 'archive': {'$exists': False}, 'events': {'$exists': False}},
+        projection={'_id': True, 'portal_runid': True, 'traces': True},
+    ):
+        portal_runid = run['portal_runid']
+        events = list(db.events.find({'portal_runid': portal_runid}, projection={'_id': False}, sort=[('seqnum', 1)]))
+        traces = run.get('traces') or []
+        archive = {
+            'events': store_documents(portal_runid, 'events', events),
+            'traces': store_documents(portal_runid, 'traces', traces),
+            'event_count': len(events),
+            'span_count': len(traces),
+            'archived_at': datetime.now(timezone.utc),
+        }
+        result = db.runs.update_one(
+            {'_id': run['_id'], 'state': {'$nin': ACCEPTING_STATES}},
+            {'$set': {'archive': archive}, '$unset': {'traces': True}},
+        )
+        if result.modified_count:
+            db.events.delete_many({'portal_runid': portal_runid})
+            archived += 1
+
+    # events restored for the events table are dropped again once the run was not modified for a while
+    for run in db.runs.find(
+        {**ended, 'archive.restored_at': {'$lt': cutoff}}, projection={'_id': True, 'portal_runid': True}
+    ):
+        db.events.delete_many({'portal_runid': run['portal_runid']})
+        db.runs.update_one({'_id': run['_id']}, {'$unset': {'archive.restored_at': True}})
+    return archived
+
+
+def restore_archived_events(portal_runid: str) -> None:
+    """Copy the events of an archived run back into the events collection, for the indexed queries of the events table.
+
+    Does nothing if the run is not archived, or its events were already restored.
+    Raises ArchiveUnavailableError if the archived events could not be loaded.
+    """
+    run = db.runs.find_one(
+        {'portal_runid': portal_runid, 'archive': {'$exists': True}, 'archive.restored_at': {'$exists': False}},
+        projection={'_id': True, 'archive.events': True},
+    )
+    if run is None:
+        return
+    events = load_documents(run['archive']['events'])
+    if events:
+        try:
+            db.events.insert_many(events, ordered=False)
+        except BulkWriteError as exc:
+            # another request restored the same events
+            if any(error['code'] != 11000 for error in exc.details['writeErrors']):
+                raise
+    db.runs.update_one({'_id': run['_id']}, {'$set': {'archive.restored_at': datetime.now(timezone.utc)}})
+
+
+def migrate_embedded_events() -> int:
+    """Move events embedded in run documents into the events collection.
+
+    This is safe to run while the portal is ingesting events, and to run again if it was interrupted.
+
+    Returns:
+      number of runs migrated
+    """
+    migrated = 0
+    for run in db.runs.find(
+        {'events': {'$exists': True}}, projection={'_id': True, 'portal_runid': True, 'events': True}
+    ):
+        events = run['events']
+        if events:
+            # remove anything left over from an interrupted migration of this run
+            db.events.delete_many(
+                {'portal_runid': run['portal_runid'], 'seqnum': {'$in': [e.get('seqnum') for e in events]}}
+            )
+            try:
+                db.events.insert_many(
+                    [{**e, 'portal_runid': run['portal_runid']} for e in events],
+                    ordered=False,
+                )
+            except BulkWriteError as exc:
+                # events which were resent by the framework are only kept once
+                if any(error['code'] != 11000 for error in exc.details['writeErrors']):
+                    raise
+        update: dict[str, Any] = {
+            '$unset': {'events': True},
+            '$set': {'event_count': db.events.count_documents({'portal_runid': run['portal_runid']})},
+        }
+        if events:
+            update['$max'] = {'last_seqnum': max(e.get('seqnum', -1) for e in events)}
+            if 'time' in events[-1]:
+                update['$max']['last_event_time'] = events[-1]['time']
+        db.runs.update_one({'_id': run['_id']}, update)
+        migrated += 1
+    return migrated
+
+
+RUN_LIVE_FIELDS = (
+    'runid',
+    'portal_runid',
+    'state',
+    'stopat',
+    'walltime',
+    'vizurl',
+    'has_trace',
+    'event_count',
+    'last_event_time',
+    'last_seqnum',
+    'lastModified',
+)
+"""Fields of a run which change while it is running."""
+
+
+def get_run_live_fields(db_filter: dict[str, Any]) -> dict[str, Any] | None:
+    """Get only the fields of a run which change while it is running, for polling clients."""
+    return db.runs.find_one(db_filter, projection={'_id': False, **dict.fromkeys(RUN_LIVE_FIELDS, True)})
 
 
 def get_run(db_filter: dict[str, Any]) -> dict[str, Any] | None:
@@ -158,20 +675,83 @@ def get_run(db_filter: dict[str, Any]) -> dict[str, Any] | None:
     return None
 
 
-def get_trace(db_filter: dict[str, Any]) -> list[dict[str, Any]]:
-    runs = db.runs.find(filter=db_filter, projection={'_id': False, 'portal_runid': True, 'traces': True})
-    traces = []
-    for run in runs:
-        traces += run['traces']
-        portal_runid = run['portal_runid']
-        traceId = run['traces'][-1]['traceId']
+def get_trace(
+    db_filter: dict[str, Any], max_depth: int | None = None, max_spans: int | None = None
+) -> list[dict[str, Any]]:
+    return list(iter_trace(db_filter, max_depth, max_spans))
 
-        # add all child traces
-        for trace in get_trace({'parent_portal_runid': portal_runid}):
-            trace['traceId'] = traceId
-            traces.append(trace)
 
-    return traces
+def iter_trace(
+    db_filter: dict[str, Any], max_depth: int | None = None, max_spans: int | None = None
+) -> Iterator[dict[str, Any]]:
+    """Stream the spans of the matching runs, followed by the spans of all their descendants.
+
+    The spans of descendants are moved into the trace of the matching run.
+
+    Params:
+      max_depth: number of generations of descendants to include, None includes all of them
+      max_spans: stop after this many spans, None returns all of them
+
+    Raises ArchiveUnavailableError if the spans of an archived run could not be loaded.
+    """
+    remaining = max_spans
+    runs = db.runs.find(
+        filter=db_filter, projection={'_id': False, 'portal_runid': True, 'traces': True, 'archive.traces': True}
+    )
+    for run in runs:
+        all_traces = load_documents(run['archive']['traces']) if 'archive' in run else run.get('traces') or []
+        traces = all_traces
+        if remaining is not None:
+            traces = traces[:remaining]
+            remaining -= len(traces)
+        yield from traces
+        if max_depth == 0 or remaining == 0:
+            continue
+
+        trace_id = all_traces[-1]['traceId'] if all_traces else hashlib.md5(run['portal_runid'].encode()).hexdigest()
+        graph_lookup: dict[str, Any] = {
+            'from': 'runs',
+            'startWith': '$portal_runid',
+            'connectFromField': 'portal_runid',
+            # uses the (parent_portal_runid, <column>, _id) indexes
+            'connectToField': 'parent_portal_runid',
+            'as': 'descendant',
+            # only follow runs which belong to this hierarchy, runs created by older versions have no ancestor chain
+            'restrictSearchWithMatch': {
+                '$or': [
+                    {'ancestor_portal_runids': run['portal_runid']},
+                    {'ancestor_portal_runids': {'$exists': False}},
+                ]
+            },
+        }
+        if max_depth is not None:
+            graph_lookup['maxDepth'] = max_depth - 1
+        pipeline: list[dict[str, Any]] = [
+            {'$match': {'portal_runid': run['portal_runid']}},
+            {'$project': {'_id': False, 'portal_runid': True}},
+            {'$graphLookup': graph_lookup},
+            # MongoDB unwinds the descendants while looking them up, instead of collecting them in one document
+            {'$unwind': '$descendant'},
+            # only keep the spans, archived descendants only have the object name of their traces
+            {'$project': {'span': '$descendant.traces', 'archive': '$descendant.archive.traces'}},
+            {'$unwind': {'path': '$span', 'preserveNullAndEmptyArrays': True}},
+            {'$match': {'$or': [{'span': {'$exists': True}}, {'archive': {'$exists': True}}]}},
+            {'$set': {'span.traceId': {'$cond': [{'$ifNull': ['$span', False]}, trace_id, '$$REMOVE']}}},
+        ]
+        if remaining is not None:
+            # archived descendants are a single document with all their spans, so the limit is also applied below
+            pipeline.append({'$limit': remaining})
+        for document in db.runs.aggregate(pipeline, maxTimeMS=30_000):
+            if 'span' in document:
+                spans = [document['span']]
+            else:
+                spans = [{**span, 'traceId': trace_id} for span in load_documents(document['archive'])]
+            for span in spans:
+                yield span
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
 
 
 def add_run(run: dict[str, Any]) -> Any:
@@ -182,6 +762,36 @@ def update_run(db_filter: dict[str, Any], update: dict[str, Any]) -> Any:
     return db.runs.update_one(db_filter, update)
 
 
+def bulk_update_runs(updates: list[UpdateOne]) -> BulkWriteResult:
+    return db.runs.bulk_write(updates, ordered=True)
+
+
+ACCEPTING_STATES = ('Running', 'Timeout')
+"""States of runs which accept new events. Timed out runs are resumed by their next event."""
+
+
+def get_ingest_runs(portal_runids: Iterable[str]) -> dict[str, dict[str, Any]]:
+    """Look up the fields of runs needed to ingest their events, keyed by portal_runid."""
+    result = db.runs.find(
+        {'portal_runid': {'$in': list(portal_runids)}},
+        projection={
+            '_id': False,
+            'portal_runid': True,
+            'runid': True,
+            'state': True,
+            'parent_portal_runid': True,
+            'ancestor_portal_runids': True,
+            'portal_ensemble_id': True,
+            # an IPS_START is retried if the run only holds this event
+            'event_count': True,
+            'last_seqnum': True,
+            # the events of archived runs are no longer in the events collection
+            'archive.archived_at': True,
+        },
+    )
+    return {run['portal_runid']: run for run in result}
+
+
 def get_runid(portal_runid: str) -> int | None:
     result = db.runs.find_one(filter={'portal_runid': portal_runid}, projection={'runid': True, '_id': False})
     if result:
@@ -205,6 +815,29 @@ def get_parent_portal_runid(portal_runid: str) -> str | None:
     return None
 
 
+def get_ancestor_portal_runids(parent_portal_runid: str) -> list[str]:
+    """Get the chain of ancestors of a run with the given parent, nearest first.
+
+    Runs store this chain in 'ancestor_portal_runids' when they are created, so this is usually a single lookup
+    of the parent. Ancestors created before the chain was stored are walked one parent at a time.
+    """
+    chain: list[str] = []
+    portal_runid: str | None = parent_portal_runid
+    while portal_runid and portal_runid not in chain:
+        chain.append(portal_runid)
+        result = db.runs.find_one(
+            filter={'portal_runid': portal_runid},
+            projection={'parent_portal_runid': True, 'ancestor_portal_runids': True, '_id': False},
+        )
+        if not result:
+            break
+        if 'ancestor_portal_runids' in result:
+            chain += result['ancestor_portal_runids']
+            break
+        portal_runid = result.get('parent_portal_runid')
+    return chain
+
+
 def get_runid_from_parent_portal_runid(parent_portal_runid: str) -> int | None:
     result = db.runs.find_one(
         filter={'parent_portal_runid': parent_portal_runid}, projection={'portal_runid': True, '_id': False}
@@ -244,7 +877,11 @@ def get_ensembles(runid: int, ensemble_id: str | None = None) -> list[EnsembleIn
                 'ensemble_id': ensemble_id,
             }
         }
-    result = db.data.find_one(db_filter, projection={'_id': False, 'ensembles': True})
+    projection: dict[str, Any] = {'_id': False, 'ensembles': True}
+    if ensemble_id:
+        # only return the matching ensemble
+        projection['ensembles'] = {'$elemMatch': {'ensemble_id': ensemble_id}}
+    result = db.data.find_one(db_filter, projection=projection)
     if result:
         return result.get('ensembles')
     return None
@@ -284,7 +921,120 @@ def save_ensemble_file_path(runid: int, ensemble_id: str, component_name: str, e
                     'ensemble_name': ensemble_name,
                     'path': path,
                 }
-            }
+            },
+            '$currentDate': {'lastModified': True},
         },
         upsert=True,
     )
+
+
+def upsert_ensemble_member(ensemble_id: str, sim_name: str, member: dict[str, Any]) -> None:
+    """Store the run of an ensemble member. Sim names are unique per ensemble."""
+    db.ensemble_members.update_one(
+        {'ensemble_id': ensemble_id, 'sim_name': sim_name},
+        {'$set': member, '$currentDate': {'lastModified': True}},
+        upsert=True,
+    )
+
+
+def get_ensemble_members_last_modified(ensemble_id: str) -> datetime | None:
+    """Get when the latest member of an ensemble was registered, or None if it has no members yet."""
+    member = db.ensemble_members.find_one(
+        {'ensemble_id': ensemble_id},
+        projection={'_id': False, 'lastModified': True},
+        sort=[('lastModified', DESCENDING)],
+    )
+    if member is None or not isinstance(member.get('lastModified'), datetime):
+        return None
+    last_modified: datetime = member['lastModified']
+    # pymongo returns naive datetimes in UTC
+    return last_modified if last_modified.tzinfo else last_modified.replace(tzinfo=timezone.utc)
+
+
+def get_ensemble_members(ensemble_id: str) -> dict[str, dict[str, Any]]:
+    """Get the runs of the members of an ensemble, by sim name."""
+    return {
+        member['sim_name']: member
+        for member in db.ensemble_members.find({'ensemble_id': ensemble_id}, projection={'_id': False})
+    }
+
+
+ENSEMBLE_PROGRESS_COUNTERS = ('started', 'running', 'completed', 'failed', 'timeout')
+"""Counters of the ensemble_progress documents, besides the walltime statistics of ended members."""
+
+
+def _ensemble_progress_counter(state: str | None, ok: Any = True) -> str | None:
+    if state is None:
+        return None
+    if state in ACCEPTING_STATES:
+        return state.lower()
+    return 'completed' if state == 'Completed' and ok is not False else 'failed'
+
+
+def ensemble_progress_update(
+    ensemble_id: str, old_state: str | None, new_state: str, ok: Any = True, walltime: Any = None
+) -> UpdateOne | None:
+    """Build the update of the progress of an ensemble, for a member which changed its state.
+
+    Params:
+      old_state: state of the member before, None if the member just started
+      new_state: state of the member now
+      ok: "ok" of the IPS_END event, members which ended without being ok failed
+      walltime: walltime of the member, if it ended
+
+    Returns None if the counters do not change.
+    """
+    old_counter = _ensemble_progress_counter(old_state)
+    new_counter = _ensemble_progress_counter(new_state, ok)
+    if new_counter is None or old_counter == new_counter:
+        return None
+    inc: dict[str, float] = {new_counter: 1}
+    if old_counter is None:
+        inc['started'] = 1
+    else:
+        inc[old_counter] = -1
+    update: dict[str, Any] = {'$inc': inc}
+    if new_state not in ACCEPTING_STATES:
+        try:
+            seconds = float(walltime)
+        except (TypeError, ValueError):
+            pass
+        else:
+            inc.update({'walltime_count': 1, 'walltime_sum': seconds})
+            update['$min'] = {'walltime_min': seconds}
+            update['$max'] = {'walltime_max': seconds}
+    return UpdateOne({'_id': ensemble_id}, update, upsert=True)
+
+
+def update_ensemble_progress(updates: list[UpdateOne]) -> None:
+    if updates:
+        db.ensemble_progress.bulk_write(updates, ordered=False)
+
+
+def set_ensemble_size(ensemble_id: str, members: int) -> None:
+    """Store the number of members of an ensemble, members which did not start yet are pending."""
+    db.ensemble_progress.update_one({'_id': ensemble_id}, {'$set': {'members': members}}, upsert=True)
+
+
+def get_ensemble_progress(ensemble_ids: list[str]) -> dict[str, dict[str, Any]]:
+    """Get the progress of ensembles, by ensemble_id. This costs one query, regardless of the size of the ensembles.
+
+    Returns:
+      the number of members in each state ("pending" members did not start yet),
+      and the minimum, maximum and mean walltime of the members which ended
+    """
+    progress: dict[str, dict[str, Any]] = {}
+    for document in db.ensemble_progress.find({'_id': {'$in': ensemble_ids}}):
+        counters = {counter: document.get(counter, 0) for counter in ENSEMBLE_PROGRESS_COUNTERS}
+        walltime_count = document.get('walltime_count', 0)
+        progress[document['_id']] = {
+            'members': document.get('members'),
+            'pending': max(document.get('members', 0) - counters.pop('started'), 0),
+            **counters,
+            'walltime': {
+                'min': document.get('walltime_min'),
+                'max': document.get('walltime_max'),
+                'mean': document['walltime_sum'] / walltime_count if walltime_count else None,
+            },
+        }
+    return progress
@@ -1,12 +1,22 @@
+import atexit
 import csv
+import io
+import itertools
 import logging
 import os
-from io import StringIO
-from typing import Any
+import shutil
+import tempfile
+import threading
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import IO, Any
 
 import portalocker
 
 from . import environment
+from .db import get_ensemble_members, get_ensemble_members_last_modified, upsert_ensemble_member
+from .util import TTLCache
 
 logger = logging.getLogger(__name__)
 
@@ -20,43 +30,194 @@ After these portal generated keys should be the 'sim_name' key, which is generat
 Finally, after the 'sim_name' key, the component parameter keys should exist.
 """
 
-
-def save_initial_csv(initial_csv: bytes, path: str | os.PathLike[Any]) -> None:
-    data = list(csv.reader(StringIO(initial_csv.decode())))
-
-    # generate columns for later
-    data[0] = [*PORTAL_GENERATED_KEYS, *data[0]]
-    for i in range(1, len(data)):
-        data[i] = [*(['?'] * len(PORTAL_GENERATED_KEYS)), *data[i]]
-
-    with open(path, 'w', newline='') as fd:
-        writer = csv.writer(fd)
-        writer.writerows(data)
-
-
-def update_ensemble_information(
-    runid: int, base_url: str, sim_name: str, username: str, csv_path: str | os.PathLike[Any]
+_pending_csvs: dict[str, threading.Timer] = {}
+_pending_lock = threading.Lock()
+
+_csv_cache: TTLCache[tuple[list[str], list[list[str]]]] = TTLCache(
+    float('inf'), max_entries=environment.ENSEMBLE_CSV_CACHE_SIZE
+)
+
+
+def save_initial_csv(initial_csv: IO[bytes], path: str | os.PathLike[Any]) -> int:
+    """Save the CSV of a new ensemble, with empty portal generated columns.
+
+    The CSV is streamed row by row from `initial_csv` (e.g. the request stream) to the file,
+    so memory use does not depend on the size of the ensemble.
+
+    Returns:
+      the number of members of the ensemble
+
+    Raises ValueError if the CSV is empty or not UTF-8, OSError if it cannot be read or written.
+    """
+    reader = csv.reader(io.TextIOWrapper(initial_csv, encoding='utf-8', newline=''))
+    header = next(reader, None)
+    if header is None:
+        msg = 'Ensemble CSV is empty'
+        raise ValueError(msg)
+
+    members = 0
+    try:
+        with open(path, 'w', newline='') as fd:
+            writer = csv.writer(fd)
+            # generate columns for later
+            writer.writerow([*PORTAL_GENERATED_KEYS, *header])
+            placeholders = ['?'] * len(PORTAL_GENERATED_KEYS)
+            for row in reader:
+                writer.writerow([*placeholders, *row])
+                members += 1
+    except BaseException:
+        # do not leave a truncated CSV behind if the upload was interrupted
+        Path(path).unlink(missing_ok=True)
+        raise
+    return members
+
+
+def read_ensemble_csv(csv_path: str | os.PathLike[Any]) -> tuple[list[str], list[list[str]]]:
+    """Get the header and the rows of an ensemble CSV. Rows are padded to the length of the header.
+
+    Parsed files are cached until they are modified. The rows must not be modified.
+
+    Raises OSError if the file cannot be read.
+    """
+    stat = os.stat(csv_path)
+    # CSVs are replaced when they are written, so the modification time and size identify a version of the file
+    key = f'{csv_path}:{stat.st_mtime_ns}:{stat.st_size}'
+    parsed = _csv_cache.get(key)
+    if parsed is None:
+        with open(csv_path, newline='') as fd:
+            reader = csv.reader(fd)
+            header = next(reader, [])
+            rows = [row + [''] * (len(header) - len(row)) for row in reader]
+        parsed = header, rows
+        _csv_cache.set(key, parsed)
+    return parsed
+
+
+def add_ensemble_member(
+    ensemble_id: str,
+    csv_path: str | os.PathLike[Any],
+    runid: int,
+    base_url: str,
+    sim_name: str,
+    username: str,
 ) -> None:
-    # we will want to make sure that each call to this function has an exclusive read/write to the file descriptor at one time.
-    # do not read from one FD and write to a separate FD, as this can cause update issues.
-    with portalocker.Lock(csv_path, 'r+', timeout=30) as fd:  # type: ignore[arg-type]
-        # we will need to read the entire file into memory while still holding the file descriptor
-        reader = csv.reader(fd.readlines())
-        fd.seek(0)
-        fd.truncate()
-        writer = csv.writer(fd)
-
-        # handle header row separately
-        header_row = next(reader)
-        writer.writerow(header_row)
-
-        for row in reader:
-            # sim names are unique per ensemble, find the name and insert
-            if row[3] == sim_name:
-                row[0] = str(runid)
-                row[1] = f'{base_url}/{runid}'
-                row[2] = str(environment.JUPYTERHUB_DIR / username / str(runid))
-            writer.writerow(row)
-
-        fd.flush()
-        os.fsync(fd.fileno())
+    """Register the run of an ensemble member, and schedule the update of the parent's ensemble CSV.
+
+    Members are stored in the ensemble_members collection, so registering one does not touch the CSV.
+    """
+    upsert_ensemble_member(
+        ensemble_id,
+        sim_name,
+        {
+            'runid': runid,
+            'run_url': f'{base_url}/{runid}',
+            'instance_analysis_path': str(environment.JUPYTERHUB_DIR / username / str(runid)),
+        },
+    )
+    schedule_ensemble_csv(ensemble_id, csv_path)
+
+
+def schedule_ensemble_csv(ensemble_id: str, csv_path: str | os.PathLike[Any], delay: float | None = None) -> None:
+    """Write the ensemble CSV after `delay` seconds, including all members registered until then.
+
+    Scheduling a CSV which is already scheduled does nothing, as the scheduled write will include the new member.
+    """
+    delay = environment.ENSEMBLE_CSV_DELAY if delay is None else delay
+    if delay <= 0:
+        write_ensemble_csv(ensemble_id, csv_path)
+        return
+    key = str(csv_path)
+    with _pending_lock:
+        if key in _pending_csvs:
+            return
+        timer = threading.Timer(delay, _write_scheduled_csv, args=(ensemble_id, csv_path))
+        timer.daemon = True
+        _pending_csvs[key] = timer
+        timer.start()
+
+
+def _write_scheduled_csv(ensemble_id: str, csv_path: str | os.PathLike[Any]) -> None:
+    # members registered from now on schedule another write
+    with _pending_lock:
+        _pending_csvs.pop(str(csv_path), None)
+    try:
+        write_ensemble_csv(ensemble_id, csv_path)
+    except Exception:
+        logger.exception('Unable to write ensemble CSV %s', csv_path)
+
+
+def flush_ensemble_csvs() -> None:
+    """Write all scheduled ensemble CSVs now, e.g. before the process exits."""
+    with _pending_lock:
+        pending = list(_pending_csvs.values())
+    for timer in pending:
+        timer.cancel()
+        _write_scheduled_csv(*timer.args)
+
+
+atexit.register(flush_ensemble_csvs)
+
+
+def refresh_stale_ensemble_csv(ensemble_id: str, csv_path: str | os.PathLike[Any]) -> bool:
+    """Write the ensemble CSV now if a scheduled write of it was lost.
+
+    Scheduled writes only exist in the process which registered the member, so they are lost if that process
+    is killed first. The CSV is stale if it was last written before a member which was registered more than
+    ENSEMBLE_CSV_DELAY seconds ago. Errors are logged, the CSV is then read as it is.
+
+    Returns:
+      True if the CSV was written
+    """
+    try:
+        last_modified = get_ensemble_members_last_modified(ensemble_id)
+        if last_modified is None:
+            return False
+        if last_modified > datetime.now(timezone.utc) - timedelta(seconds=environment.ENSEMBLE_CSV_DELAY):
+            # the scheduled write of the member is probably still pending
+            return False
+        if datetime.fromtimestamp(os.stat(csv_path).st_mtime, timezone.utc) >= last_modified:
+            return False
+        logger.warning('Rewriting stale ensemble CSV %s', csv_path)
+        write_ensemble_csv(ensemble_id, csv_path)
+    except Exception:
+        logger.exception('Unable to refresh ensemble CSV %s', csv_path)
+        return False
+    return True
+
+
+def write_ensemble_csv(ensemble_id: str, csv_path: str | os.PathLike[Any]) -> None:
+    """Fill in the portal generated columns of an ensemble CSV from the registered members.
+
+    The CSV is replaced atomically, so notebooks never read a partially written file.
+    Writers of the same CSV in different processes are serialized with a lock file next to it.
+    """
+    path = Path(csv_path)
+    with portalocker.Lock(path.with_name(f'.{path.name}.lock'), 'a', timeout=30):
+        # read the members while holding the lock, so the last write includes every member
+        members = get_ensemble_members(ensemble_id)
+        with (
+            open(path, newline='') as fd,
+            tempfile.NamedTemporaryFile('w', newline='', dir=path.parent, prefix=f'.{path.name}.', delete=False) as tmp,
+        ):
+            try:
+                csv.writer(tmp).writerows(_fill_members(csv.reader(fd), members))
+                tmp.flush()
+                os.fsync(tmp.fileno())
+                shutil.copymode(path, tmp.name)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        os.replace(tmp.name, path)
+
+
+def _fill_members(rows: Iterable[list[str]], members: dict[str, dict[str, Any]]) -> Iterator[list[str]]:
+    """Fill in the portal generated columns of the rows of registered members, one row at a time."""
+    sim_name_idx = len(PORTAL_GENERATED_KEYS)
+    rows = iter(rows)
+    # the header is not a member
+    yield from itertools.islice(rows, 1)
+    for row in rows:
+        member = members.get(row[sim_name_idx]) if len(row) > sim_name_idx else None
+        if member is not None:
+            row[:sim_name_idx] = [str(member['runid']), member['run_url'], member['instance_analysis_path']]
+        yield row
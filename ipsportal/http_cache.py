@@ -0,0 +1,164 @@
+"""HTTP caching of the pages and API responses of runs which ended.
+
+Once a run stopped accepting events, its responses only change when its `lastModified` changes.
+Responses get an ETag and Last-Modified derived from it, so browsers revalidate with a single indexed lookup
+and get a 304, and serialized responses are kept in a small per-process cache so repeat views skip the work.
+Streamed responses (e.g. traces) only get the validators, buffering them would defeat the streaming.
+Runs which still accept events are remembered for a few seconds, so polling them costs no extra lookup.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+from typing import TYPE_CHECKING, Any
+
+from flask import Response, make_response, request
+from werkzeug.http import is_resource_modified
+
+from .db import ACCEPTING_STATES, db
+from .environment import (
+    RESPONSE_CACHE_LIVE_TTL,
+    RESPONSE_CACHE_MAX_AGE,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_TTL,
+)
+from .util import TTLCache
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from flask.typing import ResponseReturnValue
+
+try:
+    _APP_VERSION = version('ipsportal')
+except PackageNotFoundError:
+    _APP_VERSION = '0'
+
+_response_cache: TTLCache[tuple[bytes, int, str]] = TTLCache(RESPONSE_CACHE_TTL, max_entries=256)
+# runid and portal_runid filters of runs which accepted events when they were last looked up
+_live_runs: TTLCache[bool] = TTLCache(RESPONSE_CACHE_LIVE_TTL, max_entries=4096)
+
+
+def _filter_key(db_filter: dict[str, Any]) -> str:
+    return ':'.join(f'{key}={value}' for key, value in db_filter.items())
+
+
+def _utc(value: datetime) -> datetime:
+    # pymongo returns naive datetimes in UTC
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def forget_live_run(runid: int, portal_runid: str) -> None:
+    """Look up the validators of a run which stopped accepting events right away, instead of remembering it as live.
+
+    Other processes still skip the lookup for up to RESPONSE_CACHE_LIVE_TTL seconds.
+    """
+    _live_runs.set(_filter_key({'runid': runid}), False)
+    _live_runs.set(_filter_key({'portal_runid': portal_runid}), False)
+
+
+def _descendants_last_modified(portal_runid: str) -> datetime | None:
+    """Get the latest lastModified of the descendants of a run, or None if any of them may still change.
+
+    This costs one query per generation, which uses the parent_portal_runid indexes.
+    """
+    latest = datetime.min.replace(tzinfo=timezone.utc)
+    parents = [portal_runid]
+    while parents:
+        children = list(
+            db.runs.find(
+                {'parent_portal_runid': {'$in': parents}},
+                projection={'_id': False, 'portal_runid': True, 'state': True, 'lastModified': True},
+            )
+        )
+        for child in children:
+            if child.get('state') in ACCEPTING_STATES or not isinstance(child.get('lastModified'), datetime):
+                return None
+            latest = max(latest, _utc(child['lastModified']))
+        parents = [child['portal_runid'] for child in children]
+    return latest
+
+
+def _validator(db_filter: dict[str, Any], include_data: bool, include_descendants: bool) -> tuple[str, datetime] | None:
+    """Get the ETag and Last-Modified of a run which ended, or None if its responses must not be cached."""
+    if RESPONSE_CACHE_LIVE_TTL > 0 and _live_runs.get(_filter_key(db_filter)):
+        return None
+    run = db.runs.find_one(
+        db_filter, projection={'_id': False, 'runid': True, 'portal_runid': True, 'state': True, 'lastModified': True}
+    )
+    if run is not None and run.get('state') in ACCEPTING_STATES:
+        _live_runs.set(_filter_key({'runid': run['runid']}), True)
+        _live_runs.set(_filter_key({'portal_runid': run['portal_runid']}), True)
+        return None
+    if run is None or not isinstance(run.get('lastModified'), datetime):
+        return None
+    last_modified = _utc(run['lastModified'])
+    if include_descendants:
+        descendants_last_modified = _descendants_last_modified(run['portal_runid'])
+        if descendants_last_modified is None:
+            return None
+        last_modified = max(last_modified, descendants_last_modified)
+    if include_data:
+        data = db.data.find_one({'runid': run['runid']}, projection={'_id': False, 'lastModified': True})
+        if data is not None:
+            if not isinstance(data.get('lastModified'), datetime):
+                return None
+            last_modified = max(last_modified, _utc(data['lastModified']))
+    # include the version, as new versions of the portal may render the same run differently
+    etag = hashlib.md5(f'{run["runid"]}:{last_modified.isoformat()}:{_APP_VERSION}'.encode()).hexdigest()
+    return etag, last_modified
+
+
+def cached_run_response(
+    include_data: bool = False,
+    include_descendants: bool = False,
+) -> Callable[[Callable[..., ResponseReturnValue]], Callable[..., Response]]:
+    """Decorate views of a single run, which take a `runid` or `portal_runid` argument.
+
+    Params:
+      include_data: the response also depends on the data document of the run (e.g. the run page)
+      include_descendants: the response also depends on all descendants of the run (e.g. its trace),
+        it is not cached while any of them is running
+    """
+
+    def decorator(view: Callable[..., ResponseReturnValue]) -> Callable[..., Response]:
+        @functools.wraps(view)
+        def wrapper(**kwargs: Any) -> Response:
+            if 'runid' in kwargs:
+                db_filter: dict[str, Any] = {'runid': kwargs['runid']}
+            else:
+                db_filter = {'portal_runid': kwargs['portal_runid']}
+            validator = _validator(db_filter, include_data, include_descendants)
+            if validator is None:
+                return make_response(view(**kwargs))
+            etag, last_modified = validator
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                key = f'{request.full_path}:{etag}'
+                cached = _response_cache.get(key)
+                if cached is not None:
+                    body, status, mimetype = cached
+                    response = Response(body, status=status, mimetype=mimetype)
+                else:
+                    response = make_response(view(**kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if not response.is_streamed:
+                        body = response.get_data()
+                        if RESPONSE_CACHE_TTL > 0 and len(body) <= RESPONSE_CACHE_MAX_BYTES:
+                            _response_cache.set(key, (body, response.status_code, response.mimetype or 'text/html'))
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = RESPONSE_CACHE_MAX_AGE
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,511 @@
+"""Apply batches of IPS Framework events to the runs collection.
+
+Events are validated up front, then consecutive non-IPS_START events are grouped by portal_runid,
+so that a batch of any size costs a constant number of database round trips.
+"""
+
+import hashlib
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any
+
+import pymongo.errors
+from pymongo import UpdateOne
+
+from .db import (
+    ACCEPTING_STATES,
+    add_events,
+    add_run,
+    bulk_update_runs,
+    ensemble_progress_update,
+    get_ancestor_portal_runids,
+    get_ensembles,
+    get_existing_event_keys,
+    get_ingest_runs,
+    get_runid,
+    increment_run_counters,
+    next_runid,
+    update_ensemble_progress,
+)
+from .ensemble import add_ensemble_member
+from .http_cache import forget_live_run
+from .jupyter import setup_jupyter_from_ips_start
+from .live import live_broker
+from .search import run_search_tokens
+from .trace_jaeger import span_forwarder
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+REQUIRED_EVENT_KEYS = frozenset(
+    {'code', 'eventtype', 'comment', 'walltime', 'phystimestamp', 'portal_runid', 'seqnum'},
+)
+"""Every event posted by the framework must contain these keys."""
+
+RUN_KEYS = frozenset(
+    {
+        'user',
+        'host',
+        'state',
+        'rcomment',
+        'tokamak',
+        'shotno',
+        'simname',
+        'startat',
+        'stopat',
+        'sim_runid',
+        'outputprefix',
+        'tag',
+        'ips_version',
+        'portal_runid',
+        'ok',
+        'walltime',
+        'parent_portal_runid',
+        'portal_ensemble_id',
+        'vizurl',
+    },
+)
+"""Keys of IPS_START and IPS_END events which are copied onto the run document itself."""
+
+
+def validate_event(event: Any) -> str | None:
+    """Check that a single posted event can be ingested.
+
+    Returns:
+      None if the event is valid, otherwise the error message for the event
+    """
+    if not isinstance(event, dict):
+        return 'Event must be a JSON object'
+    if not event.keys() >= REQUIRED_EVENT_KEYS:
+        return f'Missing required data: {sorted(k for k in REQUIRED_EVENT_KEYS if k not in event)}'
+    return None
+
+
+def _is_archived_event(run: dict[str, Any], event: dict[str, Any]) -> bool:
+    """Check if an event was resent for a run which was archived, see db.tier_runs.
+
+    Archived runs ended, and their events were moved out of the events collection,
+    so every event up to the last seqnum of the run is considered ingested already.
+    """
+    return 'archive' in run and event['seqnum'] <= run.get('last_seqnum', -1)
+
+
+class EventIngester:
+    """Accumulates validated events and writes them to Mongo in bulk.
+
+    IPS_START events create their run immediately. All other events are buffered until `flush()`,
+    which looks up every referenced run in one query and applies one merged update per run
+    in a single ordered `bulk_write`.
+
+    Ingestion is idempotent on (portal_runid, seqnum): events which were already stored are reported
+    with the 'duplicate' status instead of being applied again, so clients can safely resend batches.
+
+    Every event added gets an entry in `results` (in the order it was added), so callers can report
+    a status for each event instead of failing the whole batch.
+    """
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url
+        self.results: list[dict[str, Any]] = []
+        self.errors: list[str] = []
+        self.successes = 0
+        self.duplicates = 0
+        self.runs_created = 0
+        self.runs_ended = 0
+        self.runid: int | None = None
+        self.simname: str | None = None
+        self._pending: list[tuple[int, dict[str, Any]]] = []
+
+    def add(self, event: dict[str, Any]) -> None:
+        """Add a validated event to the batch."""
+        idx = len(self.results)
+        self.results.append({'seqnum': event.get('seqnum'), 'status': 'pending'})
+
+        if 'time' not in event:
+            event['time'] = time.strftime('%Y-%m-%d|%H:%M:%S%Z', time.localtime())
+
+        if event.get('eventtype') == 'IPS_START':
+            # anything buffered for this run must fail exactly as if it was sent before the run existed
+            self.flush()
+            self._start_run(idx, event)
+        else:
+            self._pending.append((idx, event))
+
+    def summary(self) -> dict[str, Any]:
+        """Build the response body for the events added so far."""
+        message = (
+            'New run created and ' * self.runs_created + '{} events added to run' + ' and run ended' * self.runs_ended
+        )
+        output: dict[str, Any] = {'message': message.format(self.successes)}
+        if self.runid is not None:
+            output['runid'] = self.runid
+        if self.simname is not None:
+            output['simname'] = self.simname
+        if self.duplicates:
+            output['duplicates'] = self.duplicates
+        return output
+
+    def take_results(self) -> tuple[list[dict[str, Any]], list[str]]:
+        """Flush, then return and forget the results and errors of the events added so far.
+
+        Long-lived streams call this after every batch, so memory does not grow with the number of events.
+
+        Returns:
+          the results of the events, and the errors which are not the error of a failed event
+          (e.g. the parent ensemble of a new run could not be updated)
+        """
+        self.flush()
+        results, self.results = self.results, []
+        errors, self.errors = self.errors, []
+        other_errors = Counter(errors)
+        other_errors.subtract(result['error'] for result in results if result['status'] == 'error')
+        return results, list((+other_errors).elements())
+
+    def _succeed(self, idx: int) -> None:
+        self.results[idx]['status'] = 'ok'
+        self.successes += 1
+
+    def _duplicate(self, idx: int) -> None:
+        self.results[idx]['status'] = 'duplicate'
+        self.duplicates += 1
+
+    def _end_run(self, run: dict[str, Any]) -> None:
+        self.runs_ended += 1
+        # this process stops treating the run as live right away, so its responses can be cached
+        forget_live_run(run['runid'], run['portal_runid'])
+
+    def _fail(self, idx: int, error: str, report: bool = True) -> None:
+        self.results[idx]['status'] = 'error'
+        self.results[idx]['error'] = error
+        if report:
+            self.errors.append(error)
+
+    def _start_run(self, idx: int, e: dict[str, Any]) -> None:
+        runid = next_runid()
+        run_dict: dict[str, Any] = {key: e[key] for key in RUN_KEYS if key in e}
+        run_dict['runid'] = runid
+        # store the whole hierarchy once, so traces can be propagated to every ancestor without further lookups
+        run_dict['ancestor_portal_runids'] = (
+            get_ancestor_portal_runids(run_dict['parent_portal_runid']) if run_dict.get('parent_portal_runid') else []
+        )
+        run_dict['last_event_time'] = e['time']
+        run_dict['lastModified'] = datetime.now(timezone.utc)
+        run_dict['event_count'] = 1
+        run_dict['last_seqnum'] = e['seqnum']
+        run_dict['search_tokens'] = run_search_tokens(run_dict)
+        run_dict['traces'] = []
+        run_dict['has_trace'] = False
+        duplicate = False
+        try:
+            try:
+                add_run(run_dict)
+            except pymongo.errors.DuplicateKeyError:
+                existing = get_ingest_runs([e['portal_runid']]).get(e['portal_runid'])
+                if existing is not None and _is_archived_event(existing, e):
+                    # the run ended and was archived long ago, nothing is repeated for it
+                    self.runid = existing['runid']
+                    self._duplicate(idx)
+                    return
+                # The client resent this IPS_START if it is stored, or if the run only holds this event,
+                # in which case a previous attempt created the run but failed before storing the event.
+                if existing is None or (
+                    (existing.get('event_count'), existing.get('last_seqnum')) != (1, e['seqnum'])
+                    and (e['portal_runid'], e['seqnum'])
+                    not in get_existing_event_keys({e['portal_runid']: [e['seqnum']]})
+                ):
+                    logger.exception('Duplicate Key %s', run_dict)
+                    self._fail(idx, 'Duplicate portal_runid Key')
+                    return
+                # the remaining steps are idempotent, so they are repeated for the existing run
+                runid = run_dict['runid'] = existing['runid']
+            else:
+                increment_run_counters(top_level=run_dict.get('parent_portal_runid') is None)
+                if 'portal_ensemble_id' in run_dict:
+                    progress = ensemble_progress_update(
+                        run_dict['portal_ensemble_id'], None, run_dict.get('state', 'Running')
+                    )
+                    update_ensemble_progress([progress] if progress else [])
+            try:
+                add_events([e])
+            except pymongo.errors.BulkWriteError as exc:
+                if any(error['code'] != DUPLICATE_KEY_ERROR for error in exc.details['writeErrors']):
+                    raise
+                # the client resent an IPS_START which was already stored
+                duplicate = True
+            setup_jupyter_from_ips_start(run_dict['user'], runid)
+            # if this is an ensemble run, we need to update its parent
+            if (
+                'portal_ensemble_id' in run_dict
+                and 'parent_portal_runid' in run_dict
+                and 'simname' in run_dict
+                and 'user' in run_dict
+            ):
+                self._update_parent_ensemble(run_dict)
+        except FileNotFoundError:
+            logger.exception('no file for %s', run_dict.get('parent_portal_runid'))
+            self._fail(idx, 'could not update ensemble file')
+            return
+        except Exception:
+            logger.exception('unknown IPS_START exception')
+            self._fail(idx, 'unknown IPS_START exception', report=False)
+            return
+        self.runid = runid
+        if duplicate:
+            self._duplicate(idx)
+            return
+        self._succeed(idx)
+        self.runs_created += 1
+        if 'simname' in e:
+            self.simname = e['simname']
+
+    def _update_parent_ensemble(self, run_dict: dict[str, Any]) -> None:
+        runid = run_dict['runid']
+        logger.info(
+            'Preparing to update ensemble CSV with runid %s of parent_portal_runid %s',
+            runid,
+            run_dict['parent_portal_runid'],
+        )
+        error = ''
+        parent_integer_runid = get_runid(run_dict['parent_portal_runid'])
+        if parent_integer_runid is not None:
+            ensembles = get_ensembles(parent_integer_runid, run_dict['portal_ensemble_id'])
+            if ensembles is not None:
+                try:
+                    add_ensemble_member(
+                        run_dict['portal_ensemble_id'],
+                        ensembles[0]['path'],
+                        runid,
+                        self.base_url,
+                        run_dict['simname'],
+                        run_dict['user'],
+                    )
+                except Exception:
+                    logger.exception('add_ensemble_member exception...')
+                    error = 'exception from add_ensemble_member'
+            else:
+                error = (
+                    'failed when trying to get the actual runid from the parent_portal_runid and the portal_ensemble_id'
+                )
+        else:
+            error = 'unable to retrieve the real runid from the parent portal runid'
+        if error:
+            self.errors.append('Could not update parent ensemble information')
+            logger.error(
+                'Could not update parent ensemble information for parentid=%s simname=%s ensemble_id=%s because: %s',
+                run_dict['parent_portal_runid'],
+                run_dict['simname'],
+                run_dict['portal_ensemble_id'],
+                error,
+            )
+
+    def flush(self) -> None:
+        """Write all buffered events.
+
+        Regardless of the number of events, this costs one query to look up the runs,
+        one bulk insert of the events, and one bulk write to update the runs.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+
+        runs = get_ingest_runs({e['portal_runid'] for _, e in pending})
+
+        accepted: list[tuple[int, dict[str, Any]]] = []
+        rejected: list[tuple[int, dict[str, Any]]] = []
+        ended: set[str] = set()
+        for idx, e in pending:
+            portal_runid = e['portal_runid']
+            run = runs.get(portal_runid)
+            if run is None or run.get('state') not in ACCEPTING_STATES or portal_runid in ended:
+                rejected.append((idx, e))
+                continue
+            if e.get('eventtype') == 'IPS_END':
+                ended.add(portal_runid)
+            accepted.append((idx, e))
+
+        if rejected:
+            self._reject_events(rejected, runs)
+
+        if not accepted:
+            return
+
+        # traces are stored on the run, not with the event
+        traces = [e.pop('trace', None) for _, e in accepted]
+        failed_inserts, duplicate_inserts = self._insert_events([e for _, e in accepted])
+
+        # dicts keep insertion order, so the bulk operations are applied in the order each run was first seen
+        updates: dict[str, dict[str, Any]] = {}
+        applied: dict[str, list[tuple[int, dict[str, Any] | None, bool]]] = {}
+        applied_events: dict[str, list[dict[str, Any]]] = {}
+        resent_traces: set[str] = set()
+        for position, ((idx, e), trace) in enumerate(zip(accepted, traces, strict=True)):
+            if position in failed_inserts:
+                self._fail(idx, 'Unable to save event')
+                continue
+            # A resent event is already stored, but the update of its run may have failed the first time.
+            # The update is applied again, except for the event count, so the run ends up the same either way.
+            duplicate = position in duplicate_inserts
+
+            portal_runid = e['portal_runid']
+            update = updates.setdefault(
+                portal_runid,
+                {
+                    '$set': {'state': 'Running'},
+                    '$inc': {'event_count': 0},
+                    '$max': {'last_seqnum': e['seqnum']},
+                    '$currentDate': {'lastModified': True},
+                },
+            )
+            if not duplicate:
+                update['$inc']['event_count'] += 1
+            update['$max']['last_seqnum'] = max(update['$max']['last_seqnum'], e['seqnum'])
+            if e.get('eventtype') == 'IPS_END':
+                update['$set'].update({key: e[key] for key in RUN_KEYS if key in e})
+                if search_tokens := run_search_tokens(e):
+                    update.setdefault('$addToSet', {})['search_tokens'] = {'$each': search_tokens}
+            else:
+                update['$set']['walltime'] = e.get('walltime')
+                if 'vizurl' in e:
+                    update['$set']['vizurl'] = e.get('vizurl')
+            update['$set']['last_event_time'] = e['time']
+
+            if trace:
+                update.setdefault('$push', {'traces': {'$each': []}})['traces']['$each'].append(trace)
+                update['$set']['has_trace'] = True
+                if duplicate:
+                    resent_traces.add(portal_runid)
+
+            applied.setdefault(portal_runid, []).append((idx, trace, duplicate))
+            if not duplicate:
+                applied_events.setdefault(portal_runid, []).append(e)
+
+        if not updates:
+            return
+
+        for portal_runid in resent_traces:
+            # resent traces may already be stored, only add the missing ones
+            updates[portal_runid].setdefault('$addToSet', {})['traces'] = updates[portal_runid].pop('$push')['traces']
+
+        for portal_runid, update in updates.items():
+            if runs[portal_runid]['state'] == 'Timeout' and 'stopat' not in update['$set']:
+                # the run resumed, it has not stopped after all
+                update['$unset'] = {'stopat': True}
+
+        portal_runids = list(updates)
+        failed_op: int | None = None
+        try:
+            result = bulk_update_runs(
+                [UpdateOne({'portal_runid': p, 'state': {'$in': ACCEPTING_STATES}}, updates[p]) for p in portal_runids]
+            )
+            if result.matched_count < len(portal_runids):
+                logger.warning('%d runs ended while ingesting a batch', len(portal_runids) - result.matched_count)
+        except pymongo.errors.BulkWriteError as exc:
+            # ordered bulk writes stop at the first failing operation
+            failed_op = exc.details['writeErrors'][0]['index']
+            logger.exception('Bulk write of events failed at run %s', portal_runids[failed_op])
+        except pymongo.errors.PyMongoError:
+            failed_op = 0
+            logger.exception('Bulk write of events failed')
+
+        spans: list[dict[str, Any]] = []
+        progress: list[UpdateOne] = []
+        for op_idx, portal_runid in enumerate(portal_runids):
+            if failed_op is not None and op_idx >= failed_op:
+                for idx, _trace, _duplicate in applied[portal_runid]:
+                    self._fail(idx, 'Unable to update run')
+                continue
+            if ensemble_id := runs[portal_runid].get('portal_ensemble_id'):
+                run_update = updates[portal_runid]['$set']
+                if ensemble_update := ensemble_progress_update(
+                    ensemble_id,
+                    runs[portal_runid]['state'],
+                    run_update['state'],
+                    run_update.get('ok'),
+                    run_update.get('walltime'),
+                ):
+                    progress.append(ensemble_update)
+            ancestors = None
+            for idx, trace, duplicate in applied[portal_runid]:
+                if duplicate:
+                    # the run keeps the trace, but Jaeger should not get the same spans twice
+                    self._duplicate(idx)
+                    continue
+                self._succeed(idx)
+                if trace:
+                    if ancestors is None:
+                        ancestors = self._ancestor_portal_runids(runs[portal_runid])
+                    spans.append(trace)
+                    # add traces to parent runs recursively
+                    for ancestor in ancestors:
+                        new_trace = trace.copy()
+                        new_trace['traceId'] = hashlib.md5(ancestor.encode()).hexdigest()
+                        spans.append(new_trace)
+            if portal_runid in ended:
+                self._end_run(runs[portal_runid])
+            # clients following the run on this process get the events right away, other processes poll for them
+            if portal_runid in applied_events:
+                live_broker.publish_events(portal_runid, applied_events[portal_runid])
+            live_broker.publish_run(portal_runid, updates[portal_runid]['$set'])
+
+        if spans:
+            span_forwarder.enqueue(spans)
+        if progress:
+            try:
+                update_ensemble_progress(progress)
+            except pymongo.errors.PyMongoError:
+                logger.exception('Unable to update the progress of ensembles')
+
+    def _reject_events(self, rejected: list[tuple[int, dict[str, Any]]], runs: dict[str, dict[str, Any]]) -> None:
+        """Handle events of runs which do not exist or no longer accept events.
+
+        Resent events of ended runs were already applied, everything else is invalid.
+        """
+        seqnums: dict[str, list[Any]] = {}
+        for _idx, e in rejected:
+            if e['portal_runid'] in runs and 'archive' not in runs[e['portal_runid']]:
+                seqnums.setdefault(e['portal_runid'], []).append(e['seqnum'])
+        existing = get_existing_event_keys(seqnums)
+        for idx, e in rejected:
+            run = runs.get(e['portal_runid'])
+            if (e['portal_runid'], e['seqnum']) in existing or (run is not None and _is_archived_event(run, e)):
+                self._duplicate(idx)
+            else:
+                logger.error('Invalid portal_runid %s', e['portal_runid'])
+                self._fail(idx, 'Invalid portal_runid')
+
+    @staticmethod
+    def _insert_events(events: list[dict[str, Any]]) -> tuple[set[int], set[int]]:
+        """Store events.
+
+        Returns:
+          the positions of events which could not be stored, and the positions of events which were already stored
+        """
+        try:
+            add_events(events)
+        except pymongo.errors.BulkWriteError as exc:
+            failed = set()
+            duplicates = set()
+            for error in exc.details['writeErrors']:
+                if error['code'] == DUPLICATE_KEY_ERROR:
+                    duplicates.add(error['index'])
+                else:
+                    failed.add(error['index'])
+            if failed:
+                logger.exception('Unable to store %d events', len(failed))
+            return failed, duplicates
+        except pymongo.errors.PyMongoError:
+            logger.exception('Unable to store events')
+            return set(range(len(events))), set()
+        return set(), set()
+
+    @staticmethod
+    def _ancestor_portal_runids(run: dict[str, Any]) -> list[str]:
+        if 'ancestor_portal_runids' in run:
+            return run['ancestor_portal_runids']  # type: ignore[no-any-return]
+        # runs created before the ancestor chain was stored on the run
+        if run.get('parent_portal_runid'):
+            return get_ancestor_portal_runids(run['parent_portal_runid'])
+        return []
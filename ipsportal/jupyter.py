@@ -1,18 +1,21 @@
+import csv
 import io
 import logging
 import os
 import tarfile
 from pathlib import Path
+from typing import IO
 
 from ._jupyter.hub_implementations import get_jupyter_url_prefix
 from ._jupyter.initializer import (
     initialize_jupyter_data_files,
     initialize_jupyter_notebook,
     initialize_jupyter_python_api,
+    refresh_jupyter_python_api,
     update_data_listing_file,
     update_parent_module_file_with_child_runid,
 )
-from .db import get_parent_runid_by_child_runid, save_ensemble_file_path
+from .db import get_parent_runid_by_child_runid, save_ensemble_file_path, set_ensemble_size
 from .ensemble import save_initial_csv
 from .environment import JUPYTERHUB_DIR, JUPYTERHUB_PORTAL_DIR
 
@@ -105,6 +108,8 @@ def add_analysis_data_file_for_timestep(
             return ("Couldn't write file", 500)
 
     try:
+        # copies of the API module from before the data listing journal would miss the new data file
+        refresh_jupyter_python_api(root_dir.parent)
         update_data_listing_file(root_dir, filename, timestamp)
     except Exception:
         logger.exception('Unable to update module file with the data files')
@@ -119,7 +124,7 @@ def add_ensemble_file(
     ensemble_name: str,
     component_name: str,
     ensemble_id: str,
-    data: bytes,
+    data: IO[bytes],
 ) -> tuple[str, int]:
     """
     This gets called to generate a CSV for a parent's ensembles
@@ -129,7 +134,7 @@ def add_ensemble_file(
     ensemble_name: user-provided name of the ensemble, used to generate the file (should be unique per ensemble group)
     component_name: user-provided name of the component, used to generate the filename (used to ensure that different components can reuse the same ensemble name)
     ensemble_id: automatically-generated ID, used for lookups. Ensembles will advertise their ensemble IDs when they send events. This will be shared by all ensembles in an ensemble group, but should be unique otherwise.
-    data: raw CSV data that we will initially write
+    data: stream of the raw CSV data that we will initially write, it is read row by row
     """
     root_dir = JUPYTERHUB_PORTAL_DIR / username / str(runid)
     if not root_dir.exists() and not _initialize_jupyterhub_dir(root_dir, runid):
@@ -140,9 +145,13 @@ def add_ensemble_file(
     os.makedirs(ensemble_path.parent, exist_ok=True)
     try:
         logger.info('Begin saving CSV for runid %s', runid)
-        save_initial_csv(data, ensemble_path)
+        members = save_initial_csv(data, ensemble_path)
         save_ensemble_file_path(runid, ensemble_id, component_name, ensemble_name, str(ensemble_path))
+        set_ensemble_size(ensemble_id, members)
         logger.info('Finished saving CSV for runid %s', runid)
+    except (ValueError, csv.Error) as e:
+        logger.warning('Invalid ensemble CSV %s: %s', ensemble_path, e)
+        return f'Invalid ensemble CSV: {e}', 400
     except Exception:
         logger.exception('Unable to write ensemble CSV file %s', ensemble_path)
         return (
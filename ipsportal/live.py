@@ -0,0 +1,210 @@
+"""Publish new events and run changes to clients following a run, see api.run_stream."""
+
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any
+
+from pymongo.errors import OperationFailure
+
+from .db import RUN_LIVE_FIELDS, db, get_events, get_run_live_fields
+from .environment import LIVE_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Messages for one client, as (message type, data) tuples."""
+
+    def __init__(self, portal_runid: str, last_seqnum: int, max_messages: int = 1000) -> None:
+        self.portal_runid = portal_runid
+        self.last_seqnum = last_seqnum
+        self.last_run: dict[str, Any] = {}
+        self.overflowed = False
+        self._queue: queue.Queue[tuple[str, Any]] = queue.Queue(maxsize=max_messages)
+
+    def put(self, message_type: str, data: Any) -> None:
+        try:
+            self._queue.put_nowait((message_type, data))
+        except queue.Full:
+            # the client is not keeping up, it has to reconnect and catch up from its last seqnum
+            self.overflowed = True
+
+    def get(self, timeout: float) -> tuple[str, Any] | None:
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveBroker:
+    """In-process publish/subscribe of the events and run changes of followed runs.
+
+    Events ingested by this process are published immediately. Events ingested by other worker processes
+    are picked up by a background thread, which follows a MongoDB change stream if the database is a replica set,
+    and otherwise polls the followed runs every `poll_interval` seconds (one query per run, not per client).
+    The change stream only returns changes of the followed runs, it is reopened when the followed runs change.
+
+    The thread is started lazily in the process which first subscribes, so this is safe to instantiate
+    before gunicorn forks its workers.
+    """
+
+    def __init__(self, poll_interval: float = LIVE_POLL_INTERVAL) -> None:
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._subscriptions: dict[str, set[Subscription]] = {}
+
+    def subscribe(self, portal_runid: str, last_seqnum: int) -> Subscription:
+        self._ensure_started()
+        subscription = Subscription(portal_runid, last_seqnum)
+        with self._lock:
+            self._subscriptions.setdefault(portal_runid, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.portal_runid, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.portal_runid, None)
+
+    def followed_runs(self) -> dict[str, int]:
+        """The followed runs, with the smallest seqnum all of their clients have seen."""
+        with self._lock:
+            return {
+                portal_runid: min(subscription.last_seqnum for subscription in subscriptions)
+                for portal_runid, subscriptions in self._subscriptions.items()
+            }
+
+    def publish_events(self, portal_runid: str, events: list[dict[str, Any]]) -> None:
+        """Publish new events. Events which a client has already seen are skipped, so this may be called repeatedly."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(portal_runid, ()))
+        for subscription in subscriptions:
+            new_events = [
+                {key: value for key, value in e.items() if key != '_id'}
+                for e in events
+                if e.get('seqnum', -1) > subscription.last_seqnum
+            ]
+            if new_events:
+                subscription.last_seqnum = max(e['seqnum'] for e in new_events)
+                subscription.put('events', new_events)
+
+    def publish_run(self, portal_runid: str, run: dict[str, Any]) -> None:
+        """Publish the fields of a run which changed, see db.RUN_LIVE_FIELDS."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(portal_runid, ()))
+        for subscription in subscriptions:
+            changed = {
+                key: value
+                for key, value in run.items()
+                if key in RUN_LIVE_FIELDS and key != 'lastModified' and subscription.last_run.get(key) != value
+            }
+            if changed:
+                subscription.last_run.update(changed)
+                subscription.put('run', changed)
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # subscriptions of the parent process belong to its clients
+            self._subscriptions = {}
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='live-broker', daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            self._watch()
+        except OperationFailure as e:
+            # change streams need a replica set
+            logger.info('MongoDB change streams are unavailable (%s), polling followed runs instead', e)
+        except Exception:
+            logger.exception('MongoDB change stream failed, polling followed runs instead')
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self._poll()
+            except Exception:
+                logger.exception('Unexpected error while polling followed runs')
+
+    def _watch(self) -> None:
+        resume_token = None
+        while True:
+            followed = self.followed_runs()
+            if not followed:
+                time.sleep(self.poll_interval)
+                continue
+            run_ids = {
+                run['_id']: run['portal_runid']
+                for run in db.runs.find({'portal_runid': {'$in': list(followed)}}, projection={'portal_runid': True})
+            }
+            with db.watch(
+                change_stream_pipeline(list(followed), list(run_ids)),
+                start_after=resume_token,
+                max_await_time_ms=int(self.poll_interval * 1000),
+            ) as stream:
+                # changes until the stream was opened were filtered for the runs followed before
+                for portal_runid, last_seqnum in followed.items():
+                    self._poll_run(portal_runid, last_seqnum)
+                while stream.alive and self.followed_runs().keys() == followed.keys():
+                    change = stream.try_next()
+                    if change is not None:
+                        self._publish_change(change, run_ids)
+                resume_token = stream.resume_token
+
+    def _publish_change(self, change: dict[str, Any], run_ids: dict[Any, str]) -> None:
+        if change['ns']['coll'] == 'events':
+            document = change['fullDocument']
+            self.publish_events(document['portal_runid'], [document])
+        elif portal_runid := run_ids.get(change['documentKey']['_id']):
+            self.publish_run(portal_runid, change.get('updateDescription', {}).get('updatedFields', {}))
+
+    def _poll(self) -> None:
+        for portal_runid, last_seqnum in self.followed_runs().items():
+            self._poll_run(portal_runid, last_seqnum)
+
+    def _poll_run(self, portal_runid: str, last_seqnum: int) -> None:
+        run = get_run_live_fields({'portal_runid': portal_runid})
+        if run is None:
+            return
+        if run.get('last_seqnum', last_seqnum + 1) > last_seqnum:
+            self.publish_events(portal_runid, get_events({'portal_runid': portal_runid}, last_seqnum) or [])
+        self.publish_run(portal_runid, run)
+
+
+def change_stream_pipeline(portal_runids: list[str], run_ids: list[Any]) -> list[dict[str, Any]]:
+    """Change stream stages for new events and changed live fields of the followed runs.
+
+    Run updates only include the changed fields, so the (potentially large) run documents are never sent.
+    """
+    return [
+        {
+            '$match': {
+                '$or': [
+                    {
+                        'ns.coll': 'events',
+                        'operationType': 'insert',
+                        'fullDocument.portal_runid': {'$in': portal_runids},
+                    },
+                    {'ns.coll': 'runs', 'operationType': 'update', 'documentKey._id': {'$in': run_ids}},
+                ]
+            }
+        },
+        {
+            '$project': {
+                'ns': True,
+                'documentKey': True,
+                'fullDocument': True,
+                **{f'updateDescription.updatedFields.{field}': True for field in RUN_LIVE_FIELDS},
+            }
+        },
+    ]
+
+
+live_broker = LiveBroker()
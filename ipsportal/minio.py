@@ -80,3 +80,34 @@ def put_minio_object(data: bytes, bucket_name: str, object_id: str, content_type
         return None
     else:
         return f'{MINIO_PUBLIC_URL}/{put_result.bucket_name}/{put_result.object_name}'
+
+
+def put_private_object(data: bytes, bucket_name: str, object_id: str, content_type: str) -> None:
+    """
+    Adds the raw data to MINIO, in a bucket without anonymous read access.
+
+    Raises MinioException or MaxRetryError if the operation failed.
+    """
+    if not MINIO_CLIENT.bucket_exists(bucket_name):
+        MINIO_CLIENT.make_bucket(bucket_name)
+    MINIO_CLIENT.put_object(
+        bucket_name=bucket_name,
+        object_name=object_id,
+        data=BytesIO(data),
+        length=len(data),
+        content_type=content_type,
+    )
+
+
+def get_minio_object(bucket_name: str, object_id: str) -> bytes:
+    """
+    Reads an object from MINIO.
+
+    Raises MinioException or MaxRetryError if the operation failed.
+    """
+    response = MINIO_CLIENT.get_object(bucket_name, object_id)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
@@ -0,0 +1,101 @@
+"""Keyset pagination.
+
+Instead of skipping rows, the next page is queried with a filter for rows which sort after the last row
+of the previous page. With an index matching the sort, every page costs the same, no matter how deep it is.
+
+The position is handed to clients as an opaque cursor, which encodes the sort and the sort values of the last row.
+The sort must end with `_id`, so every row has a unique position.
+
+MongoDB only compares values of the same type, so properties whose values have different types
+(e.g. a walltime stored as a string for some rows and as a number for others) cannot be paged this way.
+Sorts on such properties use offset cursors instead, which encode the number of rows to skip.
+"""
+
+from __future__ import annotations
+
+import base64
+import binascii
+from typing import Any
+
+from bson import json_util
+from bson.errors import BSONError
+
+
+class CursorError(ValueError):
+    """The cursor is malformed, or was created for a different sort."""
+
+
+def _encode(sort: dict[str, int], position: dict[str, Any]) -> str:
+    payload = json_util.dumps({'sort': list(sort.items()), **position})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _decode(cursor: str, sort: dict[str, int], key: str) -> Any:
+    """Get the position stored under `key` in the cursor."""
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        cursor_sort = [(prop, direction) for prop, direction in payload['sort']]
+        position = payload[key]
+    except (binascii.Error, BSONError, KeyError, TypeError, ValueError) as e:
+        msg = 'invalid cursor'
+        raise CursorError(msg) from e
+    if cursor_sort != list(sort.items()):
+        msg = 'cursor does not match the sort order'
+        raise CursorError(msg)
+    return position
+
+
+def encode_cursor(sort: dict[str, int], row: dict[str, Any]) -> str:
+    """Create the cursor of the page after `row`."""
+    return _encode(sort, {'values': [row.get(prop) for prop in sort]})
+
+
+def decode_cursor(cursor: str, sort: dict[str, int]) -> list[Any]:
+    """Get the sort values of the last row of the previous page."""
+    values = _decode(cursor, sort, 'values')
+    if not isinstance(values, list) or len(values) != len(sort):
+        msg = 'cursor does not match the sort order'
+        raise CursorError(msg)
+    return values
+
+
+def encode_offset_cursor(sort: dict[str, int], offset: int) -> str:
+    """Create the cursor of the page which starts at the row `offset`."""
+    return _encode(sort, {'offset': offset})
+
+
+def decode_offset_cursor(cursor: str, sort: dict[str, int]) -> int:
+    """Get the number of rows before the page."""
+    offset = _decode(cursor, sort, 'offset')
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        msg = 'invalid cursor'
+        raise CursorError(msg)
+    return offset
+
+
+def _after(prop: str, direction: int, value: Any) -> dict[str, Any] | None:
+    """Filter for values of one property which sort after `value`. Missing values sort like None, before all others."""
+    if value is None:
+        return {prop: {'$ne': None}} if direction == 1 else None
+    if direction == 1:
+        return {prop: {'$gt': value}}
+    return {'$or': [{prop: {'$lt': value}}, {prop: None}]}
+
+
+def keyset_filter(sort: dict[str, int], values: list[Any]) -> dict[str, Any]:
+    """Build the filter for rows which sort after the row with the given sort values.
+
+    All values of a sorted property other than None must have the same type, otherwise rows of the
+    other types are skipped. Use offset cursors for properties with mixed types.
+    """
+    clauses: list[dict[str, Any]] = []
+    for idx, (prop, direction) in enumerate(sort.items()):
+        after = _after(prop, direction, values[idx])
+        if after is None:
+            continue
+        equal = [{prev_prop: values[prev_idx]} for prev_idx, prev_prop in enumerate(list(sort)[:idx])]
+        clauses.append({'$and': [*equal, after]} if equal else after)
+    if not clauses:
+        # the previous page ended with the last row
+        return {'_id': {'$exists': False}}
+    return {'$or': clauses}
@@ -1,17 +1,112 @@
+from pathlib import Path
 from typing import Any
 
+import numpy as np
+import numpy.typing as npt
+import plotly
 import plotly.graph_objects as go
-from flask import Blueprint, current_app, url_for
+from flask import Blueprint, Response, current_app, jsonify, render_template, send_file, url_for
 
+from ipsportal.archive import ArchiveUnavailableError
 from ipsportal.db import get_run, get_trace
+from ipsportal.environment import RESOURCE_PLOT_MAX_POINTS
+from ipsportal.http_cache import cached_run_response
 
 bp = Blueprint('resourceplot', __name__)
 
+STEP_EPSILON = 1e-9
+"""Offset of the point before every step, so the plot draws vertical edges."""
 
-@bp.route('/resource_plot/<int:runid>')
-def resource_plot(runid: int) -> tuple[str, int]:
-    traces = get_trace({'runid': runid})
-    if traces is None:
+PLOTLY_JS = Path(plotly.__file__).parent / 'package_data' / 'plotly.min.js'
+"""The plotly.js bundle matching the figures created by the installed plotly package."""
+
+
+def get_resource_usage(
+    tasks: list[dict[str, Any]], time_start: float, duration: float
+) -> tuple[npt.NDArray[np.float64], dict[str, npt.NDArray[np.float64]]]:
+    """Compute the cores allocated to every component over time, as step functions.
+
+    Every task adds four points: right before and at its start, and right before and at its end.
+    All components share the same x values, so their series can be stacked.
+
+    Params:
+      tasks: spans with "timestamp" and "duration" (in microseconds), "localEndpoint.serviceName"
+        and "tags.cores_allocated"
+      time_start: start of the run, in seconds
+      duration: walltime of the run, in seconds
+
+    Returns:
+      the sorted x values, and the y values of every component
+
+    Raises:
+      KeyError, TypeError or ValueError if a task is missing information
+    """
+    components = np.array([t['localEndpoint']['serviceName'] for t in tasks], dtype=object)
+    timestamps = np.array([t['timestamp'] for t in tasks], dtype=np.float64)
+    durations = np.array([t['duration'] for t in tasks], dtype=np.float64)
+    cores = np.array([float(t['tags']['cores_allocated']) for t in tasks], dtype=np.float64)
+
+    n = len(tasks)
+    starts = timestamps / 1e6 - time_start
+    ends = (timestamps + durations) / 1e6 - time_start
+    x = np.concatenate(([0.0, duration], starts - STEP_EPSILON, starts, ends - STEP_EPSILON, ends))
+    # at equal times, ends sort before unchanged points, which sort before starts
+    rank = np.concatenate((np.ones(2 + n), np.full(n, 2), np.ones(n), np.zeros(n)))
+    order = np.lexsort((rank, x))
+    start_positions = np.arange(2 + n, 2 + 2 * n)
+    end_positions = np.arange(2 + 3 * n, 2 + 4 * n)
+
+    names, component_indices = np.unique(components, return_inverse=True)
+    usage: dict[str, npt.NDArray[np.float64]] = {}
+    for idx, name in enumerate(names):
+        in_component = component_indices == idx
+        steps = np.zeros(len(x))
+        steps[start_positions[in_component]] = cores[in_component]
+        steps[end_positions[in_component]] = -cores[in_component]
+        usage[str(name)] = np.cumsum(steps[order])
+    return x[order], usage
+
+
+def lttb_indices(x: npt.NDArray[np.float64], y: npt.NDArray[np.float64], threshold: int) -> npt.NDArray[np.intp]:
+    """Downsample a series with Largest-Triangle-Three-Buckets, which keeps the points which shape the plot.
+
+    Returns:
+      the sorted indices of at most `threshold` points, always including the first and the last point
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # the points between the first and the last are split into threshold - 2 buckets
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.intp) + 1
+    edges[-1] = n - 1
+    indices = np.empty(threshold, dtype=np.intp)
+    indices[0] = 0
+    indices[-1] = n - 1
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_x = x[end : edges[bucket + 2]].mean()
+            next_y = y[end : edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        # pick the point of the bucket which forms the largest triangle with the previous pick and the next bucket
+        areas = np.abs(
+            (x[selected] - next_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (next_y - y[selected])
+        )
+        selected = start + int(np.argmax(areas))
+        indices[bucket + 1] = selected
+    return indices
+
+
+def _resource_figure(runid: int) -> tuple[go.Figure | str, int]:
+    """Create the resource plot of a run, or an error message and status code."""
+    try:
+        traces = get_trace({'runid': runid})
+    except ArchiveUnavailableError:
+        return 'Unable to plot because the archived trace is unavailable', 503
+    if not traces:
         return 'Unable to plot because missing trace information', 500
 
     # last trace should get the IPS_END event
@@ -27,59 +122,28 @@ def resource_plot(runid: int) -> tuple[str, int]:
     if run is None:
         return 'Missing run', 404
 
-    tasks = []
-    task_set = set()
+    tasks = [trace for trace in traces if 'tags' in trace and 'cores_allocated' in trace['tags']]
     try:
-        for trace in traces:
-            if 'tags' in trace and 'cores_allocated' in trace['tags']:
-                tasks.append(trace)
-                task_set.add(trace['localEndpoint']['serviceName'])
-
-        task_plots: dict[str, Any] = {'x': []}
-        for task in task_set:
-            task_plots[task] = []
-
-        task_plots['x'].append(0)
-        task_plots['x'].append(duration)
-        for task in task_set:
-            task_plots[task].append(0.0)
-            task_plots[task].append(0.0)
-
-        for t in tasks:
-            start = float(t['timestamp']) / 1e6 - time_start
-            end = float(t['timestamp'] + t['duration']) / 1e6 - time_start
-            name = t['localEndpoint']['serviceName']
-            task_plots['x'].append(start - 1e-9)
-            task_plots['x'].append(start)
-            task_plots['x'].append(end - 1.0e-9)
-            task_plots['x'].append(end)
-            cores = float(t['tags']['cores_allocated'])
-            for task in task_set:
-                if task == name:
-                    task_plots[task].append(0.0)
-                    task_plots[task].append(cores)
-                    task_plots[task].append(0.0)
-                    task_plots[task].append(-cores)
-                else:
-                    task_plots[task].append(0.0)
-                    task_plots[task].append(0.0)
-                    task_plots[task].append(0.0)
-                    task_plots[task].append(0.0)
-    except KeyError:
+        x, usage = get_resource_usage(tasks, time_start, duration)
+    except (KeyError, TypeError, ValueError):
         current_app.logger.exception('Unable to plot because missing information')
         return 'Unable to plot because missing information', 500
 
+    # WebGL traces cannot be stacked by plotly, so the stacked values are computed here.
+    # All components are downsampled with the same points of the total, so the stacks stay aligned.
+    stacked = np.cumsum([usage[task] for task in usage], axis=0) if usage else np.empty((0, len(x)))
+    keep = lttb_indices(x, stacked[-1], RESOURCE_PLOT_MAX_POINTS) if usage else np.arange(len(x))
     plot = go.Figure()
-    for task in task_set:
-        # sort x and y arrays by x
-        x, y = list(zip(*sorted(zip(task_plots['x'], task_plots[task], strict=False)), strict=False))
-
+    for idx, (task, y) in enumerate(usage.items()):
         plot.add_trace(
-            go.Scatter(
+            go.Scattergl(
                 name=task,
-                x=x,
-                y=[sum(y[: n + 1]) for n in range(len(y))],  # cumsum
-                stackgroup='one',
+                x=x[keep],
+                y=stacked[idx][keep],
+                customdata=y[keep],
+                hovertemplate='%{customdata} cores',
+                mode='lines',
+                fill='tozeroy' if idx == 0 else 'tonexty',
             )
         )
 
@@ -92,4 +156,28 @@ def resource_plot(runid: int) -> tuple[str, int]:
         f'Allocation total cores = {total_cores}',
         legend_title_text='Tasks',
     )
-    return plot.to_html(), 200
+    return plot, 200
+
+
+@bp.route('/resource_plot/<int:runid>')
+def resource_plot(runid: int) -> tuple[str, int]:
+    """Page which loads the figure from resource_plot_json, so the plotly.js bundle is only downloaded once."""
+    return render_template('resource_plot.html', runid=runid, plotly_version=plotly.__version__), 200
+
+
+@bp.route('/resource_plot/plotly.min.js')
+def plotly_js() -> Response:
+    # the URL includes the version, so browsers can keep the bundle until plotly is upgraded
+    response = send_file(PLOTLY_JS, mimetype='text/javascript', max_age=365 * 24 * 60 * 60)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.route('/api/run/<int:runid>/resource_plot.json')
+@cached_run_response(include_descendants=True)
+def resource_plot_json(runid: int) -> tuple[Response, int]:
+    figure, status = _resource_figure(runid)
+    if isinstance(figure, str):
+        return jsonify(message=figure), status
+    return Response(figure.to_json(), mimetype='application/json'), status
@@ -1,6 +1,4 @@
 import logging
-from csv import DictReader
-from typing import Any
 
 from flask import Blueprint, render_template
 from urllib3.util import parse_url
@@ -8,6 +6,7 @@ from urllib3.util import parse_url
 from ipsportal._jupyter.hub_implementations import get_jupyter_url_prefix
 from ipsportal.db import get_data_information, get_run, get_runid
 from ipsportal.environment import JUPYTERHUB_IMPLEMENTATION
+from ipsportal.http_cache import cached_run_response
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +19,7 @@ def index() -> tuple[str, int]:
 
 
 @bp.route('/<int:runid>')
+@cached_run_response(include_data=True)
 def run(runid: int) -> tuple[str, int]:
     run = get_run({'runid': runid})
     if run is None:
@@ -29,28 +29,11 @@ def run(runid: int) -> tuple[str, int]:
         run['parent_runid'] = get_runid(str(run.get('parent_portal_runid')))
     else:
         run['parent_runid'] = None
-    data_info, jupyter_urls, ensemble_information_meta = get_data_information(runid)
+    data_info, jupyter_urls, ensemble_information = get_data_information(runid)
     if jupyter_urls:
         resolved_jupyter_urls = [[jupyter_url, parse_url(jupyter_url).host] for jupyter_url in jupyter_urls]
     else:
         resolved_jupyter_urls = None
-    ensemble_information = []
-    if ensemble_information_meta:
-        for listing in ensemble_information_meta:
-            try:
-                with open(listing['path']) as fd:
-                    data: list[dict[str, Any]] = list(DictReader(fd))
-                    # component keys should ALWAYS have a ':' in them, and non-component keys should NEVER have a ':' in them. Make sure the framework follows this convention.
-                    component_keys = list(filter(lambda column: ':' in column, data[0].keys()))
-                    ensemble_information.append(
-                        {
-                            'data': data,
-                            'ensemble_name': listing['ensemble_name'],
-                            'component_keys': component_keys,
-                        }
-                    )
-            except Exception:
-                logger.exception('potentially invalid listing: %s', listing)
     return render_template(
         'events.html',
         run=run,
@@ -0,0 +1,83 @@
+"""Search for the runs tables.
+
+Runs store a lowercase `search_tokens` array with a multikey index. Every word of a searchable property
+is stored twice, as "<word>" and as "<property>:<word>", so both plain and field-scoped terms become
+anchored regexes on the token array, which MongoDB answers with index range scans.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+SEARCHABLE_PROPS = ('runid', 'rcomment', 'simname', 'host', 'user', 'startat')
+"""
+Properties which are tokenized when a run is created.
+
+The state is searched separately, as it changes over the lifetime of a run.
+"""
+
+WORD_REGEX = re.compile(r'\w+')
+
+
+def tokenize(value: object) -> list[str]:
+    """Split a value into lowercase words."""
+    return WORD_REGEX.findall(str(value).lower())
+
+
+def run_search_tokens(run: dict[str, Any]) -> list[str]:
+    """Get the search tokens of a run (or of the run properties in an event)."""
+    tokens: set[str] = set()
+    for prop in SEARCHABLE_PROPS:
+        value = run.get(prop)
+        if value is None:
+            continue
+        for word in tokenize(value):
+            tokens.add(word)
+            tokens.add(f'{prop}:{word}')
+    return sorted(tokens)
+
+
+def _token_prefix(token: str) -> dict[str, Any]:
+    # an anchored, case-sensitive regex is turned into an index range scan
+    return {'search_tokens': {'$regex': f'^{re.escape(token)}'}}
+
+
+def search_filter(search_terms: list[str], states: Iterable[str]) -> dict[str, Any]:
+    """Build the filter for search terms. All terms must match.
+
+    Every term matches words by prefix. Terms can be scoped to a property with "<property>:<term>",
+    e.g. "user:foo" only matches runs whose user has a word starting with "foo".
+
+    Params:
+      search_terms: non-empty list of strings
+      states: all states runs can currently have, these are matched by prefix as well
+
+    Returns:
+      value to update the $match filter with
+    """
+    clauses: list[dict[str, Any]] = []
+    for term in search_terms:
+        prop, scoped, value = term.partition(':')
+        prop = prop.lower()
+        if scoped and prop == 'state':
+            clauses.append({'state': {'$in': [state for state in states if state.lower().startswith(value.lower())]}})
+            continue
+        if scoped and prop in SEARCHABLE_PROPS:
+            clauses.extend(_token_prefix(f'{prop}:{word}') for word in tokenize(value))
+            continue
+
+        words = tokenize(term)
+        if len(words) == 1:
+            matching_states = [state for state in states if state.lower().startswith(words[0])]
+            if matching_states:
+                clauses.append({'$or': [_token_prefix(words[0]), {'state': {'$in': matching_states}}]})
+                continue
+        clauses.extend(_token_prefix(word) for word in words)
+
+    if not clauses:
+        return {}
+    return {'$and': clauses}
@@ -0,0 +1,115 @@
+$(document).ready(function () {
+  // ensembles can have many thousands of members, so their rows are paged by the server,
+  // and only requested once the ensembles tab is shown
+  let loaded = false;
+  $("#nav-ensembles-tab").on("shown.bs.tab", () => {
+    if (loaded) {
+      return;
+    }
+    loaded = true;
+    $(".ensemble-table").each((_, table) => loadEnsembleTable($(table)));
+    loadEnsembleProgress($(".ensemble-table").first().attr("runid"));
+  });
+});
+
+function loadEnsembleProgress(runid) {
+  const seconds = (value) => (value === null ? "-" : `${value.toFixed(1)} s`);
+  $.getJSON(`/api/run/${runid}/ensembles/summary`).done((summary) => {
+    for (const ensemble of summary) {
+      const progress = $(".ensemble-progress").filter(
+        (_, element) => $(element).attr("ensemble-id") === ensemble.ensemble_id,
+      );
+      const members = ensemble.members === null ? "Unknown number of" : ensemble.members;
+      progress.text(
+        `${members} members: ${ensemble.pending} pending, ${ensemble.running} running, ` +
+          `${ensemble.completed} completed, ${ensemble.failed} failed, ${ensemble.timeout} timed out. ` +
+          `Walltime min ${seconds(ensemble.walltime.min)}, mean ${seconds(ensemble.walltime.mean)}, ` +
+          `max ${seconds(ensemble.walltime.max)}`,
+      );
+    }
+  });
+}
+
+function loadEnsembleTable(table) {
+  const url = `/api/run/${table.attr("runid")}/ensembles/${table.attr("ensemble-id")}`;
+  $.getJSON(url).done((ensemble) => {
+    const index = (name) => ensemble.columns.indexOf(name);
+    const link = (href, text) => $("<a>").attr("href", href).text(text)[0].outerHTML;
+    const jupyterPrefix = table.attr("jupyter-url-prefix");
+    const columns = [
+      { title: "Sim Name", data: index("sim_name"), render: DataTable.render.text() },
+      {
+        title: "Run",
+        data: index("portal_runid"),
+        render: (data, type, row) =>
+          type === "display" ? link(row[index("run_url")], data) : data,
+      },
+      {
+        title: "Instance Analysis URL",
+        data: index("instance_analysis_path"),
+        orderable: false,
+        searchable: false,
+        render: (data, type) => {
+          if (type !== "display") {
+            return data;
+          }
+          if (table.attr("jupyterhub-implementation") === "nersc") {
+            return $("<button>")
+              .addClass("jupyter-nersc-url-btn")
+              .attr("data-original-url", `${jupyterPrefix}${data}`)
+              .text("View run on Jupyter")[0].outerHTML;
+          }
+          return link(`${jupyterPrefix}${data}`, "View run on Jupyter");
+        },
+      },
+      ...ensemble.component_keys.map((key) => ({
+        title: key,
+        data: index(key),
+        render: DataTable.render.text(),
+      })),
+    ];
+
+    // one filter input per column, below the table
+    const footer = $("<tr>");
+    for (const column of columns) {
+      footer.append(
+        $("<th>").append(
+          column.searchable === false
+            ? ""
+            : $("<input>")
+                .addClass("form-control form-control-sm")
+                .attr("placeholder", `Filter ${column.title}`),
+        ),
+      );
+    }
+    table.append($("<tfoot>").append(footer));
+
+    table.DataTable({
+      ajax: {
+        url: url,
+        // require query parameter for "data" to be JSON-encoded string
+        data: (d) => ({ data: JSON.stringify(d) }),
+      },
+      serverSide: true,
+      responsive: true,
+      processing: true,
+      columns: columns,
+      order: [[0, "asc"]],
+      // the server only sorts by one column
+      orderMulti: false,
+      lengthMenu: [10, 25, 100, 1000],
+      initComplete: function () {
+        this.api()
+          .columns()
+          .every(function () {
+            const column = this;
+            $("input", column.footer()).on("keyup change", function () {
+              if (column.search() !== this.value) {
+                column.search(this.value).draw();
+              }
+            });
+          });
+      },
+    });
+  });
+}
@@ -1,16 +1,16 @@
 $(document).ready(function () {
   $("#event-table").DataTable({
     ajax: {
-      url: `/api/run/${$("#event-table").attr("runid")}/events`,
-      dataSrc: "",
+      url: `/api/run/${$("#event-table").attr("runid")}/events-datatables`,
+      // require query parameter for "data" to be JSON-encoded string
+      data: (d) => ({ data: JSON.stringify(d) }),
     },
-    deferRender: true,
+    serverSide: true,
     responsive: true,
     order: [[1, "desc"]],
-    lengthMenu: [
-      [10, 25, 100, -1],
-      [10, 25, 100, "All"],
-    ],
+    // the server only sorts by one column
+    orderMulti: false,
+    lengthMenu: [10, 25, 100, 1000],
     columns: [
       { data: "time", defaultContent: "" },
       { data: "seqnum", defaultContent: "" },
@@ -16,6 +16,10 @@ function onNerscJupyterUrlBtnClick(event) {
   }
 }
 
-for (let jupyterUrlBtn of document.getElementsByClassName("jupyter-nersc-url-btn")) {
-  jupyterUrlBtn.addEventListener("click", onNerscJupyterUrlBtnClick);
-}
+// delegate clicks, as buttons are also added to tables after the page loaded
+document.addEventListener("click", (event) => {
+  const jupyterUrlBtn = event.target.closest(".jupyter-nersc-url-btn");
+  if (jupyterUrlBtn) {
+    onNerscJupyterUrlBtnClick({ currentTarget: jupyterUrlBtn });
+  }
+});
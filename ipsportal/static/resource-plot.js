@@ -0,0 +1,16 @@
+$(document).ready(function () {
+  // the figure is fetched separately, so the plotly.js bundle stays in the browser cache
+  const container = $("#resource-plot");
+  $.getJSON(`/api/run/${container.attr("runid")}/resource_plot.json`)
+    .done((figure) => {
+      Plotly.newPlot(container[0], figure.data, figure.layout, {
+        responsive: true,
+      });
+    })
+    .fail((response) => {
+      const message =
+        (response.responseJSON && response.responseJSON.message) ||
+        "Unable to load the resource plot";
+      container.text(message);
+    });
+});
@@ -0,0 +1,36 @@
+$(document).ready(function () {
+  // follow a running simulation: update the run summary and reload the events table as new events arrive
+  const eventTable = $("#event-table");
+  if (
+    !window.EventSource ||
+    !["Running", "Timeout"].includes(eventTable.attr("state"))
+  ) {
+    return;
+  }
+
+  const source = new EventSource(`/api/run/${eventTable.attr("runid")}/stream`);
+  let reloadPending = false;
+
+  source.addEventListener("events", () => {
+    // coalesce bursts of events into one reload of the current page
+    if (reloadPending) {
+      return;
+    }
+    reloadPending = true;
+    setTimeout(() => {
+      reloadPending = false;
+      eventTable.DataTable().ajax.reload(null, false);
+    }, 1000);
+  });
+
+  source.addEventListener("run", (e) => {
+    const run = JSON.parse(e.data);
+    for (const field of ["state", "stopat"]) {
+      if (field in run) {
+        $(`#run-${field}`).text(run[field]);
+      }
+    }
+  });
+
+  source.addEventListener("end", () => source.close());
+});
@@ -1,9 +1,28 @@
 $(document).ready(function () {
+  // keyset pagination: when moving to the next page, continue after the last row instead of skipping rows
+  let lastRequest = null;
+  let nextCursor = null;
+  const pageKey = (d, start) => JSON.stringify([d.order, d.search, d.length, start]);
+
   $("#runs-table").DataTable({
     ajax: {
       url: "/api/runs-datatables",
       // require query parameter for "data" to be JSON-encoded string
-      data: (d) => ({ data: JSON.stringify(d) }),
+      data: (d) => {
+        if (
+          nextCursor &&
+          pageKey(d, d.start) ===
+            pageKey(lastRequest, lastRequest.start + lastRequest.length)
+        ) {
+          d.cursor = nextCursor;
+        }
+        lastRequest = d;
+        return { data: JSON.stringify(d) };
+      },
+      dataSrc: (json) => {
+        nextCursor = json.next_cursor;
+        return json.data;
+      },
     },
     serverSide: true,
     processing: true,
@@ -13,6 +32,8 @@ $(document).ready(function () {
     // },
     responsive: true,
     order: [[0, "desc"]],
+    // the server only sorts by one column, which its indexes can satisfy
+    orderMulti: false,
     columns: [
       {
         data: "runid",
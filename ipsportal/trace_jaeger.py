@@ -1,16 +1,35 @@
 import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
 from typing import Any
 
 import requests
-from flask import Blueprint, current_app, redirect, url_for
+from flask import Blueprint, current_app, jsonify, redirect, url_for
 from werkzeug.wrappers import Response
 
 from ipsportal.db import get_portal_runid, get_trace
 
-from .environment import JAEGER_HOST
+from .environment import (
+    JAEGER_BATCH_SIZE,
+    JAEGER_FLUSH_INTERVAL,
+    JAEGER_HOST,
+    JAEGER_MAX_RETRIES,
+    JAEGER_QUEUE_SIZE,
+    JAEGER_SPOOL_DIR,
+    JAEGER_SPOOL_MAX_FILES,
+)
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('trace', __name__)
 
+ZIPKIN_SPANS_URL = f'http://{JAEGER_HOST}:9411/api/v2/spans'
+
 
 @bp.route('/gettrace/<int:runid>')
 def gettrace(runid: int) -> tuple[str, int] | Response:
@@ -21,7 +40,7 @@ def gettrace(runid: int) -> tuple[str, int] | Response:
 
     try:
         x = requests.get(f'http://{JAEGER_HOST}:16686/jaeger/api/traces/{traceID}', timeout=60)
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         current_app.logger.exception('Unable to connect to jaeger')
         return 'Unable to connect to jaeger', 500
 
@@ -32,7 +51,7 @@ def gettrace(runid: int) -> tuple[str, int] | Response:
 
         try:
             response = send_trace(trace)
-        except requests.exceptions.ConnectionError:
+        except requests.exceptions.RequestException:
             current_app.logger.exception('Unable to create trace')
             return 'Unable to create trace', 500
 
@@ -49,8 +68,256 @@ def jaeger(trace: str) -> Response:
     return Response('Unable to get trace', 500)
 
 
+@bp.route('/api/jaeger/forwarder')
+def forwarder_stats() -> tuple[Response, int]:
+    """Counters of the span forwarder. Note that each worker process has its own forwarder."""
+    return jsonify(span_forwarder.stats()), 200
+
+
 def send_trace(trace: list[dict[str, Any]]) -> requests.Response:
-    url = f'http://{JAEGER_HOST}:9411/api/v2/spans'
     headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
 
-    return requests.post(url, json=trace, headers=headers, timeout=1)
+    return requests.post(ZIPKIN_SPANS_URL, json=trace, headers=headers, timeout=1)
+
+
+class SpanForwarder:
+    """Sends spans to Jaeger's Zipkin v2 endpoint from a background thread.
+
+    Spans are put on a bounded in-memory queue, so callers never wait on Jaeger. The flusher thread
+    coalesces queued spans into batches, retries failed requests with exponential backoff, and spools
+    batches to disk while Jaeger is unavailable. Spooled batches are sent again once Jaeger recovers.
+
+    The queue and thread are created lazily in the process which first enqueues spans,
+    so this is safe to instantiate before gunicorn forks its workers.
+    """
+
+    SPOOL_RECOUNT_WRITES = 100
+    """The spool directory is recounted after this many spooled batches, as other worker processes share it."""
+
+    STALE_CLAIM_SECONDS = 600.0
+    """Spooled batches claimed longer ago than this are sent again, in case the claiming process was killed."""
+
+    def __init__(
+        self,
+        url: str,
+        spool_dir: Path,
+        queue_size: int = JAEGER_QUEUE_SIZE,
+        batch_size: int = JAEGER_BATCH_SIZE,
+        flush_interval: float = JAEGER_FLUSH_INTERVAL,
+        max_retries: int = JAEGER_MAX_RETRIES,
+        spool_max_files: int = JAEGER_SPOOL_MAX_FILES,
+    ) -> None:
+        self.url = url
+        self.spool_dir = spool_dir
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spool_max_files = spool_max_files
+
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._queue: queue.Queue[dict[str, Any]] = queue.Queue(maxsize=queue_size)
+        self._session = requests.Session()
+        self._unavailable_until = 0.0
+        self._unavailable_backoff = 0.0
+        # approximate number of spooled batches, so spooling does not list the directory for every batch
+        self._spool_count: int | None = None
+        self._spool_writes = 0
+
+        self.sent = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.failed_requests = 0
+
+    def enqueue(self, spans: list[dict[str, Any]]) -> None:
+        """Queue spans to be sent to Jaeger. This never blocks, spans are dropped if the queue is full."""
+        self._ensure_started()
+        for span in spans:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.dropped += 1
+
+    def stats(self) -> dict[str, Any]:
+        try:
+            spool_files = sum(1 for _ in self.spool_dir.glob('*.json'))
+        except OSError:
+            spool_files = 0
+        return {
+            'pid': os.getpid(),
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self.queue_size,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'spooled': self.spooled,
+            'spool_files': spool_files,
+            'failed_requests': self.failed_requests,
+        }
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # after a fork, the parent's thread does not exist in this process and its queue/session must not be shared
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._session = requests.Session()
+            self._spool_count = None
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='jaeger-span-forwarder', daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                batch = self._next_batch()
+                if batch:
+                    self._flush_batch(batch)
+                else:
+                    self._drain_spool()
+            except Exception:
+                logger.exception('Unexpected error in the Jaeger span forwarder')
+
+    def _next_batch(self) -> list[dict[str, Any]]:
+        """Block until spans are available, then collect up to a full batch within the flush interval.
+
+        Returns an empty list if no spans arrived for a while, so the spool can be retried.
+        """
+        try:
+            batch = [self._queue.get(timeout=max(self.flush_interval, 5.0))]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush_batch(self, batch: list[dict[str, Any]]) -> None:
+        if self._post(batch):
+            self._drain_spool()
+        else:
+            self._spool(batch)
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._unavailable_until
+
+    def _post(self, spans: list[dict[str, Any]]) -> bool:
+        """Send spans, retrying with exponential backoff. Returns True if Jaeger accepted them."""
+        if not self._available():
+            return False
+        for attempt in range(self.max_retries):
+            if attempt:
+                time.sleep(min(0.25 * 2**attempt, 5.0))
+            try:
+                response = self._session.post(self.url, json=spans, timeout=5)
+            except requests.exceptions.RequestException as e:
+                logger.debug('Unable to send spans to Jaeger: %s', e)
+            else:
+                if response.status_code < 300:
+                    self.sent += len(spans)
+                    self._unavailable_backoff = 0.0
+                    return True
+                logger.warning('Jaeger rejected %d spans with status %d', len(spans), response.status_code)
+                if response.status_code < 500:
+                    # the spans themselves are invalid, sending them again will not help
+                    self.dropped += len(spans)
+                    return True
+            self.failed_requests += 1
+
+        # stop trying for a while, batches go straight to the spool until then
+        self._unavailable_backoff = min(max(self._unavailable_backoff * 2, 1.0), 60.0)
+        self._unavailable_until = time.monotonic() + self._unavailable_backoff
+        return False
+
+    def _spool(self, spans: list[dict[str, Any]]) -> None:
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            if self._spool_count is None or self._spool_writes >= self.SPOOL_RECOUNT_WRITES:
+                self._spool_count = sum(1 for _ in self.spool_dir.glob('*.json'))
+                self._spool_writes = 0
+            if self._spool_count >= self.spool_max_files:
+                self.dropped += len(spans)
+                return
+            path = self.spool_dir / f'{time.time_ns()}-{os.getpid()}.json'
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(spans, f)
+            # rename is atomic, so other processes never see a partially written batch
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception('Unable to spool spans for Jaeger')
+            self.dropped += len(spans)
+        else:
+            self.spooled += len(spans)
+            self._spool_count += 1
+            self._spool_writes += 1
+
+    def _drain_spool(self) -> None:
+        """Send spooled batches, oldest first, until the spool is empty or Jaeger fails again."""
+        if not self._available():
+            return
+        try:
+            self._release_stale_claims()
+            paths = sorted(self.spool_dir.glob('*.json'))
+        except OSError:
+            return
+        self._spool_count = len(paths)
+        for path in paths:
+            # claim the file first, as all worker processes share the spool directory
+            claimed = path.with_suffix(f'.{os.getpid()}.sending')
+            try:
+                os.rename(path, claimed)
+                with open(claimed) as f:
+                    spans = json.load(f)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError):
+                logger.exception('Discarding unreadable spooled spans %s', path)
+                claimed.unlink(missing_ok=True)
+                continue
+
+            if not self._post(spans):
+                os.rename(claimed, path)
+                return
+            claimed.unlink(missing_ok=True)
+            self._spool_count = max(self._spool_count - 1, 0)
+
+    def _release_stale_claims(self) -> None:
+        """Return spooled batches claimed by processes which died, or which claimed them too long ago, to the spool."""
+        for claimed in self.spool_dir.glob('*.sending'):
+            # "<name>.json" is claimed as "<name>.<pid>.sending"
+            name, _sep, pid = claimed.name.removesuffix('.sending').rpartition('.')
+            try:
+                if not self._is_stale_claim(claimed, pid):
+                    continue
+                os.rename(claimed, claimed.with_name(f'{name}.json'))
+            except FileNotFoundError:
+                # sent or released by another process in the meantime
+                continue
+            logger.warning('Sending spooled spans %s again, which were claimed by process %s', name, pid)
+
+    def _is_stale_claim(self, claimed: Path, pid: str) -> bool:
+        # renaming the file to claim it updated its ctime
+        if time.time() - claimed.stat().st_ctime > self.STALE_CLAIM_SECONDS:
+            return True
+        # only the flusher thread claims files, one at a time, so claims of this process were abandoned
+        if not pid.isdigit() or int(pid) == os.getpid():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # the process exists, but belongs to another user
+            pass
+        return False
+
+
+span_forwarder = SpanForwarder(ZIPKIN_SPANS_URL, JAEGER_SPOOL_DIR)
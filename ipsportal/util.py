@@ -1,4 +1,10 @@
 import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, TypeVar
+
+T = TypeVar('T')
 
 ALLOWED_PROPS_RUN = [
     'runid',
@@ -17,6 +23,21 @@ Properties we allow sort queries on for the runs table.
 THIS MUST MATCH THE CLIENT SIDE CONFIGURATION.
 """
 
+ALLOWED_PROPS_EVENT = [
+    'time',
+    'seqnum',
+    'eventtype',
+    'code',
+    'walltime',
+    'phystimestamp',
+    'comment',
+]
+"""
+Properties we allow sort queries on for the events table.
+
+THIS MUST MATCH THE CLIENT SIDE CONFIGURATION.
+"""
+
 VALID_FILENAME_REGEX = re.compile('^[a-zA-Z0-9._#%+-]+$')
 
 
@@ -24,3 +45,38 @@ VALID_FILENAME_REGEX = re.compile('^[a-zA-Z0-9._#%+-]+$')
 def is_valid_filename(filename: str) -> bool:
     """Make sure that users submit a file which is reasonable and would be valid on any OS"""
     return bool(VALID_FILENAME_REGEX.match(filename))
+
+
+class TTLCache(Generic[T]):
+    """A small thread-safe cache whose entries expire after `ttl` seconds.
+
+    The least recently stored entries are evicted once the cache holds `max_entries`.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1024) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, T]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> T | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key: str, value: T) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
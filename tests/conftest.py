@@ -1,11 +1,15 @@
 import pytest
 
 from ipsportal import create_app
+from ipsportal.db import ensure_indexes, get_db
 
 
 @pytest.fixture
 def app():
-    return create_app()
+    app = create_app()
+    # deployments create the indexes with `flask --app ipsportal create-indexes` when the container starts
+    ensure_indexes(get_db())
+    return app
 
 
 @pytest.fixture
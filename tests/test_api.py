@@ -1,5 +1,13 @@
+import gzip
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
 from uuid import uuid1
 
+from urllib3.exceptions import MaxRetryError
+
+from ipsportal.util import ALLOWED_PROPS_EVENT
+
 
 def test_post_events(client):
     current_number_of_runs = len(client.get('/api/runs').json)
@@ -37,7 +45,8 @@ def test_post_events(client):
     response = client.get(f'/api/run/{runid}')
     assert response.status_code == 200
     assert response.json['portal_runid'] == start_event['portal_runid']
-    assert response.json['state'] == 'Timeout'
+    assert response.json['state'] == 'Running'
+    assert response.json['event_count'] == 1
     assert response.json['startat'] == start_event['startat']
     assert response.json['rcomment'] == start_event['rcomment']
     assert response.json['runid'] == runid
@@ -47,7 +56,8 @@ def test_post_events(client):
     response = client.get(f'/api/run/{portal_runid}')
     assert response.status_code == 200
     assert response.json['portal_runid'] == start_event['portal_runid']
-    assert response.json['state'] == 'Timeout'
+    assert response.json['state'] == 'Running'
+    assert response.json['event_count'] == 1
     assert response.json['startat'] == start_event['startat']
     assert response.json['rcomment'] == start_event['rcomment']
     assert response.json['runid'] == runid
@@ -128,6 +138,7 @@ def test_post_events(client):
     assert response.json['stopat'] == end_event['stopat']
     assert response.json['runid'] == runid
     assert response.json['has_trace']
+    assert response.json['event_count'] == 3
 
     # check events with runid
     response = client.get(f'/api/run/{runid}/events')
@@ -174,7 +185,7 @@ def test_post_events(client):
     assert response.json[1] == trace2
 
     # posting another event should fail since run has ended
-    response = client.post('/api/event', json=event)
+    response = client.post('/api/event', json={**event, 'seqnum': 3})
 
     assert response.status_code == 400
     assert 'message' in response.json
@@ -271,8 +282,16 @@ def test_duplicate_portal_runid(client):
     assert 'errors' not in response.json
     assert 'runid' in response.json
 
-    # this should fail
+    # resending the same event is idempotent
     response = client.post('/api/event', json=start_event)
+    assert response.status_code == 200
+    assert response.json['message'] == '0 events added to run'
+    assert response.json['duplicates'] == 1
+    assert response.json['results'] == [{'seqnum': 0, 'status': 'duplicate'}]
+    assert 'errors' not in response.json
+
+    # a different IPS_START for the same portal_runid should fail
+    response = client.post('/api/event', json={**start_event, 'seqnum': 1})
     assert response.status_code == 400
     assert 'message' in response.json
     assert response.json['message'] == '0 events added to run'
@@ -281,6 +300,145 @@ def test_duplicate_portal_runid(client):
     assert 'runid' not in response.json
 
 
+def test_resent_events_are_idempotent(client):
+    portal_runid = str(uuid1())
+    start_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_START',
+        'ok': True,
+        'comment': f'Starting IPS Simulation {portal_runid}',
+        'walltime': '0.01',
+        'state': 'Running',
+        'startat': '2022-05-03|15:41:07EDT',
+        'rcomment': 'CI Test',
+        'phystimestamp': -1,
+        'portal_runid': portal_runid,
+        'seqnum': 0,
+        'user': 'retry',
+    }
+    events = [
+        {
+            'code': 'DRIVER',
+            'eventtype': 'IPS_CALL_BEGIN',
+            'ok': True,
+            'comment': 'Target = x:init(0)',
+            'walltime': '0.5',
+            'phystimestamp': 0,
+            'portal_runid': portal_runid,
+            'seqnum': 1,
+        },
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_END',
+            'ok': True,
+            'comment': 'Simulation Ended',
+            'walltime': '1.0',
+            'state': 'Completed',
+            'stopat': '2022-05-03|15:41:08EDT',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 2,
+        },
+    ]
+    response = client.post('/api/event', json=[start_event, *events])
+    assert response.status_code == 200
+    runid = response.json['runid']
+
+    # the whole batch is resent, e.g. after a client timeout, along with one new (invalid) event
+    late_event = {**events[0], 'seqnum': 3}
+    response = client.post('/api/event', json=[start_event, *events, late_event])
+    assert response.status_code == 400
+    assert response.json['duplicates'] == 3
+    assert [r['status'] for r in response.json['results']] == ['duplicate', 'duplicate', 'duplicate', 'error']
+    assert response.json['errors'] == ['Invalid portal_runid']
+
+    response = client.get(f'/api/run/{runid}/events')
+    assert [e['seqnum'] for e in response.json] == [0, 1, 2]
+
+
+def test_resent_events_apply_failed_run_updates(client, monkeypatch):
+    import pymongo.errors
+
+    from ipsportal import ingest
+
+    def fail_once(original):
+        calls = []
+
+        def wrapper(*args, **kwargs):
+            if not calls:
+                calls.append(True)
+                msg = 'connection lost'
+                raise pymongo.errors.AutoReconnect(msg)
+            return original(*args, **kwargs)
+
+        return wrapper
+
+    portal_runid = str(uuid1())
+    start_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_START',
+        'ok': True,
+        'comment': f'Starting IPS Simulation {portal_runid}',
+        'walltime': '0.01',
+        'state': 'Running',
+        'phystimestamp': -1,
+        'portal_runid': portal_runid,
+        'seqnum': 0,
+        'user': 'retry',
+    }
+    # the run is created, but its IPS_START event is not stored
+    monkeypatch.setattr(ingest, 'add_events', fail_once(ingest.add_events))
+    response = client.post('/api/event', json=start_event)
+    assert response.json['results'] == [{'seqnum': 0, 'status': 'error', 'error': 'unknown IPS_START exception'}]
+
+    response = client.post('/api/event', json=start_event)
+    assert response.status_code == 200
+    assert response.json['results'] == [{'seqnum': 0, 'status': 'ok'}]
+    runid = response.json['runid']
+
+    end_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_END',
+        'ok': True,
+        'comment': 'Simulation Ended',
+        'walltime': '1.0',
+        'state': 'Completed',
+        'stopat': '2022-05-03|15:41:08EDT',
+        'phystimestamp': -1,
+        'portal_runid': portal_runid,
+        'seqnum': 1,
+        'trace': {
+            'timestamp': 1651606867984607,
+            'duration': 1000000,
+            'localEndpoint': {'serviceName': 'FRAMEWORK@Framework@0'},
+            'id': '0000000000000001',
+            'traceId': hashlib.md5(portal_runid.encode()).hexdigest(),
+            'name': 'IPS_END',
+        },
+    }
+    # the event is stored, but the run is not updated
+    monkeypatch.setattr(ingest, 'bulk_update_runs', fail_once(ingest.bulk_update_runs))
+    response = client.post('/api/event', json=end_event)
+    assert response.status_code == 400
+    assert response.json['errors'] == ['Unable to update run']
+    assert client.get(f'/api/run/{runid}').json['state'] == 'Running'
+
+    # the retry is a duplicate, and still ends the run
+    response = client.post('/api/event', json=end_event)
+    assert response.status_code == 200
+    assert response.json['duplicates'] == 1
+    run = client.get(f'/api/run/{runid}').json
+    assert run['state'] == 'Completed'
+    assert run['stopat'] == '2022-05-03|15:41:08EDT'
+    assert run['has_trace']
+
+    # resending it again does not add the trace twice
+    client.post('/api/event', json=end_event)
+    from ipsportal.db import get_trace
+
+    assert len(get_trace({'runid': runid})) == 1
+
+
 def test_runid_not_found(client):
     response = client.get('/api/run/10000000')
     assert response.status_code == 404
@@ -356,3 +514,1328 @@ def test_post_event_array(client):
     response = client.get(f'/api/run/{portal_runid}/events')
     assert response.status_code == 200
     assert len(response.json) == 2
+
+
+def test_post_event_batch_statuses(client):
+    portal_runid = str(uuid1())
+    invalid_portal_runid = str(uuid1())
+
+    def make_event(seqnum, eventtype='IPS_CALL_END', run=portal_runid, **kwargs):
+        return {
+            'code': 'Framework',
+            'eventtype': eventtype,
+            'comment': f'event {seqnum}',
+            'walltime': f'{seqnum}.0',
+            'phystimestamp': seqnum,
+            'portal_runid': run,
+            'seqnum': seqnum,
+            **kwargs,
+        }
+
+    events = [
+        make_event(0, 'IPS_START', ok=True, state='Running', user='identity_crisis'),
+        make_event(1),
+        make_event(1, run=invalid_portal_runid),
+        make_event(2),
+        make_event(3, 'IPS_END', ok=True, state='Completed'),
+        make_event(4),
+    ]
+    response = client.post('/api/event', json=events)
+
+    # events for unknown or ended runs fail individually, everything else is still applied
+    assert response.status_code == 400
+    assert response.json['message'] == 'New run created and 4 events added to run and run ended'
+    assert response.json['errors'] == ['Invalid portal_runid', 'Invalid portal_runid']
+    assert [result['status'] for result in response.json['results']] == ['ok', 'ok', 'error', 'ok', 'ok', 'error']
+
+    response = client.get(f'/api/run/{portal_runid}/events')
+    assert response.status_code == 200
+    assert [event['seqnum'] for event in response.json] == [0, 1, 2, 3]
+
+    # a malformed event rejects the whole batch before anything is written
+    other_portal_runid = str(uuid1())
+    response = client.post(
+        '/api/event',
+        json=[
+            make_event(0, 'IPS_START', run=other_portal_runid, state='Running', user='identity_crisis'),
+            {'code': 'Framework'},
+        ],
+    )
+    assert response.status_code == 400
+    assert response.json['message'].startswith('Missing required data: ')
+    assert [result['status'] for result in response.json['results']] == ['not_applied', 'error']
+    assert client.get(f'/api/run/{other_portal_runid}').status_code == 404
+
+
+def test_trace_propagates_to_all_ancestors(client, monkeypatch):
+    from ipsportal.trace_jaeger import span_forwarder
+
+    sent_spans = []
+    monkeypatch.setattr(span_forwarder, 'enqueue', sent_spans.extend)
+
+    portal_runids = [str(uuid1()) for _ in range(3)]
+    parent_portal_runid = None
+    for portal_runid in portal_runids:
+        start_event = {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'identity_crisis',
+        }
+        if parent_portal_runid:
+            start_event['parent_portal_runid'] = parent_portal_runid
+        response = client.post('/api/event', json=start_event)
+        assert response.status_code == 200
+        parent_portal_runid = portal_runid
+
+    response = client.post(
+        '/api/event',
+        json={
+            'code': 'Framework',
+            'eventtype': 'IPS_CALL_END',
+            'comment': 'Target = sim@driver@2:finalize(0)',
+            'walltime': '1.0',
+            'phystimestamp': 0,
+            'portal_runid': portal_runids[-1],
+            'seqnum': 1,
+            'trace': {'timestamp': 1651606894526459, 'id': '6daf4d4c1a7bd43b', 'traceId': 'grandchild'},
+        },
+    )
+    assert response.status_code == 200
+
+    assert [span['traceId'] for span in sent_spans] == [
+        'grandchild',
+        hashlib.md5(portal_runids[1].encode()).hexdigest(),
+        hashlib.md5(portal_runids[0].encode()).hexdigest(),
+    ]
+
+
+def test_post_event_stream(client):
+    portal_runid = str(uuid1())
+    events = [
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'identity_crisis',
+        },
+        *(
+            {
+                'code': 'Framework',
+                'eventtype': 'IPS_CALL_END',
+                'comment': f'event {seqnum}',
+                'walltime': f'{seqnum}.0',
+                'phystimestamp': seqnum,
+                'portal_runid': portal_runid,
+                'seqnum': seqnum,
+            }
+            for seqnum in range(1, 1200)
+        ),
+    ]
+    lines = [json.dumps(event) for event in events]
+    # invalid lines are reported by line number, without affecting the rest of the stream
+    lines.insert(3, '{"not": "an event"')
+    lines.insert(5, '{"code": "Framework"}')
+    body = gzip.compress(('\n'.join(lines) + '\n').encode())
+
+    response = client.post(
+        '/api/events/stream',
+        data=body,
+        headers={'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'},
+    )
+    assert response.status_code == 400
+    assert response.json['message'] == 'New run created and 1200 events added to run'
+    assert response.json['lines'] == 1202
+    assert response.json['failed'] == 2
+    assert [error['line'] for error in response.json['errors']] == [4, 6]
+
+    response = client.get(f'/api/run/{portal_runid}/events')
+    assert response.status_code == 200
+    assert [event['seqnum'] for event in response.json] == list(range(1200))
+
+    response = client.post('/api/events/stream', data=body, headers={'Content-Type': 'application/json'})
+    assert response.status_code == 415
+
+
+def test_post_event_stream_reports_ingest_errors(client):
+    portal_runid = str(uuid1())
+    events = [
+        # the parent of this ensemble member does not exist, so the ensemble cannot be updated
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'parent_portal_runid': str(uuid1()),
+            'portal_ensemble_id': str(uuid1()),
+            'simname': 'sim_0',
+            'seqnum': 0,
+            'user': 'orphan',
+        },
+        # events of unknown runs are rejected
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_CALL_END',
+            'comment': 'lost',
+            'walltime': '1.0',
+            'phystimestamp': 1,
+            'portal_runid': str(uuid1()),
+            'seqnum': 1,
+        },
+    ]
+    response = client.post(
+        '/api/events/stream',
+        data='\n'.join(json.dumps(event) for event in events),
+        headers={'Content-Type': 'application/x-ndjson'},
+    )
+    assert response.status_code == 400
+    assert response.json['failed'] == 1
+    assert response.json['errors'] == [
+        {'line': 2, 'error': 'Invalid portal_runid'},
+        {'error': 'Could not update parent ensemble information'},
+    ]
+
+
+def test_create_indexes_command(runner):
+    result = runner.invoke(args=['create-indexes'])
+    assert result.exit_code == 0
+    assert 'Created indexes' in result.output
+
+
+def test_timeout_sweeper_lease(app):
+    from ipsportal.db import acquire_lease, get_db
+
+    with app.app_context():
+        name = f'test-lease-{uuid1()}'
+        assert acquire_lease(name, 'worker-1', 60)
+        # only one worker sweeps, while the lease is renewed
+        assert not acquire_lease(name, 'worker-2', 60)
+        assert acquire_lease(name, 'worker-1', 60)
+
+        # another worker takes over once the lease expired
+        get_db().leases.update_one(
+            {'_id': name}, {'$set': {'expires': datetime.now(timezone.utc) - timedelta(minutes=1)}}
+        )
+        assert acquire_lease(name, 'worker-2', 60)
+        assert not acquire_lease(name, 'worker-1', 60)
+
+
+def test_migrate_embedded_events(app, client, runner):
+    from ipsportal.db import get_db, get_events, get_events_page, migrate_embedded_events
+
+    portal_runid = str(uuid1())
+    events = [
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'migrator',
+        },
+        *(
+            {
+                'code': 'DRIVER',
+                'eventtype': 'IPS_CALL_BEGIN',
+                'ok': True,
+                'comment': f'Target = x:step({seqnum})',
+                'walltime': f'{seqnum}.0',
+                'phystimestamp': seqnum,
+                'portal_runid': portal_runid,
+                'seqnum': seqnum,
+            }
+            for seqnum in range(1, 4)
+        ),
+    ]
+    response = client.post('/api/event', json=events)
+    assert response.status_code == 200
+
+    def table_seqnums():
+        arguments = {'draw': 1, 'start': 0, 'length': 10, 'columns': [], 'order': []}
+        response = client.get(
+            f'/api/run/{portal_runid}/events-datatables', query_string={'data': json.dumps(arguments)}
+        )
+        assert response.status_code == 200
+        return [event['seqnum'] for event in response.json['data']]
+
+    with app.app_context():
+        # runs created by older versions of the portal embed their events
+        db = get_db()
+        ingested = get_events({'portal_runid': portal_runid})
+        embedded = [{k: v for k, v in event.items() if k != 'portal_runid'} for event in ingested]
+        db.events.delete_many({'portal_runid': portal_runid})
+        db.runs.update_one(
+            {'portal_runid': portal_runid}, {'$set': {'events': embedded}, '$unset': {'event_count': True}}
+        )
+        assert get_events({'portal_runid': portal_runid}) == embedded
+        assert get_events({'portal_runid': portal_runid}, after_seqnum=2) == embedded[3:]
+        # the events table only queries the events collection
+        assert get_events_page({'portal_runid': portal_runid}) == []
+        assert table_seqnums() == []
+
+        # an interrupted migration left one of the events behind
+        db.events.insert_one({**embedded[2], 'portal_runid': portal_runid})
+
+        result = runner.invoke(args=['migrate-events'])
+        assert result.exit_code == 0
+        assert 'Migrated the events of' in result.output
+
+        run = db.runs.find_one({'portal_runid': portal_runid})
+        assert 'events' not in run
+        assert run['event_count'] == 4
+        assert run['last_seqnum'] == 3
+        assert get_events({'portal_runid': portal_runid}) == ingested
+        assert get_events({'portal_runid': portal_runid}, after_seqnum=2) == ingested[3:]
+        assert get_events_page({'portal_runid': portal_runid}) == ingested
+        assert table_seqnums() == [0, 1, 2, 3]
+
+        # migrating again changes nothing
+        stored = list(db.events.find({'portal_runid': portal_runid}, sort=[('seqnum', 1)]))
+        assert migrate_embedded_events() == 0
+        assert list(db.events.find({'portal_runid': portal_runid}, sort=[('seqnum', 1)])) == stored
+        assert db.runs.find_one({'portal_runid': portal_runid}) == run
+
+
+def test_timed_out_run_resumes(client, runner):
+    portal_runid = str(uuid1())
+    start_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_START',
+        'ok': True,
+        'comment': f'Starting IPS Simulation {portal_runid}',
+        'walltime': '0.01',
+        'state': 'Running',
+        'startat': '2022-05-03|15:41:07EDT',
+        'rcomment': 'CI Test',
+        'phystimestamp': -1,
+        'portal_runid': portal_runid,
+        'seqnum': 0,
+        'user': 'sleepy',
+    }
+    response = client.post('/api/event', json=start_event)
+    assert response.status_code == 200
+
+    result = runner.invoke(args=['sweep-timeouts', '--hours', '0'])
+    assert result.exit_code == 0
+
+    response = client.get(f'/api/run/{portal_runid}')
+    assert response.json['state'] == 'Timeout'
+    assert response.json['stopat']
+
+    event = {
+        'code': 'DRIVER',
+        'eventtype': 'IPS_CALL_BEGIN',
+        'ok': True,
+        'comment': 'Target = x:step(1)',
+        'walltime': '100.0',
+        'phystimestamp': 1,
+        'portal_runid': portal_runid,
+        'seqnum': 1,
+    }
+    response = client.post('/api/event', json=event)
+    assert response.status_code == 200
+
+    response = client.get(f'/api/run/{portal_runid}')
+    assert response.json['state'] == 'Running'
+    assert 'stopat' not in response.json
+    assert response.json['event_count'] == 2
+
+
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+def test_runs_datatables_sorts_use_indexes(app):
+    from ipsportal.datatables import _parse_sort_arguments
+    from ipsportal.db import ensure_indexes, get_db
+    from ipsportal.util import ALLOWED_PROPS_RUN
+
+    with app.app_context():
+        db = get_db()
+        ensure_indexes(db)
+        columns = [{'data': prop, 'orderable': True} for prop in ALLOWED_PROPS_RUN]
+        for col_idx, prop in enumerate(ALLOWED_PROPS_RUN):
+            for direction in ('asc', 'desc'):
+                sort = _parse_sort_arguments(
+                    {'columns': columns, 'order': [{'column': col_idx, 'dir': direction}]}, ALLOWED_PROPS_RUN
+                )
+                plan = (db.runs.find({'parent_portal_runid': None}).sort(list(sort.items())).limit(20).explain())[
+                    'queryPlanner'
+                ]['winningPlan']
+                stages = set(_plan_stages(plan))
+                assert 'COLLSCAN' not in stages, (prop, direction, plan)
+                assert 'SORT' not in stages, (prop, direction, plan)
+
+
+def test_events_datatables_sorts_use_indexes(app):
+    from ipsportal.datatables import _parse_sort_arguments
+    from ipsportal.db import ensure_indexes, get_db
+
+    with app.app_context():
+        db = get_db()
+        ensure_indexes(db)
+        columns = [{'data': prop, 'orderable': True} for prop in ALLOWED_PROPS_EVENT]
+        for col_idx, prop in enumerate(ALLOWED_PROPS_EVENT):
+            for direction in ('asc', 'desc'):
+                sort = _parse_sort_arguments(
+                    {'columns': columns, 'order': [{'column': col_idx, 'dir': direction}]},
+                    ALLOWED_PROPS_EVENT,
+                    tiebreaker='seqnum',
+                )
+                plan = (db.events.find({'portal_runid': 'sorted'}).sort(list(sort.items())).limit(20).explain())[
+                    'queryPlanner'
+                ]['winningPlan']
+                stages = set(_plan_stages(plan))
+                assert 'COLLSCAN' not in stages, (prop, direction, plan)
+                assert 'SORT' not in stages, (prop, direction, plan)
+
+
+def test_runs_datatables_search(client):
+    portal_runid = str(uuid1())
+    user = f'searcher{uuid1().hex}'
+    response = client.post(
+        '/api/event',
+        json={
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'startat': '2022-05-03|15:41:07EDT',
+            'rcomment': 'Searchable Comment',
+            'simname': 'search_sim',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': user,
+        },
+    )
+    assert response.status_code == 200
+    runid = response.json['runid']
+
+    def search(value):
+        arguments = {'draw': 1, 'start': 0, 'length': 10, 'columns': [], 'search': {'value': value}}
+        response = client.get('/api/runs-datatables', query_string={'data': json.dumps(arguments)})
+        assert response.status_code == 200
+        return [run['runid'] for run in response.json['data']]
+
+    assert runid in search(f'user:{user[:12].upper()}')
+    assert runid in search(f'{user} searchable')
+    assert runid in search(f'{user} state:run')
+    assert search(f'{user} state:completed') == []
+    assert search(f'host:{user}') == []
+
+
+def test_runs_datatables_counts(client):
+    def totals():
+        arguments = {'draw': 1, 'start': 0, 'length': 1, 'columns': []}
+        response = client.get('/api/runs-datatables', query_string={'data': json.dumps(arguments)})
+        assert response.status_code == 200
+        return response.json['recordsTotal'], response.json['recordsFiltered']
+
+    total, filtered = totals()
+    assert total == filtered
+
+    portal_runid = str(uuid1())
+    response = client.post(
+        '/api/event',
+        json={
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'counter',
+        },
+    )
+    assert response.status_code == 200
+    assert totals() == (total + 1, filtered + 1)
+
+
+def test_child_runs_pages(client):
+    parent_portal_runid = str(uuid1())
+
+    def start_event(portal_runid, **kwargs):
+        return {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'pager',
+            **kwargs,
+        }
+
+    events = [start_event(parent_portal_runid)]
+    # frameworks send the walltime as a string or as a number
+    events += [
+        start_event(str(uuid1()), parent_portal_runid=parent_portal_runid, walltime=walltime)
+        for walltime in ('0.01', 2.5, '1.0', 0.5, '3.0')
+    ]
+    response = client.post('/api/event', json=events)
+    assert response.status_code == 200
+
+    all_children = client.get(f'/api/run/{parent_portal_runid}/children').json
+    assert len(all_children) == 5
+
+    for sort, direction in (('runid', 'asc'), ('runid', 'desc'), ('walltime', 'asc'), ('walltime', 'desc')):
+        runids = []
+        cursor = None
+        while True:
+            query = {'limit': 2, 'sort': sort, 'dir': direction}
+            if cursor:
+                query['cursor'] = cursor
+            response = client.get(f'/api/run/{parent_portal_runid}/children', query_string=query)
+            assert response.status_code == 200
+            runids += [run['runid'] for run in response.json['data']]
+            cursor = response.json['next_cursor']
+            if cursor is None:
+                break
+        if sort == 'runid':
+            assert runids == sorted((run['runid'] for run in all_children), reverse=direction == 'desc')
+        else:
+            # no child is skipped, even though keyset filters only match walltimes of one type
+            assert sorted(runids) == sorted(run['runid'] for run in all_children)
+
+    response = client.get(f'/api/run/{parent_portal_runid}/children', query_string={'cursor': 'garbage'})
+    assert response.status_code == 400
+
+
+def test_runs_datatables_cursor(client):
+    def page(**kwargs):
+        arguments = {
+            'draw': 1,
+            'start': 0,
+            'length': 2,
+            'columns': [{'data': 'runid', 'orderable': True}],
+            'order': [{'column': 0, 'dir': 'desc'}],
+            **kwargs,
+        }
+        response = client.get('/api/runs-datatables', query_string={'data': json.dumps(arguments)})
+        assert response.status_code == 200
+        return response.json
+
+    first = page()
+    assert first['next_cursor']
+    second = page(start=2, cursor=first['next_cursor'])
+    assert [run['runid'] for run in second['data']] == [run['runid'] for run in page(start=2)['data']]
+
+
+def test_trace_of_run_hierarchy(client, monkeypatch):
+    from ipsportal.trace_jaeger import span_forwarder
+
+    monkeypatch.setattr(span_forwarder, 'enqueue', lambda spans: None)
+
+    # a parent with two children, one of which has a child itself
+    portal_runids = [str(uuid1()) for _ in range(4)]
+    parents = [None, portal_runids[0], portal_runids[0], portal_runids[1]]
+    events = []
+    for portal_runid, parent_portal_runid in zip(portal_runids, parents, strict=True):
+        start_event = {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'tracer',
+        }
+        if parent_portal_runid:
+            start_event['parent_portal_runid'] = parent_portal_runid
+        events.append(start_event)
+        events.append(
+            {
+                'code': 'Framework',
+                'eventtype': 'IPS_CALL_END',
+                'comment': 'Target = sim@driver@2:finalize(0)',
+                'walltime': '1.0',
+                'phystimestamp': 0,
+                'portal_runid': portal_runid,
+                'seqnum': 1,
+                'trace': {'timestamp': 1651606894526459, 'id': portal_runid, 'traceId': portal_runid},
+            }
+        )
+    response = client.post('/api/event', json=events)
+    assert response.status_code == 200
+
+    response = client.get(f'/api/run/{portal_runids[0]}/trace')
+    assert response.status_code == 200
+    assert response.json[0]['id'] == portal_runids[0]
+    assert sorted(span['id'] for span in response.json) == sorted(portal_runids)
+    assert {span['traceId'] for span in response.json} == {portal_runids[0]}
+
+    response = client.get(f'/api/run/{portal_runids[0]}/trace', query_string={'depth': 1})
+    assert sorted(span['id'] for span in response.json) == sorted(portal_runids[:3])
+
+    response = client.get(f'/api/run/{portal_runids[0]}/trace', query_string={'depth': 0})
+    assert [span['id'] for span in response.json] == [portal_runids[0]]
+
+    response = client.get(f'/api/run/{portal_runids[0]}/trace', query_string={'limit': 2})
+    assert len(response.json) == 2
+
+    response = client.get(f'/api/run/{portal_runids[1]}/trace')
+    assert sorted(span['id'] for span in response.json) == sorted([portal_runids[1], portal_runids[3]])
+
+    response = client.get(f'/api/run/{portal_runids[0]}/trace', query_string={'depth': -1})
+    assert response.status_code == 400
+
+
+def test_events_datatables(client):
+    portal_runid = str(uuid1())
+    events = [
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'table',
+        }
+    ]
+    for seqnum in range(1, 11):
+        events.append(
+            {
+                'code': 'DRIVER' if seqnum % 2 else 'WORKER',
+                'eventtype': 'IPS_CALL_BEGIN' if seqnum % 3 else 'IPS_CALL_END',
+                'comment': f'step {seqnum}',
+                'walltime': str(seqnum),
+                'phystimestamp': seqnum,
+                'portal_runid': portal_runid,
+                'seqnum': seqnum,
+            }
+        )
+    response = client.post('/api/event', json=events)
+    assert response.status_code == 200
+    runid = response.json['runid']
+
+    columns = [{'data': prop, 'orderable': True} for prop in ALLOWED_PROPS_EVENT]
+
+    def page(**kwargs):
+        arguments = {'draw': 1, 'start': 0, 'length': 3, 'columns': columns, **kwargs}
+        response = client.get(f'/api/run/{runid}/events-datatables', query_string={'data': json.dumps(arguments)})
+        assert response.status_code == 200
+        return response.json
+
+    result = page(order=[{'column': 1, 'dir': 'desc'}])
+    assert result['recordsTotal'] == 11
+    assert result['recordsFiltered'] == 11
+    assert [e['seqnum'] for e in result['data']] == [10, 9, 8]
+
+    result = page(start=3, order=[{'column': 1, 'dir': 'asc'}], code='DRIVER', seqnum_min=2, seqnum_max=9)
+    assert result['recordsTotal'] == 11
+    assert result['recordsFiltered'] == 4
+    assert [e['seqnum'] for e in result['data']] == [9]
+
+    result = page(order=[{'column': 2, 'dir': 'asc'}], eventtype='IPS_CALL_END')
+    assert [e['seqnum'] for e in result['data']] == [3, 6, 9]
+
+    response = client.get(
+        f'/api/run/{portal_runid}/events-datatables', query_string={'data': json.dumps({'columns': columns})}
+    )
+    assert response.status_code == 200
+    assert response.json['recordsTotal'] == 11
+
+    response = client.get(f'/api/run/{runid}/events-datatables', query_string={'data': json.dumps({'seqnum_min': 'x'})})
+    assert response.status_code == 400
+
+    response = client.get('/api/run/100000000/events-datatables')
+    assert response.status_code == 404
+
+
+def test_poll_events_after_seqnum(client):
+    portal_runid = str(uuid1())
+    start_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_START',
+        'ok': True,
+        'comment': f'Starting IPS Simulation {portal_runid}',
+        'walltime': '0.01',
+        'state': 'Running',
+        'phystimestamp': -1,
+        'portal_runid': portal_runid,
+        'seqnum': 0,
+        'user': 'poller',
+    }
+
+    def event(seqnum):
+        return {
+            'code': 'DRIVER',
+            'eventtype': 'IPS_CALL_BEGIN',
+            'comment': f'step {seqnum}',
+            'walltime': str(seqnum),
+            'phystimestamp': seqnum,
+            'portal_runid': portal_runid,
+            'seqnum': seqnum,
+        }
+
+    response = client.post('/api/event', json=[start_event, event(1), event(2)])
+    assert response.status_code == 200
+    runid = response.json['runid']
+
+    response = client.get(f'/api/run/{runid}', query_string={'after_seqnum': 2})
+    assert response.status_code == 200
+    assert response.json['last_seqnum'] == 2
+    assert response.json['new_events'] is False
+    assert 'rcomment' not in response.json
+    assert client.get(f'/api/run/{runid}/events', query_string={'after_seqnum': 2}).json == []
+
+    response = client.post('/api/event', json=[event(3), event(4)])
+    assert response.status_code == 200
+
+    response = client.get(f'/api/run/{portal_runid}', query_string={'after_seqnum': 2})
+    assert response.json['new_events'] is True
+    assert response.json['walltime'] == '4'
+    assert response.json['event_count'] == 5
+    response = client.get(f'/api/run/{portal_runid}/events', query_string={'after_seqnum': 2})
+    assert [e['seqnum'] for e in response.json] == [3, 4]
+
+    response = client.get(f'/api/run/{runid}/events', query_string={'after_seqnum': 'x'})
+    assert response.status_code == 400
+
+
+def test_run_stream(client):
+    portal_runid = str(uuid1())
+    start_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_START',
+        'ok': True,
+        'comment': f'Starting IPS Simulation {portal_runid}',
+        'walltime': '0.01',
+        'state': 'Running',
+        'phystimestamp': -1,
+        'portal_runid': portal_runid,
+        'seqnum': 0,
+        'user': 'follower',
+    }
+    response = client.post('/api/event', json=start_event)
+    assert response.status_code == 200
+    runid = response.json['runid']
+
+    response = client.get(f'/api/run/{runid}/stream', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    stream = iter(response.response)
+    assert next(stream).startswith(b'retry:')
+
+    def read_message():
+        message = next(stream).decode()
+        fields = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+        return fields['event'], json.loads(fields['data']), fields.get('id')
+
+    message_type, run, _ = read_message()
+    assert message_type == 'run'
+    assert run['state'] == 'Running'
+
+    end_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_END',
+        'ok': True,
+        'comment': 'Simulation Ended',
+        'walltime': '2.0',
+        'state': 'Completed',
+        'stopat': '2022-05-03|15:41:34EDT',
+        'phystimestamp': 1,
+        'portal_runid': portal_runid,
+        'seqnum': 1,
+    }
+    response = client.post('/api/event', json=end_event)
+    assert response.status_code == 200
+
+    message_type, events, event_id = read_message()
+    assert message_type == 'events'
+    assert [e['seqnum'] for e in events] == [1]
+    assert event_id == '1'
+    message_type, run, _ = read_message()
+    assert message_type == 'run'
+    assert run['state'] == 'Completed'
+    assert run['stopat'] == end_event['stopat']
+    assert read_message()[:2] == ('end', 'Completed')
+
+
+def test_ended_run_revalidation(client, monkeypatch):
+    from ipsportal import http_cache
+
+    portal_runid = str(uuid1())
+    start_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_START',
+        'ok': True,
+        'comment': f'Starting IPS Simulation {portal_runid}',
+        'walltime': '0.01',
+        'state': 'Running',
+        'phystimestamp': -1,
+        'portal_runid': portal_runid,
+        'seqnum': 0,
+        'user': 'cacher',
+    }
+    response = client.post('/api/event', json=start_event)
+    assert response.status_code == 200
+    runid = response.json['runid']
+
+    # running runs change with every event
+    response = client.get(f'/api/run/{runid}')
+    assert response.status_code == 200
+    assert response.headers.get('ETag') is None
+
+    # polling a running run does not look up its validators again for a while
+    class NoRuns:
+        def find_one(self, *args, **kwargs):
+            raise AssertionError
+
+    with monkeypatch.context() as m:
+        m.setattr(http_cache, 'db', type('NoDb', (), {'runs': NoRuns()})())
+        for url in (f'/api/run/{runid}', f'/api/run/{portal_runid}/events'):
+            response = client.get(url)
+            assert response.status_code == 200
+            assert response.headers.get('ETag') is None
+
+    end_event = {
+        'code': 'Framework',
+        'eventtype': 'IPS_END',
+        'ok': True,
+        'comment': 'Simulation Ended',
+        'walltime': '2.0',
+        'state': 'Completed',
+        'stopat': '2022-05-03|15:41:34EDT',
+        'phystimestamp': 1,
+        'portal_runid': portal_runid,
+        'seqnum': 1,
+    }
+    response = client.post('/api/event', json=end_event)
+    assert response.status_code == 200
+
+    for url in (f'/api/run/{runid}', f'/api/run/{portal_runid}/events'):
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert response.headers['Last-Modified']
+        assert 'public' in response.headers['Cache-Control']
+        body = response.data
+
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers['ETag'] == etag
+        assert response.data == body
+
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+
+def test_ended_run_trace_revalidation(client):
+    from ipsportal.http_cache import _response_cache
+
+    portal_runids = [str(uuid1()), str(uuid1())]
+    runids = []
+    for portal_runid, parent_portal_runid in zip(portal_runids, [None, portal_runids[0]], strict=True):
+        start_event = {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'cacher',
+        }
+        if parent_portal_runid:
+            start_event['parent_portal_runid'] = parent_portal_runid
+        response = client.post('/api/event', json=start_event)
+        assert response.status_code == 200
+        runids.append(response.json['runid'])
+
+    def end(portal_runid):
+        response = client.post(
+            '/api/event',
+            json={
+                'code': 'Framework',
+                'eventtype': 'IPS_END',
+                'ok': True,
+                'comment': 'Simulation Ended',
+                'walltime': '2.0',
+                'state': 'Completed',
+                'stopat': '2022-05-03|15:41:34EDT',
+                'phystimestamp': 1,
+                'portal_runid': portal_runid,
+                'seqnum': 1,
+                'trace': {
+                    'timestamp': 1651606867984607,
+                    'duration': 2000000,
+                    'id': portal_runid,
+                    'traceId': hashlib.md5(portal_runid.encode()).hexdigest(),
+                },
+            },
+        )
+        assert response.status_code == 200
+
+    # the trace of the parent includes its child, which is still running
+    end(portal_runids[0])
+    url = f'/api/run/{runids[0]}/trace'
+    response = client.get(url)
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    assert response.headers.get('ETag') is None
+
+    end(portal_runids[1])
+    response = client.get(url)
+    assert response.status_code == 200
+    assert len(response.json) == 2
+    etag = response.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    # the trace is streamed, so it is not buffered in the response cache
+    assert not any(key.startswith(url) for key in _response_cache._entries)
+
+
+def test_tier_runs(client, runner, monkeypatch):
+    from ipsportal import archive
+    from ipsportal.trace_jaeger import span_forwarder
+
+    monkeypatch.setattr(span_forwarder, 'enqueue', lambda spans: None)
+    objects = {}
+    monkeypatch.setattr(
+        archive, 'put_private_object', lambda data, bucket, object_id, content_type: objects.update({object_id: data})
+    )
+    monkeypatch.setattr(archive, 'get_minio_object', lambda bucket, object_id: objects[object_id])
+
+    # a running parent with a child which ended
+    portal_runids = [str(uuid1()), str(uuid1())]
+    events = []
+    for portal_runid, parent_portal_runid in zip(portal_runids, [None, portal_runids[0]], strict=True):
+        start_event = {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'user': 'archiver',
+        }
+        if parent_portal_runid:
+            start_event['parent_portal_runid'] = parent_portal_runid
+        events.append(start_event)
+        events.append(
+            {
+                'code': 'Framework',
+                'eventtype': 'IPS_CALL_END',
+                'comment': 'Target = sim@driver@2:finalize(0)',
+                'walltime': '1.0',
+                'phystimestamp': 0,
+                'portal_runid': portal_runid,
+                'seqnum': 1,
+                'trace': {'timestamp': 1651606894526459, 'id': portal_runid, 'traceId': portal_runid},
+            }
+        )
+    events.append(
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_END',
+            'ok': True,
+            'comment': 'Simulation Ended',
+            'walltime': '2.0',
+            'state': 'Completed',
+            'stopat': '2022-05-03|15:41:34EDT',
+            'phystimestamp': 1,
+            'portal_runid': portal_runids[1],
+            'seqnum': 2,
+        }
+    )
+    response = client.post('/api/event', json=events)
+    assert response.status_code == 200
+
+    result = runner.invoke(args=['tier-runs', '--days', '0'])
+    assert result.exit_code == 0
+    assert f'{portal_runids[1]}/events.json.gz' in objects
+    assert f'{portal_runids[0]}/events.json.gz' not in objects
+
+    # MinIO errors are reported as unavailable archives
+    def unavailable(bucket, object_id):
+        raise MaxRetryError(None, f'/{bucket}/{object_id}')
+
+    monkeypatch.setattr(archive, 'get_minio_object', unavailable)
+    datatables_query = {'data': json.dumps({'draw': 1, 'start': 0, 'length': 10, 'columns': [], 'order': []})}
+    for url, query_string in (
+        (f'/api/run/{portal_runids[1]}/events', {}),
+        (f'/api/run/{portal_runids[1]}/trace', {}),
+        (f'/api/run/{portal_runids[1]}/events-datatables', datatables_query),
+    ):
+        response = client.get(url, query_string=query_string)
+        assert response.status_code == 503
+        assert 'unavailable' in response.json['message']
+    response = client.get(f'/api/run/{portal_runids[1]}/stream', query_string={'after_seqnum': 0})
+    assert response.status_code == 200
+    assert 'event: error' in response.get_data(as_text=True)
+    monkeypatch.setattr(archive, 'get_minio_object', lambda bucket, object_id: objects[object_id])
+
+    # resent events of archived runs were already ingested
+    for resent in (events[2:4], events[2:3], events[4:5]):
+        response = client.post('/api/event', json=resent)
+        assert response.status_code == 200
+        assert response.json['duplicates'] == len(resent)
+
+    response = client.get(f'/api/run/{portal_runids[1]}/events', query_string={'after_seqnum': 0})
+    assert response.status_code == 200
+    assert [e['seqnum'] for e in response.json] == [1, 2]
+
+    response = client.get(f'/api/run/{portal_runids[0]}/trace')
+    assert response.status_code == 200
+    assert sorted(span['id'] for span in response.json) == sorted(portal_runids)
+
+    response = client.get(f'/api/run/{portal_runids[1]}/events-datatables', query_string=datatables_query)
+    assert response.status_code == 200
+    assert response.json['recordsTotal'] == 3
+
+
+def test_resource_plot(client, monkeypatch):
+    from ipsportal.trace_jaeger import span_forwarder
+
+    monkeypatch.setattr(span_forwarder, 'enqueue', lambda spans: None)
+    portal_runid = str(uuid1())
+    events = [
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': portal_runid,
+            'seqnum': 0,
+            'simname': 'plotted',
+            'rcomment': 'resources',
+            'user': 'plotter',
+        },
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_TASK_END',
+            'comment': 'task finished',
+            'walltime': '1.0',
+            'phystimestamp': 0,
+            'portal_runid': portal_runid,
+            'seqnum': 1,
+            'trace': {
+                'timestamp': 1_000_000,
+                'duration': 2_000_000,
+                'localEndpoint': {'serviceName': 'worker'},
+                'traceId': portal_runid,
+                'tags': {'cores_allocated': '4'},
+            },
+        },
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_END',
+            'ok': True,
+            'comment': 'Simulation Ended',
+            'walltime': '4.0',
+            'state': 'Completed',
+            'stopat': '2022-05-03|15:41:34EDT',
+            'phystimestamp': 1,
+            'portal_runid': portal_runid,
+            'seqnum': 2,
+            'trace': {
+                'timestamp': 0,
+                'duration': 4_000_000,
+                'localEndpoint': {'serviceName': 'sim'},
+                'traceId': portal_runid,
+                'tags': {'total_cores': 8},
+            },
+        },
+    ]
+    response = client.post('/api/event', json=events)
+    assert response.status_code == 200
+    runid = client.get(f'/api/run/{portal_runid}').json['runid']
+
+    response = client.get(f'/api/run/{runid}/resource_plot.json')
+    assert response.status_code == 200
+    [trace] = response.json['data']
+    assert trace['type'] == 'scattergl'
+    assert trace['name'] == 'worker'
+    assert max(trace['y']) == 4
+
+    response = client.get(f'/resource_plot/{runid}')
+    assert response.status_code == 200
+    assert b'plotly.min.js' in response.data
+    assert b'<script type="text/javascript">window.PlotlyConfig' not in response.data
+
+    response = client.get('/resource_plot/plotly.min.js')
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    response.close()
+
+    response = client.get('/api/run/999999999/resource_plot.json')
+    assert response.status_code == 500
+
+
+def test_ensemble_members(client, monkeypatch):
+    import csv
+
+    from ipsportal import environment
+    from ipsportal.db import get_ensembles
+    from ipsportal.ensemble import _pending_csvs, flush_ensemble_csvs
+
+    parent_portal_runid = str(uuid1())
+    response = client.post(
+        '/api/event',
+        json={
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {parent_portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': parent_portal_runid,
+            'seqnum': 0,
+            'user': 'ensembler',
+        },
+    )
+    assert response.status_code == 200
+    parent_runid = response.json['runid']
+
+    ensemble_id = str(uuid1())
+    response = client.post(
+        '/api/data/add_ensemble_variables',
+        data='sim_name,driver:x\nsim_0,1\nsim_1,2\nsim_2,3\n',
+        headers={
+            'Content-Type': 'text/csv',
+            'X-Api-Key': environment.SECRET_API_KEY,
+            'X-Ips-Username': 'ensembler',
+            'X-Ips-Portal-Runid': str(parent_runid),
+            'X-Ips-Component-Name': 'driver',
+            'X-Ips-Ensemble-Id': ensemble_id,
+            'X-Ips-Ensemble-Name': 'sweep',
+        },
+    )
+    assert response.status_code == 201
+    csv_path = get_ensembles(parent_runid, ensemble_id)[0]['path']
+
+    # members registered together are written with one rewrite of the CSV
+    monkeypatch.setattr(environment, 'ENSEMBLE_CSV_DELAY', 60)
+    child_runids = {}
+    for sim_name in ('sim_2', 'sim_0'):
+        portal_runid = str(uuid1())
+        response = client.post(
+            '/api/event',
+            json={
+                'code': 'Framework',
+                'eventtype': 'IPS_START',
+                'ok': True,
+                'comment': f'Starting IPS Simulation {portal_runid}',
+                'walltime': '0.01',
+                'state': 'Running',
+                'phystimestamp': -1,
+                'portal_runid': portal_runid,
+                'parent_portal_runid': parent_portal_runid,
+                'portal_ensemble_id': ensemble_id,
+                'simname': sim_name,
+                'seqnum': 0,
+                'user': 'ensembler',
+            },
+        )
+        assert response.status_code == 200
+        child_runids[sim_name] = str(response.json['runid'])
+    assert list(_pending_csvs) == [csv_path]
+    flush_ensemble_csvs()
+    assert not _pending_csvs
+
+    with open(csv_path, newline='') as fd:
+        rows = {row['sim_name']: row for row in csv.DictReader(fd)}
+    assert rows['sim_0']['portal_runid'] == child_runids['sim_0']
+    assert rows['sim_0']['run_url'].endswith(f'/{child_runids["sim_0"]}')
+    assert rows['sim_1']['portal_runid'] == '?'
+    assert rows['sim_2']['portal_runid'] == child_runids['sim_2']
+    assert rows['sim_2']['driver:x'] == '3'
+
+    response = client.get(f'/api/run/{parent_runid}/ensembles/{ensemble_id}')
+    assert response.status_code == 200
+    assert response.json['ensemble_name'] == 'sweep'
+    assert response.json['component_keys'] == ['driver:x']
+    columns = response.json['columns']
+
+    def ensemble_rows(order_column, direction, search=None):
+        arguments = {
+            'draw': 1,
+            'start': 0,
+            'length': 2,
+            'columns': [
+                {'data': idx, 'orderable': True, 'search': {'value': search if name == 'sim_name' else ''}}
+                for idx, name in enumerate(columns)
+            ],
+            'order': [{'column': columns.index(order_column), 'dir': direction}],
+        }
+        return client.get(
+            f'/api/run/{parent_runid}/ensembles/{ensemble_id}', query_string={'data': json.dumps(arguments)}
+        )
+
+    response = ensemble_rows('driver:x', 'desc')
+    assert response.status_code == 200
+    assert response.json['recordsTotal'] == 3
+    assert [row[columns.index('sim_name')] for row in response.json['data']] == ['sim_2', 'sim_1']
+
+    response = ensemble_rows('sim_name', 'asc', search='SIM_1')
+    assert response.json['recordsFiltered'] == 1
+    assert response.json['data'][0][columns.index('driver:x')] == '2'
+
+    response = client.get(f'/api/run/{parent_runid}/ensembles/unknown')
+    assert response.status_code == 404
+
+    response = client.get(f'/{parent_runid}')
+    assert response.status_code == 200
+    assert f'ensemble-id="{ensemble_id}"' in response.text
+    assert 'sim_2' not in response.text
+
+
+def test_ensemble_progress(client):
+    from ipsportal import environment
+    from ipsportal.db import sweep_timed_out_runs
+
+    parent_portal_runid = str(uuid1())
+    response = client.post(
+        '/api/event',
+        json={
+            'code': 'Framework',
+            'eventtype': 'IPS_START',
+            'ok': True,
+            'comment': f'Starting IPS Simulation {parent_portal_runid}',
+            'walltime': '0.01',
+            'state': 'Running',
+            'phystimestamp': -1,
+            'portal_runid': parent_portal_runid,
+            'seqnum': 0,
+            'user': 'ensembler',
+        },
+    )
+    assert response.status_code == 200
+    parent_runid = response.json['runid']
+
+    response = client.get(f'/api/run/{parent_runid}/ensembles/summary')
+    assert response.status_code == 404
+
+    ensemble_id = str(uuid1())
+    headers = {
+        'Content-Type': 'text/csv',
+        'X-Api-Key': environment.SECRET_API_KEY,
+        'X-Ips-Username': 'ensembler',
+        'X-Ips-Portal-Runid': str(parent_runid),
+        'X-Ips-Component-Name': 'driver',
+        'X-Ips-Ensemble-Id': ensemble_id,
+        'X-Ips-Ensemble-Name': 'sweep',
+    }
+    response = client.post('/api/data/add_ensemble_variables', data='', headers=headers)
+    assert response.status_code == 400
+    response = client.post(
+        '/api/data/add_ensemble_variables',
+        data='sim_name,driver:x\nsim_0,1\nsim_1,2\nsim_2,3\nsim_3,4\n',
+        headers=headers,
+    )
+    assert response.status_code == 201
+
+    child_portal_runids = {}
+    for sim_name in ('sim_0', 'sim_1', 'sim_2'):
+        portal_runid = str(uuid1())
+        response = client.post(
+            '/api/event',
+            json={
+                'code': 'Framework',
+                'eventtype': 'IPS_START',
+                'ok': True,
+                'comment': f'Starting IPS Simulation {portal_runid}',
+                'walltime': '0.01',
+                'state': 'Running',
+                'phystimestamp': -1,
+                'portal_runid': portal_runid,
+                'parent_portal_runid': parent_portal_runid,
+                'portal_ensemble_id': ensemble_id,
+                'simname': sim_name,
+                'seqnum': 0,
+                'user': 'ensembler',
+            },
+        )
+        assert response.status_code == 200
+        child_portal_runids[sim_name] = portal_runid
+
+    end_events = [
+        {
+            'code': 'Framework',
+            'eventtype': 'IPS_END',
+            'ok': ok,
+            'comment': 'Simulation Ended',
+            'walltime': walltime,
+            'state': 'Completed',
+            'stopat': '2022-05-03|15:41:08EDT',
+            'phystimestamp': -1,
+            'portal_runid': child_portal_runids[sim_name],
+            'seqnum': 1,
+        }
+        for sim_name, ok, walltime in (('sim_0', True, '10.0'), ('sim_1', False, '30.0'))
+    ]
+    response = client.post('/api/event', json=end_events)
+    assert response.status_code == 200
+
+    response = client.get(f'/api/run/{parent_runid}/ensembles/summary')
+    assert response.status_code == 200
+    [summary] = response.json
+    assert summary['ensemble_id'] == ensemble_id
+    assert summary['ensemble_name'] == 'sweep'
+    assert {key: summary[key] for key in ('members', 'pending', 'running', 'completed', 'failed', 'timeout')} == {
+        'members': 4,
+        'pending': 1,
+        'running': 1,
+        'completed': 1,
+        'failed': 1,
+        'timeout': 0,
+    }
+    assert summary['walltime'] == {'min': 10.0, 'max': 30.0, 'mean': 20.0}
+
+    # the running member times out, ended members and the parent are not counted twice
+    sweep_timed_out_runs(0)
+    [summary] = client.get(f'/api/run/{parent_runid}/ensembles/summary').json
+    assert (summary['running'], summary['timeout'], summary['completed']) == (0, 1, 1)
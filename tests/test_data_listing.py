@@ -0,0 +1,68 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from ipsportal._jupyter import initializer
+from ipsportal._jupyter.initializer import (
+    IPS_DATA_JOURNAL_FILE,
+    IPS_DATA_LIST_FILE,
+    initialize_jupyter_data_files,
+    refresh_jupyter_python_api,
+    update_data_listing_file,
+)
+from ipsportal._jupyter.ips_analysis_api_v1 import IPSAnalysisApi
+
+
+def test_data_listing_journal(tmp_path):
+    initialize_jupyter_data_files(tmp_path)
+    update_data_listing_file(tmp_path, 'a.h5', 1.0)
+    update_data_listing_file(tmp_path, 'b.h5', 0.0)
+    update_data_listing_file(tmp_path, 'a.h5', 1.0)
+    update_data_listing_file(tmp_path, 'c.h5', 1.0)
+
+    # new data files are only appended to the journal
+    assert json.loads((tmp_path / IPS_DATA_LIST_FILE).read_text()) == {}
+    assert len((tmp_path / IPS_DATA_JOURNAL_FILE).read_text().splitlines()) == 4
+
+    assert IPSAnalysisApi(tmp_path).get_data() == {
+        0.0: [str(tmp_path / 'data/b.h5')],
+        1.0: [str(tmp_path / 'data/a.h5'), str(tmp_path / 'data/c.h5')],
+    }
+
+
+def test_data_listing_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(initializer, 'DATA_LISTING_COMPACT_BYTES', 200)
+    initialize_jupyter_data_files(tmp_path)
+
+    def add(idx):
+        update_data_listing_file(tmp_path, f'{idx}.h5', float(idx % 10))
+
+    # concurrent writers do not lose data files, even while the journal is compacted
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(add, range(400)))
+
+    snapshot = json.loads((tmp_path / IPS_DATA_LIST_FILE).read_text())
+    assert sum(len(paths) for paths in snapshot.values()) > 0
+    assert (tmp_path / IPS_DATA_JOURNAL_FILE).stat().st_size < (tmp_path / IPS_DATA_LIST_FILE).stat().st_size
+
+    data = IPSAnalysisApi(tmp_path).get_data()
+    assert list(data) == [float(timestep) for timestep in range(10)]
+    assert sorted(path for paths in data.values() for path in paths) == sorted(
+        str(tmp_path / f'data/{idx}.h5') for idx in range(400)
+    )
+
+
+def test_refresh_outdated_api(tmp_path, monkeypatch):
+    monkeypatch.setattr(initializer, '_refreshed_api_dirs', set())
+    module_file = tmp_path / 'ips_analysis_api_v1.py'
+    module_file.write_text('# copy which only reads the data listing file\n')
+
+    refresh_jupyter_python_api(tmp_path)
+    source = (Path(initializer.__file__).parent / 'ips_analysis_api_v1.py').read_bytes()
+    assert module_file.read_bytes() == source
+    assert [path.name for path in tmp_path.iterdir()] == [module_file.name]
+
+    # each directory is only compared once
+    module_file.write_text('# modified\n')
+    refresh_jupyter_python_api(tmp_path)
+    assert module_file.read_text() == '# modified\n'
@@ -0,0 +1,67 @@
+import csv
+import io
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import uuid1
+
+import pytest
+
+from ipsportal.ensemble import PORTAL_GENERATED_KEYS, refresh_stale_ensemble_csv, save_initial_csv
+
+
+class _TruncatedStream(io.RawIOBase):
+    """Upload which fails after sending some rows."""
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._data.read(len(buffer))
+        if not chunk:
+            raise ConnectionResetError
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+
+def test_save_initial_csv(tmp_path):
+    path = tmp_path / 'ensemble.csv'
+    members = save_initial_csv(io.BytesIO(b'sim_name,driver:x\nsim_0,1\nsim_1,"a,b"\n'), path)
+    assert members == 2
+    with open(path, newline='') as fd:
+        rows = list(csv.reader(fd))
+    assert rows[0] == [*PORTAL_GENERATED_KEYS, 'sim_name', 'driver:x']
+    assert rows[2] == ['?', '?', '?', 'sim_1', 'a,b']
+
+
+def test_save_initial_csv_invalid(tmp_path):
+    path = tmp_path / 'ensemble.csv'
+    with pytest.raises(ValueError, match='empty'):
+        save_initial_csv(io.BytesIO(b''), path)
+    with pytest.raises(ConnectionResetError):
+        save_initial_csv(_TruncatedStream(b'sim_name,driver:x\n' + b'sim,1\n' * 10_000), path)
+    assert not path.exists()
+
+
+def test_refresh_stale_ensemble_csv(app, tmp_path):
+    from ipsportal.db import get_db, upsert_ensemble_member
+
+    path = tmp_path / 'ensemble.csv'
+    save_initial_csv(io.BytesIO(b'sim_name,driver:x\nsim_0,1\n'), path)
+    ensemble_id = str(uuid1())
+    with app.app_context():
+        # the process which registered the member was killed before its scheduled write
+        upsert_ensemble_member(ensemble_id, 'sim_0', {'runid': 7, 'run_url': 'url', 'instance_analysis_path': 'path'})
+        # the scheduled write may still be pending
+        assert not refresh_stale_ensemble_csv(ensemble_id, path)
+
+        registered = datetime.now(timezone.utc) - timedelta(minutes=2)
+        get_db().ensemble_members.update_many({'ensemble_id': ensemble_id}, {'$set': {'lastModified': registered}})
+        os.utime(path, (time.time() - 180, time.time() - 180))
+        assert refresh_stale_ensemble_csv(ensemble_id, path)
+        with open(path, newline='') as fd:
+            assert list(csv.reader(fd))[1] == ['7', 'url', 'path', 'sim_0', '1']
+        assert not refresh_stale_ensemble_csv(ensemble_id, path)
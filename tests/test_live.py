@@ -0,0 +1,35 @@
+from ipsportal.live import LiveBroker, Subscription, change_stream_pipeline
+
+
+def test_change_stream_pipeline_only_matches_followed_runs():
+    match, project = change_stream_pipeline(['a'], [1])
+    assert match['$match']['$or'][0]['fullDocument.portal_runid'] == {'$in': ['a']}
+    assert match['$match']['$or'][1]['documentKey._id'] == {'$in': [1]}
+    # run updates only carry their changed live fields
+    assert 'updateDescription.updatedFields.state' in project['$project']
+    assert not any(field.endswith('.traces') for field in project['$project'])
+
+
+def test_publish_change():
+    broker = LiveBroker()
+    subscription = Subscription('a', last_seqnum=0)
+    broker._subscriptions['a'] = {subscription}
+
+    broker._publish_change(
+        {'ns': {'coll': 'events'}, 'documentKey': {'_id': 'event'}, 'fullDocument': {'portal_runid': 'a', 'seqnum': 1}},
+        {},
+    )
+    broker._publish_change(
+        {
+            'ns': {'coll': 'runs'},
+            'documentKey': {'_id': 1},
+            'updateDescription': {'updatedFields': {'state': 'Completed'}},
+        },
+        {1: 'a'},
+    )
+    # runs which are not followed are ignored
+    broker._publish_change({'ns': {'coll': 'runs'}, 'documentKey': {'_id': 2}}, {1: 'a'})
+
+    assert subscription.get(timeout=0) == ('events', [{'portal_runid': 'a', 'seqnum': 1}])
+    assert subscription.get(timeout=0) == ('run', {'state': 'Completed'})
+    assert subscription.get(timeout=0) is None
@@ -134,9 +134,13 @@ def test_post_event(client):
 
     response = client.get(f'/resource_plot/{runid}')
     assert response.status_code == 200
-    assert (
+    assert 'resource-plot.js' in response.text
+
+    response = client.get(f'/api/run/{runid}/resource_plot.json')
+    assert response.status_code == 200
+    assert response.json['layout']['title']['text'] == (
         f"<a href='/{runid}'>Run - {runid}</a> Sim Name: CI Test Comment: "
-        f'CI Test {portal_runid}<br>Allocation total cores = 8' in response.text
+        f'CI Test {portal_runid}<br>Allocation total cores = 8'
     )
 
     response = client.get(f'/gettrace/{runid}')
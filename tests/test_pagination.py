@@ -0,0 +1,66 @@
+import pytest
+from bson import ObjectId
+
+from ipsportal.pagination import (
+    CursorError,
+    decode_cursor,
+    decode_offset_cursor,
+    encode_cursor,
+    encode_offset_cursor,
+    keyset_filter,
+)
+
+
+def test_cursor_round_trip():
+    sort = {'state': -1, '_id': -1}
+    _id = ObjectId()
+    cursor = encode_cursor(sort, {'state': 'Running', '_id': _id, 'user': 'x'})
+    assert decode_cursor(cursor, sort) == ['Running', _id]
+
+
+def test_cursor_for_other_sort():
+    cursor = encode_cursor({'state': 1, '_id': 1}, {'state': 'Running', '_id': ObjectId()})
+    with pytest.raises(CursorError):
+        decode_cursor(cursor, {'state': -1, '_id': -1})
+
+
+def test_offset_cursor():
+    sort = {'walltime': 1, '_id': 1}
+    assert decode_offset_cursor(encode_offset_cursor(sort, 40), sort) == 40
+    # cursors of one kind are not valid for the other
+    with pytest.raises(CursorError):
+        decode_cursor(encode_offset_cursor(sort, 40), sort)
+    with pytest.raises(CursorError):
+        decode_offset_cursor(encode_cursor(sort, {'walltime': '1.0', '_id': 5}), sort)
+    with pytest.raises(CursorError):
+        decode_offset_cursor(encode_offset_cursor(sort, -1), sort)
+
+
+@pytest.mark.parametrize('cursor', ['', 'not a cursor', 'e30', '!!!!'])
+def test_invalid_cursor(cursor):
+    with pytest.raises(CursorError):
+        decode_cursor(cursor, {'_id': 1})
+
+
+def test_keyset_filter_ascending():
+    assert keyset_filter({'user': 1, '_id': 1}, ['bob', 5]) == {
+        '$or': [{'user': {'$gt': 'bob'}}, {'$and': [{'user': 'bob'}, {'_id': {'$gt': 5}}]}]
+    }
+
+
+def test_keyset_filter_descending_includes_missing_values():
+    assert keyset_filter({'user': -1, '_id': -1}, ['bob', 5]) == {
+        '$or': [
+            {'$or': [{'user': {'$lt': 'bob'}}, {'user': None}]},
+            {'$and': [{'user': 'bob'}, {'$or': [{'_id': {'$lt': 5}}, {'_id': None}]}]},
+        ]
+    }
+
+
+def test_keyset_filter_missing_value():
+    assert keyset_filter({'user': 1, '_id': 1}, [None, 5]) == {
+        '$or': [{'user': {'$ne': None}}, {'$and': [{'user': None}, {'_id': {'$gt': 5}}]}]
+    }
+    assert keyset_filter({'user': -1, '_id': -1}, [None, 5]) == {
+        '$or': [{'$and': [{'user': None}, {'$or': [{'_id': {'$lt': 5}}, {'_id': None}]}]}]
+    }
@@ -0,0 +1,64 @@
+import random
+
+import numpy as np
+
+from ipsportal.resourceplot import get_resource_usage, lttb_indices
+
+
+def _task(component, start, duration, cores):
+    return {
+        'timestamp': start * 1_000_000,
+        'duration': duration * 1_000_000,
+        'localEndpoint': {'serviceName': component},
+        'tags': {'cores_allocated': cores},
+    }
+
+
+def test_resource_usage_steps():
+    tasks = [_task('a', 1, 2, 4), _task('b', 2, 2, 8), _task('a', 3, 1, 2)]
+    x, usage = get_resource_usage(tasks, time_start=0, duration=5)
+    assert sorted(usage) == ['a', 'b']
+    assert np.all(np.diff(x) >= 0)
+
+    def at(component, time):
+        # the value after all steps at that time
+        return usage[component][np.searchsorted(x, time, side='right') - 1]
+
+    assert [at('a', t) for t in (0, 1, 2.5, 3, 3.5, 4, 5)] == [0, 4, 4, 2, 2, 0, 0]
+    assert [at('b', t) for t in (0, 1, 2, 3, 4, 5)] == [0, 0, 8, 8, 0, 0]
+
+
+def test_resource_usage_matches_naive_sum():
+    rng = random.Random(0)
+    tasks = [_task(rng.choice('abc'), rng.randint(0, 100), rng.randint(1, 20), rng.randint(1, 16)) for _ in range(200)]
+    x, usage = get_resource_usage(tasks, time_start=0, duration=120)
+    for component, y in usage.items():
+        for time in range(121):
+            expected = sum(
+                float(t['tags']['cores_allocated'])
+                for t in tasks
+                if t['localEndpoint']['serviceName'] == component
+                and t['timestamp'] / 1e6 <= time < (t['timestamp'] + t['duration']) / 1e6
+            )
+            assert y[np.searchsorted(x, time, side='right') - 1] == expected
+
+
+def test_resource_usage_without_tasks():
+    x, usage = get_resource_usage([], time_start=0, duration=5)
+    assert list(x) == [0, 5]
+    assert usage == {}
+
+
+def test_lttb_indices():
+    x = np.arange(1000, dtype=np.float64)
+    y = np.zeros(1000)
+    y[500] = 10
+    indices = lttb_indices(x, y, 20)
+    assert len(indices) == 20
+    assert indices[0] == 0
+    assert indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+    # the peak shapes the plot, so it is kept
+    assert 500 in indices
+
+    assert list(lttb_indices(x[:10], y[:10], 20)) == list(range(10))
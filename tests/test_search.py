@@ -0,0 +1,39 @@
+from ipsportal.search import run_search_tokens, search_filter, tokenize
+
+
+def test_tokenize():
+    assert tokenize('CI Test 2022-05-03|15:41:07EDT') == ['ci', 'test', '2022', '05', '03', '15', '41', '07edt']
+    assert tokenize(42) == ['42']
+
+
+def test_run_search_tokens():
+    tokens = run_search_tokens({'runid': 7, 'user': 'Alice', 'host': 'perlmutter', 'state': 'Running', 'tag': 'x'})
+    assert tokens == ['7', 'alice', 'host:perlmutter', 'perlmutter', 'runid:7', 'user:alice']
+
+
+def test_search_filter_prefix():
+    assert search_filter(['Perl'], []) == {'$and': [{'search_tokens': {'$regex': '^perl'}}]}
+
+
+def test_search_filter_field_scoped():
+    assert search_filter(['user:Ali', 'host:perl'], []) == {
+        '$and': [{'search_tokens': {'$regex': '^user:ali'}}, {'search_tokens': {'$regex': '^host:perl'}}]
+    }
+
+
+def test_search_filter_states():
+    states = ['Running', 'Completed', 'Complete']
+    assert search_filter(['state:comp'], states) == {'$and': [{'state': {'$in': ['Completed', 'Complete']}}]}
+    assert search_filter(['run'], states) == {
+        '$and': [{'$or': [{'search_tokens': {'$regex': '^run'}}, {'state': {'$in': ['Running']}}]}]
+    }
+
+
+def test_search_filter_unknown_field_is_a_plain_term():
+    assert search_filter(['foo:bar'], []) == {
+        '$and': [{'search_tokens': {'$regex': '^foo'}}, {'search_tokens': {'$regex': '^bar'}}]
+    }
+
+
+def test_search_filter_without_words():
+    assert search_filter(['--'], []) == {}
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+import requests
+
+from ipsportal.trace_jaeger import SpanForwarder
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSession:
+    def __init__(self):
+        self.available = True
+        self.posted = []
+
+    def post(self, url, json, timeout):
+        if not self.available:
+            raise requests.exceptions.ReadTimeout
+        self.posted.append(json)
+        return FakeResponse(202)
+
+
+def make_forwarder(tmp_path, **kwargs):
+    forwarder = SpanForwarder('http://jaeger.invalid:9411/api/v2/spans', tmp_path / 'spool', **kwargs)
+    session = FakeSession()
+    forwarder._session = session
+    return forwarder, session
+
+
+def test_batches_spans(tmp_path):
+    forwarder, session = make_forwarder(tmp_path, batch_size=3, flush_interval=0.01)
+    for i in range(5):
+        forwarder._queue.put_nowait({'id': str(i)})
+
+    forwarder._flush_batch(forwarder._next_batch())
+    forwarder._flush_batch(forwarder._next_batch())
+
+    assert [[span['id'] for span in batch] for batch in session.posted] == [['0', '1', '2'], ['3', '4']]
+    assert forwarder.stats()['sent'] == 5
+
+
+def test_drops_spans_when_queue_full(tmp_path):
+    forwarder, _session = make_forwarder(tmp_path, queue_size=2)
+    forwarder._ensure_started = lambda: None
+
+    forwarder.enqueue([{'id': '0'}, {'id': '1'}, {'id': '2'}])
+
+    stats = forwarder.stats()
+    assert stats['queue_depth'] == 2
+    assert stats['dropped'] == 1
+
+
+def test_spools_while_jaeger_unavailable(tmp_path):
+    forwarder, session = make_forwarder(tmp_path, max_retries=2)
+    session.available = False
+
+    forwarder._flush_batch([{'id': '0'}])
+    # jaeger is marked unavailable, so this batch is spooled without retrying
+    forwarder._flush_batch([{'id': '1'}])
+
+    assert session.posted == []
+    stats = forwarder.stats()
+    assert stats['failed_requests'] == 2
+    assert stats['spooled'] == 2
+    assert stats['spool_files'] == 2
+
+    session.available = True
+    forwarder._unavailable_until = 0.0
+    forwarder._flush_batch([{'id': '2'}])
+
+    # the new batch is sent first, followed by the spool in the order it was written
+    assert session.posted == [[{'id': '2'}], [{'id': '0'}], [{'id': '1'}]]
+    assert forwarder.stats()['spool_files'] == 0
+
+
+def test_sends_stale_claims_again(tmp_path):
+    forwarder, session = make_forwarder(tmp_path)
+    spool_dir = tmp_path / 'spool'
+    spool_dir.mkdir()
+    # claimed by a worker which was killed while sending, pids are at most 2**22
+    (spool_dir / f'1-1.{2**22 + 1}.sending').write_text('[{"id": "0"}]')
+    # claimed by a live process, which is still sending it
+    (spool_dir / f'2-1.{os.getppid()}.sending').write_text('[{"id": "1"}]')
+
+    forwarder._drain_spool()
+
+    assert session.posted == [[{'id': '0'}]]
+    assert [path.name for path in spool_dir.iterdir()] == [f'2-1.{os.getppid()}.sending']
+
+
+def test_spool_limit(tmp_path, monkeypatch):
+    forwarder, session = make_forwarder(tmp_path, max_retries=1, spool_max_files=2)
+    session.available = False
+    for i in range(3):
+        forwarder._spool([{'id': str(i)}])
+    assert forwarder.stats()['spool_files'] == 2
+    assert forwarder.stats()['dropped'] == 1
+
+    # the spool is not listed again for every batch
+    monkeypatch.setattr(type(forwarder.spool_dir), 'glob', lambda self, pattern: pytest.fail('listed the spool'))
+    forwarder._spool([{'id': '3'}])
+    monkeypatch.undo()
+    assert forwarder.stats()['dropped'] == 2
+
+    session.available = True
+    forwarder._drain_spool()
+    forwarder._spool([{'id': '4'}])
+    assert session.posted == [[{'id': '0'}], [{'id': '1'}]]
+    assert forwarder.stats()['spool_files'] == 1